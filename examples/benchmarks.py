@@ -1,78 +1,420 @@
-from pymamba import Database
+#!/usr/bin/python3
+"""
+PyMamba benchmark suite
+
+Each benchmark is run against a fresh copy of a generated dataset and the results (operations,
+seconds and operations per second) are written out as JSON. Given a baseline (the JSON from a
+previous run) each result is compared with it's counterpart and anything that has slowed down
+by more than the tolerance is reported as a regression, in which case we exit with status 1.
+
+    python3 examples/benchmarks.py --records 100000 --output results.json
+    python3 examples/benchmarks.py --baseline results.json --tolerance 0.15
+"""
+from argparse import ArgumentParser
+from json import dump, load
+from multiprocessing import get_context
+from os import makedirs, path
+from platform import python_version
+from random import Random
+from shutil import rmtree
+from sys import exit, stdout
 from time import time
-from random import random
-from subprocess import call
+
+from pymamba import Database, __version__
+from pymamba.models import ManyToMany, Table
+
+BENCHMARKS = []
+
+
+def benchmark(func):
+    """
+    Register a benchmark, a benchmark is a generator called with (database, options), it does
+    any setup and yields, then does the work and yields the number of operations performed.
+    Only the work is timed.
+    """
+    BENCHMARKS.append(func)
+    return func
+
+
+def record(number, rnd):
+    """
+    Generate a test record
+
+    :param number: The sequence number of the record
+    :type number: int
+    :param rnd: A random number generator
+    :type rnd: Random
+    :return: A new record
+    :rtype: dict
+    """
+    return {
+        'origin': 'linux.co.uk',
+        'sid': number,
+        'when': 1500000000 + number,
+        'day': rnd.randint(0, 6),
+        'hour': rnd.randint(0, 23),
+        'text': 'x' * rnd.randint(10, 100)
+    }
+
+
+def populate(db, records, chunk, indexed=True):
+    """
+    Generate the standard dataset
+
+    :param db: The database to populate
+    :type db: Database
+    :param records: The number of records to generate
+    :type records: int
+    :param chunk: The number of records to write per transaction
+    :type chunk: int
+    :param indexed: Whether to create the standard indexes first
+    :type indexed: bool
+    :return: The table
+    :rtype: pymamba.Table
+    """
+    rnd = Random(records)
+    table = db.table('sessions')
+    if indexed:
+        table.index('by_sid', '{sid:09}')
+        table.index('by_day', '{day}', duplicates=True)
+        table.index('by_hour', '{hour:02}', duplicates=True)
+    for start in range(0, records, chunk):
+        with db.begin():
+            for number in range(start, min(start + chunk, records)):
+                table.append(record(number, rnd))
+    return table
 
 
-def chunk(db, tbl, start, count):
+def sample(table, count, seed=1):
     """
-    Create a chunk of data
-    
-    :param tbl: Table to operate on
-    :type tbl: Table
-    :param start: Starting index 
-    :type start: int
-    :param count: Number of items
+    Pick a random sample of keys from a table
+
+    :param table: The table to sample
+    :type table: pymamba.Table
+    :param count: The number of keys required
     :type count: int
+    :param seed: Seed for the random number generator
+    :type seed: int
+    :return: The keys
+    :rtype: list
+    """
+    keys = [doc['_id'] for doc in table.find()]
+    return Random(seed).sample(keys, min(count, len(keys)))
+
+
+@benchmark
+def append_single(db, options):
+    """Append records, one transaction per record"""
+    rnd = Random(0)
+    table = db.table('single')
+    count = min(options.records, options.single)
+    yield
+    for number in range(count):
+        table.append(record(number, rnd))
+    yield count
+
+
+@benchmark
+def append_bulk(db, options):
+    """Append records in transactions of 'chunk' records, no indexes"""
+    yield
+    populate(db, options.records, options.chunk, indexed=False)
+    yield options.records
+
+
+@benchmark
+def append_indexed(db, options):
+    """Append records in transactions of 'chunk' records, three indexes"""
+    yield
+    populate(db, options.records, options.chunk)
+    yield options.records
+
+
+@benchmark
+def get(db, options):
+    """Read records by key"""
+    table = db.table('sessions')
+    keys = sample(table, options.operations)
+    yield
+    for key in keys:
+        table.get(key)
+    yield len(keys)
+
+
+@benchmark
+def seek(db, options):
+    """Read all the records with a given key from a duplicate index"""
+    table = db.table('sessions')
+    yield
+    count = 0
+    for day in range(7):
+        for _ in table.seek('by_day', {'day': day}):
+            count += 1
+    yield count
+
+
+@benchmark
+def seek_one(db, options):
+    """Read records by a unique index"""
+    table = db.table('sessions')
+    sids = Random(2).sample(range(options.records), min(options.operations, options.records))
+    yield
+    for sid in sids:
+        table.seek_one('by_sid', {'sid': sid})
+    yield len(sids)
+
+
+@benchmark
+def range_index(db, options):
+    """Read records in ranges of 100 from a unique index"""
+    table = db.table('sessions')
+    yield
+    count = 0
+    for lower in range(0, options.records, options.records // 10 or 1):
+        for _ in table.range('by_sid', {'sid': lower}, {'sid': lower + 99}):
+            count += 1
+    yield count
+
+
+@benchmark
+def find(db, options):
+    """Read every record in natural order"""
+    table = db.table('sessions')
+    yield
+    yield sum(1 for _ in table.find())
+
+
+@benchmark
+def find_index(db, options):
+    """Read every record in index order"""
+    table = db.table('sessions')
+    yield
+    yield sum(1 for _ in table.find('by_hour'))
+
+
+@benchmark
+def find_expression(db, options):
+    """Read every record filtering with an expression (operations are records scanned)"""
+    table = db.table('sessions')
+    yield
+    for _ in table.find(expression=lambda doc: doc['hour'] == 12):
+        pass
+    yield table.records
+
+
+@benchmark
+def save(db, options):
+    """Update records (changing an indexed field) in transactions of 'chunk' records"""
+    table = db.table('sessions')
+    keys = sample(table, options.operations)
+    yield
+    for start in range(0, len(keys), options.chunk):
+        with db.begin():
+            for key in keys[start:start + options.chunk]:
+                doc = table.get(key)
+                doc['hour'] = (doc['hour'] + 1) % 24
+                table.save(doc)
+    yield len(keys)
+
+
+@benchmark
+def delete(db, options):
+    """Delete records in transactions of 'chunk' records"""
+    table = db.table('sessions')
+    keys = sample(table, options.operations)
+    yield
+    for start in range(0, len(keys), options.chunk):
+        with db.begin():
+            table.delete(keys[start:start + options.chunk])
+    yield len(keys)
+
+
+@benchmark
+def reindex(db, options):
+    """Rebuild all three indexes (operations are records indexed)"""
+    table = db.table('sessions')
+    yield
+    table.reindex()
+    yield table.records
+
+
+@benchmark
+def orm_many_to_many(db, options):
+    """Traverse a many-to-many relationship (operations are links followed)"""
+    class Business(Table):
+        _calculated = {}
+        _display = [{'name': 'name', 'width': 30}]
+
+    class Person(Table):
+        _calculated = {}
+        _display = [{'name': 'name', 'width': 30}]
+
+    business = Business(table=db.table('business'))
+    person = Person(table=db.table('person'))
+    ManyToMany(db, business, person)
+    companies = max(options.operations // 100, 1)
+    for number in range(companies):
+        doc = business.add({'name': 'business-{}'.format(number)})
+        for employee in range(10):
+            doc.person.append({'name': 'person-{}-{}'.format(number, employee)})
+        doc.save()
+    yield
+    count = 0
+    for _ in range(10):
+        for doc in business.find():
+            for _ in doc.person:
+                count += 1
+    yield count
+
+
+def reader(name, records):
     """
-    begin = time()
-    with db.begin():
-        for index, session in enumerate(range(start, start + count)):
-            rnd = random()
-            record = {
-	            'origin': 'linux.co.uk',
-        	    'sid': start + count - index,
-	            'when': time(),
-        	    'day': int(rnd * 6),
-            	'hour': int(rnd * 24)
-        	}	
-            tbl.append(record)
-
-    finish = time()
-    print("  - {:5}:{:5} - Append Speed/sec = {:.0f}".format(start, count, count / (finish - begin)))
-
-print('** SINGLE Threaded benchmark **')
-print('** Probably better throughput with multiple processes')
-print('')
-
-call(['rm', '-rf', 'databases/perfDB'])
-print("* No Indecies")
-db = Database('databases/perfDB')
-table = db.table('sessions')
-chunk(db,table, 0, 5000)
-chunk(db,table, 5000, 5000)
-chunk(db,table, 10000, 5000)
-db.close()
-
-call(['rm', '-rf', 'databases/perfDB'])
-print("* Indexed by sid, day, hour")
-db = Database('databases/perfDB')
-table = db.table('sessions')
-table.index('by_sid', '{sid}')
-table.index('by_day', '{day}')
-table.index('by_hour', '{hour}')
-chunk(db,table, 0, 5000)
-chunk(db,table, 5000, 5000)
-chunk(db,table, 10000, 5000)
-db.close()
-
-call(['rm', '-rf', 'databases/perfDB'])
-print("* Indexed by function")
-db = Database('databases/perfDB')
-table = db.table('sessions')
-table.index('by_multiple', '!{origin}|{day:02}|{hour:02}|{sid:05}')
-chunk(db, table, 0, 5000)
-chunk(db,table, 5000, 5000)
-chunk(db,table, 10000, 5000)
-
-print("* Linear scan through most recent index")
-start = 0
-count = 15000
-begin = time()
-for doc in table.find('by_multiple'): pass
-finish = time()
-print("  - {:5}:{:5} - Read Speed/sec   = {:.0f}".format(start, count, count / (finish - begin)))
-
-db.close()
+    Read every record in a table, run in a separate process by concurrent_readers
+
+    :param name: The name of the database
+    :type name: str
+    :param records: Not used, every process reads the whole table
+    :type records: int
+    :return: The number of records read
+    :rtype: int
+    """
+    db = Database(name)
+    try:
+        return sum(1 for _ in db.table('sessions').find())
+    finally:
+        db.close()
+
+
+@benchmark
+def concurrent_readers(db, options):
+    """Full table scans by 'readers' processes at once (operations are records read)"""
+    name = db.env.path()
+    pool = get_context('spawn').Pool(options.readers)
+    try:
+        pool.apply(reader, (name, 0))    # warm up the pool
+        yield
+        yield sum(pool.starmap(reader, [(name, options.records)] * options.readers))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def run(func, options):
+    """
+    Run a single benchmark on it's own database
+
+    :param func: The benchmark
+    :type func: function
+    :param options: Our command line options
+    :type options: Namespace
+    :return: operations, seconds and rate (operations per second)
+    :rtype: dict
+    """
+    name = path.join(options.path, func.__name__)
+    rmtree(name, ignore_errors=True)
+    db = Database(name, binlog=options.binlog)
+    try:
+        if func.__name__ not in ['append_single', 'append_bulk', 'append_indexed']:
+            populate(db, options.records, options.chunk)
+        db.sync(True)
+        steps = func(db, options)
+        next(steps)                         # setup, not timed
+        start = time()
+        operations = next(steps)
+        seconds = time() - start
+        steps.close()
+    finally:
+        db.close()
+        rmtree(name, ignore_errors=True)
+    return {'operations': operations, 'seconds': seconds, 'rate': operations / seconds if seconds else 0.0}
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compare our results with a baseline
+
+    :param results: The results of this run
+    :type results: dict
+    :param baseline: The results of a previous run
+    :type baseline: dict
+    :param tolerance: The fraction by which a rate may drop before it counts as a regression
+    :type tolerance: float
+    :return: The names of the benchmarks that have regressed
+    :rtype: list
+    """
+    regressions = []
+    for name, result in sorted(results['results'].items()):
+        before = baseline['results'].get(name)
+        if not before or not before['rate']:
+            print('  {:20} {:>12.0f}/sec (no baseline)'.format(name, result['rate']))
+            continue
+        change = result['rate'] / before['rate'] - 1
+        flag = ''
+        if change < -tolerance:
+            regressions.append(name)
+            flag = ' ** REGRESSION **'
+        print('  {:20} {:>12.0f}/sec {:>+7.1%}{}'.format(name, result['rate'], change, flag))
+    return regressions
+
+
+def main():
+    parser = ArgumentParser(description='PyMamba benchmark suite')
+    parser.add_argument('--records', type=int, default=20000, help='size of the dataset')
+    parser.add_argument('--operations', type=int, default=5000, help='operations for get/save/delete etc')
+    parser.add_argument('--single', type=int, default=2000, help='records for append_single')
+    parser.add_argument('--chunk', type=int, default=5000, help='records per write transaction')
+    parser.add_argument('--readers', type=int, default=4, help='processes for concurrent_readers')
+    parser.add_argument('--repeat', type=int, default=1, help='run each benchmark n times and keep the best')
+    parser.add_argument('--path', default='databases/benchmarks', help='where to put the databases')
+    parser.add_argument('--binlog', action='store_true', help='enable the binlog')
+    parser.add_argument('--only', nargs='*', help='only run these benchmarks')
+    parser.add_argument('--output', help='write the results (JSON) to this file')
+    parser.add_argument('--baseline', help='compare with the results (JSON) in this file')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown, i.e. 0.2 = 20%%')
+    options = parser.parse_args()
+
+    if options.records < 1 or options.operations < 1 or options.repeat < 1:
+        parser.error('--records, --operations and --repeat must be positive')
+    options.operations = min(options.operations, options.records)
+    makedirs(options.path, exist_ok=True)
+    results = {
+        'meta': {
+            'version': __version__,
+            'python': python_version(),
+            'when': time(),
+            'records': options.records,
+            'operations': options.operations,
+            'chunk': options.chunk,
+            'readers': options.readers,
+            'repeat': options.repeat,
+            'binlog': options.binlog
+        },
+        'results': {}
+    }
+    for func in BENCHMARKS:
+        if options.only and func.__name__ not in options.only:
+            continue
+        stdout.write('* {:20} {}\n'.format(func.__name__, func.__doc__))
+        stdout.flush()
+        runs = [run(func, options) for _ in range(options.repeat)]
+        results['results'][func.__name__] = result = max(runs, key=lambda r: r['rate'])
+        stdout.write('  {:20} {:>12.0f}/sec ({} in {:.3f}s)\n'.format(
+            '', result['rate'], result['operations'], result['seconds']))
+
+    if options.output:
+        with open(options.output, 'w') as io:
+            dump(results, io, indent=2, sort_keys=True)
+    if options.baseline:
+        with open(options.baseline) as io:
+            baseline = load(io)
+        if baseline['meta'].get('records') != options.records:
+            print('! baseline was run with {} records'.format(baseline['meta'].get('records')))
+        print('\n** Compared with {} (tolerance {:.0%})'.format(options.baseline, options.tolerance))
+        regressions = compare(results, baseline, options.tolerance)
+        if regressions:
+            print('\n** {} benchmark(s) regressed: {}'.format(len(regressions), ', '.join(regressions)))
+            exit(1)
 
 
+if __name__ == '__main__':
+    main()
@@ -39,13 +39,29 @@ not feature complete and not exhaustively tested in the real world.
 #   playing with.
 #
 ##############################################################################
-from lmdb import Cursor, Environment, Transaction, NotFoundError
+from lmdb import Cursor, Environment, Transaction, NotFoundError, MapFullError, MapResizedError
 from ujson import loads, dumps
 from sys import _getframe, maxsize
+from types import GeneratorType
+from time import time, sleep
+from string import Formatter
+from math import ceil
+from itertools import product
+from math import log
+from re import compile as regex, escape, DOTALL, IGNORECASE
+from datetime import datetime, timedelta, timezone
+from os import path, getpid, listdir, makedirs, mkfifo, unlink, open as os_open, read, write, close, pipe, \
+    replace, rmdir, O_RDWR, O_WRONLY, O_NONBLOCK
+from threading import Thread, local
+from weakref import WeakSet
+import os
+from select import select
+from errno import ENXIO, ENOENT
+from asyncio import get_event_loop
 from bson.objectid import ObjectId
-from ujson_delta import diff
+from ujson_delta import diff, patch
 
-__version__ = '0.3.0'
+__version__ = '0.4.0'
 
 
 def read_transaction(func):
@@ -58,7 +74,7 @@ def read_transaction(func):
         if args[0]._ctx.transaction:
             kwargs['txn'] = args[0]._ctx.transaction.txn
             return func(*args, **kwargs)
-        kwargs['txn'] = args[0]._ctx.env.begin()
+        kwargs['txn'] = args[0]._ctx._begin()
         kwargs['abort'] = True
         return func(*args, **kwargs)
     return wrapped_f
@@ -66,30 +82,92 @@ def read_transaction(func):
 
 def write_transaction(func):
     """
-    Wrapper for write transactions to ensure a an appropriate transaction is in place 
+    Wrapper for write transactions to ensure a an appropriate transaction is in place. If we
+    own the transaction and the map fills up, the map is grown and the operation is retried.
     """
     def wrapped_f(*args, **kwargs):
         if 'txn' in kwargs:
             return func(*args, **kwargs)
-        if args[0]._ctx.transaction:
-            kwargs['txn'] = args[0]._ctx.transaction.txn
+        ctx = args[0]._ctx
+        if ctx.transaction:
+            kwargs['txn'] = ctx.transaction.txn
             return func(*args, **kwargs)
-        with args[0]._ctx.env.begin(write=True) as kwargs['txn']:
+        while True:
+            try:
+                with ctx._begin(write=True) as kwargs['txn']:
+                    result = func(*args, **kwargs)
+            except MapFullError:
+                ctx._grow()
+                continue
+            ctx._high_water()
+            return result
+    return wrapped_f
+
+
+def metered(func):
+    """
+    Wrapper for table operations to report their latency to the database's metrics sink (if it
+    has one), generators are measured until they're exhausted or closed
+    """
+    op = func.__name__
+    names = func.__code__.co_varnames[:func.__code__.co_argcount]
+    indexed = names[1] == 'index'
+    traced = 'trace' in names
+
+    def wrapped_f(*args, **kwargs):
+        metrics = args[0]._ctx._metrics
+        if not metrics:
             return func(*args, **kwargs)
+        index = kwargs.get('index', args[1] if len(args) > 1 else None) if indexed else None
+        trace = kwargs.setdefault('trace', {}) if traced else None
+        context = _context(names, args, kwargs) if metrics.detail else None
+        start = time()
+        result = func(*args, **kwargs)
+        if isinstance(result, GeneratorType):
+            return _metered(metrics, op, args[0]._name, index, start, result, trace, context)
+        elapsed = time() - start
+        if trace is None:
+            metrics.operation(op, args[0]._name, index, elapsed, context=context)
+        else:
+            metrics.operation(op, args[0]._name, index, elapsed, trace['scanned'], int(result is not None), context)
+        return result
     return wrapped_f
 
 
 class DBTransaction(object):
     """
     This class is used to wrap LMDB transactions and track changes for the replication system.
+
+    Binlog entries are encoded (ujson) as they happen and buffered up to the configured
+    binlog 'buffer' size, at which point they're flushed into the current write transaction
+    as individual keys of the form <transaction id><sequence>, so the size of a transaction
+    is no longer limited by the amount of memory we can use to hold the log.
+
+    If the binlog lives in it's own environment it gets a write transaction of it's own which
+    is committed immediately after the main transaction. As a crash between the two commits
+    would lose the log entries for that transaction, the main transaction records the id of
+    the last transaction logged (in __metadata__) and the first entry of each transaction in
+    the log carries the id of the one before it ('prv'). Database.entries uses this to detect
+    a missing transaction and raise xBinlogGap rather than quietly skipping it.
+
+    If the map fills up during the transaction the map is grown when the transaction is
+    aborted, but the MapFullError is passed on as it's up to the caller to try again.
     
     :param db: Database handle, should point to our Database instance
     :type db: Database
+    :param log: Whether changes made in this transaction are written to the binlog
+    :type log: bool
     """
-    def __init__(self, db):
-        self.txns = []
-        self._txn = Transaction(db.env, write=True)
+    def __init__(self, db, log=True):
+        self._start = time()
+        self._txn = db._begin(write=True)
+        self._log_txn = None
         self._db = db
+        self._logging = log
+        self._id = None
+        self._seq = 0
+        self._buffer = []
+        self._bytes = 0
 
     def __enter__(self):
         """
@@ -109,16 +187,81 @@ class DBTransaction(object):
         :param traceback: n/a
         :return: n/a
         """
-        if txn_type is None:
-            if self._db._binlog:
-                key = str(ObjectId())
-                doc = {'txn': self.txns}
-                if not self._txn.put(key.encode(), dumps(doc).encode(), db=self._db._binlog, append=True): raise xWriteFail(key)
-            self._txn.commit()
-        else:
-            self._txn.abort()
+        try:
+            if txn_type is None:
+                try:
+                    self.flush()
+                    commit = time()
+                    self._txn.commit()
+                    if self._log_txn:
+                        self._log_txn.commit()
+                except MapFullError:
+                    self._abort()
+                    self._db._grow()
+                    raise
+                except Exception:
+                    self._abort()
+                    raise
+                if self._db._metrics:
+                    now = time()
+                    self._db._metrics.transaction(now - self._start, now - commit)
+                self._db._high_water()
+                if self._id:
+                    self._db._notify()
+            else:
+                self._abort()
+                if issubclass(txn_type, MapFullError):
+                    self._db._grow()
+        finally:
+            self._db.end()
+
+    def _abort(self):
+        """
+        Abort the transaction along with the binlog's transaction (if it has one)
+        """
+        self._txn.abort()
+        if self._log_txn:
+            self._log_txn.abort()
+
+    def flush(self):
+        """
+        Write any buffered binlog entries into the current transaction
+        """
+        db = self._db._binlog
+        if not self._buffer or not db:
+            self._buffer = []
+            self._bytes = 0
+            return
+        txn = self.log_txn
+        for value in self._buffer:
+            key = '{}{:08x}'.format(self._id, self._seq).encode()
+            if not txn.put(key, value, db=db, append=True): raise xWriteFail(key)
+            self._seq += 1
+        self._buffer = []
+        self._bytes = 0
+
+    def _log(self, entry):
+        """
+        Add an entry to the binlog buffer, flushing the buffer if it's full
 
-        self._db.end()
+        :param entry: The binlog entry
+        :type entry: dict
+        """
+        if not self._db._binlog or not self._logging:
+            return
+        if not self._id:
+            self._id = _binlog_id(self.log_txn, self._db._binlog)
+            if self._log_txn:
+                prev = self._txn.get(b'~binlog', db=self._db._metadata)
+                if prev and prev.decode() >= self._id:
+                    self._id = '{:024x}'.format(int(prev, 16) + 1)
+                if not self._txn.put(b'~binlog', self._id.encode(), db=self._db._metadata): raise xWriteFail
+                entry['prv'] = prev.decode() if prev else None
+        value = _binlog_encode(entry)
+        self._buffer.append(value)
+        self._bytes += len(value)
+        if self._bytes >= self._db._binlog_conf['buffer']:
+            self.flush()
 
     def append(self, table, doc):
         """
@@ -129,7 +272,7 @@ class DBTransaction(object):
         :param doc: The record that has been appended
         :type doc: dict
         """
-        self.txns.append({'cmd': 'add', 'tab': table, 'doc': doc})
+        self._log({'cmd': 'add', 'tab': table, 'doc': doc})
 
     def delete(self, table, keys):
         """
@@ -140,7 +283,20 @@ class DBTransaction(object):
         :param keys: A list of keys to delete
         :type keys: list
         """
-        self.txns.append({'cmd': 'del', 'tab': table, 'keys': keys})
+        self._log({'cmd': 'del', 'tab': table, 'keys': keys})
+
+    def delete_range(self, table, lower, upper):
+        """
+        Add the deletion of a range of keys to the transaction
+
+        :param table: Table to operate on
+        :type table: str
+        :param lower: The first key deleted
+        :type lower: bytes
+        :param upper: The last key deleted
+        :type upper: bytes
+        """
+        self._log({'cmd': 'dlr', 'tab': table, 'lo': lower, 'hi': upper})
 
     def drop(self, table):
         """
@@ -149,7 +305,7 @@ class DBTransaction(object):
         :param table: Name of the table to drop
         :type table: str
         """
-        self.txns.append({'cmd': 'drp', 'tab': table})
+        self._log({'cmd': 'drp', 'tab': table})
 
     def empty(self, table):
         """
@@ -158,7 +314,7 @@ class DBTransaction(object):
         :param table: Name of the table to empty
         :type table: str
         """
-        self.txns.append({'cmd': 'emp', 'tab': table})
+        self._log({'cmd': 'emp', 'tab': table})
 
     def update(self, table, key, delta):
         """
@@ -171,9 +327,45 @@ class DBTransaction(object):
         :param delta: Delta of the changes old->new
         :type delta: dict
         """
-        self.txns.append({'cmd': 'upd', 'tab': table, 'key': key, 'yyy': delta})
+        self._log({'cmd': 'upd', 'tab': table, 'key': key, 'yyy': delta})
 
-    def index(self, table, name, func, duplicates):
+    def save(self, table, key, old, rec):
+        """
+        Add a saved record to the transaction, logged as the table's conf['binlog']['updates']
+        representation, see Database
+
+        :param table: Name of the table to update
+        :type table: str
+        :param key: Key of the record to update
+        :type key: str
+        :param old: The record as it was
+        :type old: dict
+        :param rec: The record as saved
+        :type rec: dict
+        """
+        updates = self._db._updates
+        representation = updates.get(table, updates.get('*', 'delta'))
+        if representation == 'fields':
+            self.operators(table, key, _fields_delta(old, rec))
+        elif representation == 'image':
+            self._log({'cmd': 'img', 'tab': table, 'key': key, 'doc': rec})
+        else:
+            self.update(table, key, diff(old, rec, verbose=False))
+
+    def operators(self, table, key, ops):
+        """
+        Add an update (by update operators) to the transaction
+
+        :param table: Name of the table to update
+        :type table: str
+        :param key: Key of the record to update
+        :type key: str
+        :param ops: The update operators, see Table.update
+        :type ops: dict
+        """
+        self._log({'cmd': 'opr', 'tab': table, 'key': key, 'ops': ops})
+
+    def index(self, table, name, func, duplicates, options=None):
         """
         Add an index to the transaction 
         
@@ -185,8 +377,13 @@ class DBTransaction(object):
         :type func: str
         :param duplicates: Whether to allow duplicates
         :type duplicates: bool
+        :param options: Any other options the index was created with, see Index.options
+        :type options: dict
         """
-        self.txns.append({'cmd': 'idx', 'tab': table, 'idx': name, 'fun': func, 'dup': duplicates})
+        entry = {'cmd': 'idx', 'tab': table, 'idx': name, 'fun': func, 'dup': duplicates}
+        if options:
+            entry['opt'] = options
+        self._log(entry)
 
     def unindex(self, table, name):
         """
@@ -197,12 +394,36 @@ class DBTransaction(object):
         :param name: The name of the index to remove
         :type name: str
         """
-        self.txns.append({'cmd': 'uix', 'tab': table, 'idx': name})
+        self._log({'cmd': 'uix', 'tab': table, 'idx': name})
 
     @property
     def txn(self):
         return self._txn
 
+    @property
+    def logging(self):
+        """
+        PROPERTY - Whether changes made in this transaction are written to the binlog
+
+        :getter: True if changes are logged
+        :type: bool
+        """
+        return self._logging and self._db._binlog is not None
+
+    @property
+    def log_txn(self):
+        """
+        PROPERTY - The transaction used to write the binlog
+
+        :getter: The main transaction, or a transaction on the binlog's own environment
+        :type: Transaction
+        """
+        if self._db._log_env is self._db.env:
+            return self._txn
+        if not self._log_txn:
+            self._log_txn = self._db._begin(self._db._log_env, write=True)
+        return self._log_txn
+
 
 class Database(object):
     """
@@ -212,6 +433,27 @@ class Database(object):
     :type name: str
     :param conf: Any additional or custom options for this environment
     :type conf: dict  
+    :param metrics: A metrics sink to report operation latencies to, see pymamba.metrics
+    :type metrics: Metrics
+    :param readonly: Open the database read-only, for processes that only read
+    :type readonly: bool
+
+    A Database opened before a fork is re-opened in the child automatically (Python 3.7+),
+    LMDB handles can't be shared across a fork. In read-only mode the environment is opened
+    without 'writemap', if there are no writers at all conf={'env': {'lock': False}} will
+    avoid the locking overhead too.
+
+    conf['map'] controls how the map grows, when a write fills the map it's resized to 'growth'
+    times it's current size (up to 'limit' bytes, None for no limit) and the write is retried,
+    'warn' is called with (database, path, used, map_size) the first time a commit leaves the
+    map more than 'high_water' full. A growth of None turns automatic growth off. The map can
+    only be resized when this process has no other transactions open, if it has we wait up to
+    'wait' seconds for them to finish, then give up with xMapFull.
+
+    conf['binlog']['updates'] chooses how updates (save) are logged, either for all tables or
+    per table as {table: representation, '*': default}. 'delta' logs a ujson_delta diff ('upd'),
+    'fields' logs the top level fields set and removed as update operators ('opr') and 'image'
+    logs the whole record as saved ('img'). Nothing is computed unless the update is logged.
     """
     _debug = False
     _conf = {
@@ -224,29 +466,114 @@ class Database(object):
         'writemap': True,
         'map_async': True
     }
+    _binlog_conf = {
+        'buffer': 1024*64,
+        'chunk': 1000,
+        'updates': 'delta'
+    }
+    _map_conf = {
+        'growth': 2,
+        'limit': None,
+        'high_water': 0.8,
+        'warn': None,
+        'wait': 1.0
+    }
+    _scan_conf = {
+        'records': 1000,
+        'seconds': 0.1
+    }
 
-    def __init__(self, name, conf=None, binlog=True, size=None):
-        conf = dict(self._conf, **conf.get('env', {})) if conf else self._conf
-        if size: conf['map_size'] = size
+    def __init__(self, name, conf=None, binlog=True, size=None, metrics=None, readonly=False):
+        self._binlog_conf = dict(self._binlog_conf, **conf.get('binlog', {})) if conf else self._binlog_conf
+        updates = self._binlog_conf['updates']
+        self._updates = dict(updates) if isinstance(updates, dict) else {'*': updates}
+        unknown = set(self._updates.values()) - {'delta', 'fields', 'image'}
+        if unknown: raise ValueError('unknown update representation: {}'.format(', '.join(sorted(unknown))))
+        self._map_conf = dict(self._map_conf, **conf.get('map', {})) if conf else self._map_conf
+        self._scan_conf = dict(self._scan_conf, **conf.get('scan', {})) if conf else self._scan_conf
+        conf = dict(self._conf, **conf.get('env', {})) if conf else dict(self._conf)
+        if size: conf['map_size'] = int(size)
+        if readonly: conf.update(readonly=True, writemap=False, map_async=False)
+        self._name = name
+        self._readonly = readonly
+        self._warned = {}
+        self._metrics = metrics
         self._tables = {}
+        self._env_conf = conf
         self._env = Environment(name, **conf)
+        self._log_env = Environment(self._binlog_conf['path'], **conf) if 'path' in self._binlog_conf else self._env
+        log_path = self._log_env.path()
+        self._watch_path = path.join(log_path, 'watch') if conf['subdir'] else log_path + '-watch'
+        self._local = local()
+        self._forked = False
+        self._open_handles(binlog)
+        self.reader_check()
+        _databases.add(self)
+
+    def _open_handles(self, binlog):
+        """
+        Open the main, binlog and metadata databases, then load the index definitions
+
+        :param binlog: Whether to create the binlog if it doesn't exist
+        :type binlog: bool
+        """
         self._db = self._env.open_db()
-        self._transaction = None
         try:
-            self._binlog = self.env.open_db('__binlog__'.encode(), create=binlog)
+            self._binlog = self._log_env.open_db('__binlog__'.encode(), create=binlog and not self._readonly)
         except NotFoundError:
             self._binlog = None
         try:
             self._metadata = self.env.open_db('__metadata__'.encode(), create=False)
         except NotFoundError:
-            self.migrate_metadata()
+            if self._readonly:
+                self._metadata = None
+            else:
+                self.migrate_metadata()
+        self._version = None
+        self._definitions = {}
+        with self._begin() as txn:
+            self._load_definitions(txn)
+
+    def _load_definitions(self, txn):
+        """
+        Make sure our cache of index definitions is up to date, the cache is reloaded (in one
+        pass over __metadata__) whenever the version stamp (~version) has changed.
+
+        :param txn: An open transaction
+        :type txn: Transaction
+        :return: Index definitions by metadata key
+        :rtype: dict
+        """
+        if self._metadata is None:
+            return self._definitions
+        version = txn.get(b'~version', db=self._metadata)
+        version = bytes(version) if version else None
+        if version != self._version or not self._version:
+            definitions = {}
+            with Cursor(self._metadata, txn) as cursor:
+                found = cursor.set_range(b'_')
+                while found and cursor.key()[:1] == b'_':
+                    definitions[cursor.key().decode()] = loads(bytes(cursor.value()))
+                    found = cursor.next()
+            self._definitions = definitions
+            self._version = version
+        return self._definitions
+
+    def _bump_version(self, txn):
+        """
+        Record a change to the index definitions, anyone caching them will reload them
+
+        :param txn: An open write transaction
+        :type txn: Transaction
+        """
+        if not txn.put(b'~version', str(ObjectId()).encode(), db=self._metadata): raise xWriteFail('~version')
 
     def __del__(self):
         self.close()
 
     def migrate_metadata(self):
         self._metadata = self.env.open_db('__metadata__'.encode(), create=True)
-        with self.env.begin(write=True) as txn:
+        with self._begin(write=True) as txn:
             with Cursor(self._db, txn) as cursor:
                 move_next = cursor.first
                 while move_next():
@@ -270,6 +597,8 @@ class Database(object):
         :return: A Database Environment
         :rtype: Environment
         """
+        if self._forked:
+            self._adopt()
         return self._env
 
     @property
@@ -282,6 +611,20 @@ class Database(object):
         """
         return self._transaction
 
+    @property
+    def _transaction(self):
+        """
+        PROPERTY - The current transaction, each thread has it's own
+
+        :getter: The current transaction (or None)
+        :type: DBTransaction
+        """
+        return getattr(self._local, 'transaction', None)
+
+    @_transaction.setter
+    def _transaction(self, value):
+        self._local.transaction = value
+
     def binlog(self, enable=True):
         """
         Enable or disable binary logging, disable with delete the transaction history too ...
@@ -290,24 +633,417 @@ class Database(object):
         """
         if enable:
             if not self._binlog:
-                self._binlog = self.env.open_db('__binlog__'.encode())
+                self._binlog = self._log_env.open_db('__binlog__'.encode())
         else:
             if self._binlog:
                 if self.transaction:
-                    self.transaction.txn.drop(self._binlog, True)
+                    self.transaction.log_txn.drop(self._binlog, True)
                 else:
-                    with self.env.begin(write=True) as txn:
+                    with self._begin(self._log_env, write=True) as txn:
                         txn.drop(self._binlog, True)
 
             self._binlog = None
 
-    def begin(self):
+    def entries(self, since=None):
+        """
+        Generate the entries held in the binlog, oldest first, as (transaction id, entry) tuples.
+        Entries are read one at a time so the size of a transaction doesn't matter.
+
+        :param since: Only return transactions logged after this transaction id
+        :type since: str
+        :return: The next transaction id and entry (generator)
+        :rtype: tuple
+        :raises: xBinlogGap if a transaction is missing from the log
+        """
+        return _binlog_chain(since, ((tid, _binlog_decode(value)) for tid, value in self._scan(since)))
+
+    def _scan(self, since=None):
+        """
+        Generate the raw (encoded) entries held in the binlog, see entries
+
+        :param since: Only return transactions logged after this transaction id
+        :type since: str
+        :return: The next transaction id and encoded entry (generator)
+        :rtype: tuple
+        """
+        if not self._binlog:
+            return
+        txn = self._begin(self._log_env)
+        try:
+            with Cursor(self._binlog, txn) as cursor:
+                found = cursor.set_range((since + '~').encode()) if since else cursor.first()
+                while found:
+                    key = cursor.key()
+                    tid = key[:24].decode()
+                    if len(key) == 24:
+                        for entry in loads(bytes(cursor.value()))['txn']:
+                            yield tid, dumps(entry).encode()
+                    else:
+                        yield tid, cursor.value()
+                    found = cursor.next()
+        finally:
+            txn.abort()
+
+    def tail(self):
+        """
+        Recover the id of the last transaction in the binlog
+
+        :return: A transaction id or None
+        :rtype: str
+        """
+        if not self._binlog:
+            return None
+        with self._begin(self._log_env) as txn:
+            with Cursor(self._binlog, txn) as cursor:
+                return cursor.key()[:24].decode() if cursor.last() else None
+
+    def watch(self, since=None, tables=None, ops=None, wait=True, timeout=None):
+        """
+        Watch the binlog for committed changes, see Watcher
+
+        :param since: Start after this transaction id, None for new changes only, '' for everything
+        :type since: str
+        :param tables: Only report changes to these tables
+        :type tables: list
+        :param ops: Only report these operations, i.e. ['add', 'upd', 'opr', 'del']
+        :type ops: list
+        :param wait: Whether to wait for new changes once we've caught up
+        :type wait: bool
+        :param timeout: How long to wait (seconds) before giving up, None to wait forever
+        :type timeout: float
+        :return: A watcher that generates changes when iterated
+        :rtype: Watcher
+        """
+        return Watcher(self, since, tables, ops, wait, timeout)
+
+    def _notify(self):
+        """
+        Wake up anyone watching the binlog, each watcher owns a FIFO in our 'watch' folder
+        """
+        try:
+            names = listdir(self._watch_path)
+        except OSError:
+            return
+        for name in names:
+            fifo = path.join(self._watch_path, name)
+            try:
+                fd = os_open(fifo, O_WRONLY | O_NONBLOCK)
+            except OSError as error:
+                if error.errno == ENXIO:
+                    unlink(fifo)    # nobody is reading, the watcher is no longer with us
+                continue
+            try:
+                write(fd, b'!')
+            except BlockingIOError:
+                pass                # the watcher already has a wakeup pending
+            finally:
+                close(fd)
+
+    def purge(self, until=None, age=None, entries=None, size=None, chunk=None):
+        """
+        Remove old transactions from the binlog. With no arguments the retention policy held in
+        conf['binlog'] ('age', 'entries' and/or 'size') is applied. A checkpoint ('until') on it's
+        own removes everything up to and including that transaction, combined with a policy it
+        stops the purge going past the checkpoint. Only whole transactions are removed, this is
+        done in chunks of 'chunk' entries, each with it's own write transaction (unless we're
+        inside a transaction already, in which case that's used instead). A chunk always ends
+        on a transaction boundary, so a transaction larger than 'chunk' is removed in one go.
+
+        :param until: A transaction id (typically a consumer's checkpoint)
+        :type until: str
+        :param age: Remove transactions older than this (seconds)
+        :type age: int
+        :param entries: Keep no more than this many entries
+        :type entries: int
+        :param size: Keep no more than (roughly) this many bytes
+        :type size: int
+        :param chunk: The maximum number of entries to remove per write transaction
+        :type chunk: int
+        :return: The number of entries removed
+        :rtype: int
+        """
+        if not self._binlog:
+            return 0
+        if until is None and age is None and entries is None and size is None:
+            age, entries, size = (self._binlog_conf.get(k) for k in ['age', 'entries', 'size'])
+        bound = self._purge_bound(age, entries, size)
+        if until:
+            bound = min(bound, until + '~') if bound else until + '~'
+        if not bound:
+            return 0
+        bound = bound.encode()
+        if self.transaction:
+            return _purge(self.transaction.log_txn, self._binlog, bound, maxsize)
+        chunk = chunk or self._binlog_conf['chunk']
+        count = 0
+        while True:
+            with self._begin(self._log_env, write=True) as txn:
+                removed = _purge(txn, self._binlog, bound, chunk)
+            count += removed
+            if not removed:
+                return count
+
+    def _purge_bound(self, age, entries, size):
+        """
+        Work out the (exclusive) key up to which a retention policy will purge the binlog
+
+        :param age: Remove transactions older than this (seconds)
+        :type age: int
+        :param entries: Keep no more than this many entries
+        :type entries: int
+        :param size: Keep no more than (roughly) this many bytes
+        :type size: int
+        :return: The bound, or None if there's nothing to purge
+        :rtype: str
+        """
+        bounds = []
+        if age is not None:
+            bounds.append(str(ObjectId.from_datetime(datetime.fromtimestamp(time() - age, timezone.utc))))
+        if entries is not None or size is not None:
+            with self._begin(self._log_env, buffers=True) as txn:
+                stat = txn.stat(self._binlog)
+                excess = stat['entries'] - entries if entries is not None else 0
+                if size is not None and stat['entries']:
+                    extra = _stat_bytes(stat) - size
+                    if extra > 0:
+                        # size is page based, so work in entries using the average page use per entry
+                        per_entry = _stat_bytes(stat) / stat['entries']
+                        excess = max(excess, int(ceil(extra / per_entry)))
+                last = None
+                with Cursor(self._binlog, txn) as cursor:
+                    found = cursor.first()
+                    while found and excess > 0:
+                        last = bytes(cursor.key())
+                        excess -= 1
+                        found = cursor.next()
+                if last:
+                    bounds.append(last[:24].decode() + '~')
+        return max(bounds) if bounds else None
+
+    def apply(self, entries):
+        """
+        Apply binlog entries (as generated by 'entries') to this database, this will happen
+        within the current transaction if there is one. Indexes whose definition differs from
+        the one in the log are recreated, any other sign that we've diverged from the source of
+        the log raises xReplicaFail.
+
+        :param entries: The entries to apply
+        :type entries: iterable
+        :raises: xReplicaFail if the entries don't match the state of this database
+        """
+        for entry in entries:
+            cmd = entry['cmd']
+            name = entry['tab']
+            if cmd == 'drp':
+                if name not in self.tables_all: raise xReplicaFail('drop, no table: {}'.format(name))
+                self.drop(name)
+                continue
+            table = self.table(name)
+            if cmd == 'add':
+                table.append(entry['doc'])
+            elif cmd == 'upd':
+                doc = table.get(entry['key'])
+                if not doc: raise xReplicaFail('update, no record: {}'.format(entry['key']))
+                doc = patch(doc, entry['yyy'])
+                doc['_id'] = entry['key']
+                table.save(doc)
+            elif cmd == 'img':
+                if not table.get(entry['key']): raise xReplicaFail('update, no record: {}'.format(entry['key']))
+                table.save(dict(entry['doc'], _id=entry['key']))
+            elif cmd == 'opr':
+                if not table.update(entry['key'], entry['ops']):
+                    raise xReplicaFail('update, no record: {}'.format(entry['key']))
+            elif cmd == 'del':
+                table.delete(entry['keys'])
+            elif cmd == 'dlr':
+                table.delete_range(None, {'_id': entry['lo']}, {'_id': entry['hi']})
+            elif cmd == 'emp':
+                table.empty()
+            elif cmd == 'idx':
+                index = table._indexes.get(entry['idx'])
+                options = entry.get('opt', {})
+                if index and (index.func != entry['fun'] or index.duplicates != entry['dup'] or
+                              index.options != options):
+                    table.drop_index(entry['idx'])
+                table.index(entry['idx'], entry['fun'], entry['dup'], **options)
+            elif cmd == 'uix':
+                if not table.exists(entry['idx']): raise xReplicaFail('unindex, no index: {}'.format(entry['idx']))
+                table.drop_index(entry['idx'])
+
+    def replay(self, source, until=None, since=None, batch=10000, progress=None):
+        """
+        Point-in-time restore, apply the binlog of 'source' to this database (typically a copy
+        restored from a backup) up to and including the transaction 'until'. Transactions are
+        applied in large write transactions of (roughly) 'batch' entries, index maintenance is
+        deferred while we replay and the indexes of every table we touch are rebuilt in a single
+        pass at the end. Replayed changes are not written to our own binlog, instead the last
+        transaction applied is kept in __metadata__ (~replay) so an interrupted replay will pick
+        up where it left off (rebuilding any indexes it had deferred) when called again.
+
+        :param source: The source of the binlog, a Database or a SocketSource
+        :type source: Database|SocketSource
+        :param until: The last transaction to apply, an id, datetime or time() (None for everything)
+        :type until: str|datetime|float
+        :param since: Start after this transaction id, the default is the last transaction we
+            replayed or, failing that, the last transaction in our own binlog (i.e. the backup)
+        :type since: str
+        :param batch: The number of entries to apply per write transaction
+        :type batch: int
+        :param progress: A function to call with our progress (as returned) after each batch
+        :type progress: function
+        :return: transactions, entries, checkpoint (the last transaction applied) and elapsed
+        :rtype: dict
+        """
+        with self._begin() as txn:
+            value = txn.get(b'~replay', db=self._metadata)
+        state = loads(bytes(value)) if value else {'since': self.tail(), 'reindex': []}
+        checkpoint = since or state['since']
+        bound = _replay_bound(until)
+        deferred = set(state['reindex'])
+        start = time()
+        stats = {'transactions': 0, 'entries': 0, 'checkpoint': checkpoint, 'elapsed': 0.0}
+
+        def defer(name):
+            self.table(name)._deferred = True
+            deferred.add(name)
+
+        try:
+            for name in deferred & set(self.tables_all):
+                defer(name)
+            while True:
+                applied = count = 0
+                entries = source.entries(checkpoint)
+                try:
+                    with self.begin(log=False) as transaction:
+                        for tid, entry in entries:
+                            if tid != checkpoint:
+                                if count >= batch or (bound and tid >= bound):
+                                    break
+                                checkpoint = tid
+                                applied += 1
+                            if entry['cmd'] != 'drp':
+                                defer(entry['tab'])
+                            self.apply([entry])
+                            count += 1
+                        if applied:
+                            state = {'since': checkpoint, 'reindex': sorted(deferred)}
+                            if not transaction.txn.put(b'~replay', dumps(state).encode(), db=self._metadata):
+                                raise xWriteFail('unable to write checkpoint')
+                finally:
+                    entries.close()
+                if not applied:
+                    break
+                stats['transactions'] += applied
+                stats['entries'] += count
+                stats['checkpoint'] = checkpoint
+                stats['elapsed'] = time() - start
+                if progress:
+                    progress(dict(stats))
+
+            with self.begin(log=False) as transaction:
+                names = self.tables_all
+                for name in sorted(deferred):
+                    if name in names:
+                        table = self.table(name)
+                        table._deferred = False
+                        table.reindex()
+                state = {'since': checkpoint, 'reindex': []}
+                if not transaction.txn.put(b'~replay', dumps(state).encode(), db=self._metadata):
+                    raise xWriteFail('unable to write checkpoint')
+        finally:
+            for table in self._tables.values():
+                table._deferred = False
+        stats['elapsed'] = time() - start
+        return stats
+
+    def _begin(self, env=None, **kwargs):
+        """
+        Begin an LMDB transaction, adopting the new map size if another process has grown the map
+
+        :param env: The environment to use, the default is our main environment
+        :type env: Environment
+        :return: A new transaction
+        :rtype: Transaction
+        """
+        if self._forked:
+            log = env is not None and env is self._log_env
+            self._adopt()
+            env = self._log_env if log else None
+        env = env or self._env
+        try:
+            return env.begin(**kwargs)
+        except MapResizedError:
+            self._quiesce(env, 'the map was resized by another process')
+            env.set_mapsize(0)
+            return env.begin(**kwargs)
+
+    def _quiesce(self, env, reason):
+        """
+        Wait for this process's read transactions on an environment to finish, the map can't be
+        resized while any are open (i.e. a find() generator that hasn't finished)
+
+        :param env: The environment we want to resize
+        :type env: Environment
+        :param reason: Why we want to resize it, for the exception
+        :type reason: str
+        :raises: xMapFull if there are still transactions open after conf['map']['wait'] seconds
+        """
+        give_up = time() + self._map_conf['wait']
+        while _readers(env):
+            if time() >= give_up:
+                raise xMapFull('{}, but this process has transactions open'.format(reason))
+            sleep(0.01)
+
+    def _grow(self):
+        """
+        Grow the map of any environment that's over the high water mark (i.e. the one that
+        filled up), there must be no other transactions active in this process when we do this
+        so we wait for them (see _quiesce). Other processes pick up the new size when their next
+        transaction fails with MapResized.
+
+        :raises: xMapFull if automatic growth is off, the map has reached it's limit or other
+            transactions are still open
+        """
+        growth = self._map_conf['growth']
+        limit = self._map_conf['limit']
+        if not growth:
+            raise xMapFull('automatic growth is disabled')
+        envs = [self._env] if self._log_env is self._env else [self._env, self._log_env]
+        usage = [(env, _map_used(env), env.info()['map_size']) for env in envs]
+        full = [(env, size) for env, used, size in usage if used >= size * self._map_conf['high_water']]
+        for env, size in full or [(env, size) for env, used, size in usage]:
+            if limit and size >= limit:
+                raise xMapFull('map size limit reached: {}'.format(limit))
+            psize = env.stat()['psize']
+            size = int(size * growth) // psize * psize + psize
+            self._quiesce(env, 'the map is full')
+            env.set_mapsize(min(size, limit) if limit else size)
+
+    def _high_water(self):
+        """
+        Call the 'warn' hook if the map is over the high water mark, once for each map size
+        """
+        warn = self._map_conf['warn']
+        if not warn:
+            return
+        envs = [self._env] if self._log_env is self._env else [self._env, self._log_env]
+        for env in envs:
+            size = env.info()['map_size']
+            used = _map_used(env)
+            if used >= size * self._map_conf['high_water'] and self._warned.get(env.path()) != size:
+                self._warned[env.path()] = size
+                warn(self, env.path(), used, size)
+
+    def begin(self, log=True):
         """
         Begin a new transaction returning a transaction reference (use with "with")
+
+        :param log: Whether changes made in this transaction are written to the binlog
+        :type log: bool
         :return: Reference to the new transaction
         :rtype: DBTransaction
         """
-        self._transaction = DBTransaction(self)
+        self._transaction = DBTransaction(self, log)
         return self._transaction
 
     def end(self):
@@ -320,10 +1056,215 @@ class Database(object):
         """
         Close the current database
         """
-        if self._env:
+        _databases.discard(self)
+        if getattr(self, '_forked', False):
+            self._env = None
+        if getattr(self, '_env', None):
+            if self._log_env is not self._env:
+                self._log_env.close()
             self._env.close()
             self._env = None
 
+    def stats(self):
+        """
+        Storage statistics for the database as a whole, figures from env.info() along with
+        stats for each table, the metadata and the binlog. Pages not used by any table, index
+        or other database are reported as free, these are the pages a compact would recover.
+
+        :return: map_size, used, usage (fraction of the map used), last_pgno, last_txnid,
+            readers, max_readers, psize, pages, free_pages, free (bytes), tables, metadata, binlog
+        :rtype: dict
+        """
+        tables = [self.table(name) for name in self.tables]
+        with self._begin() as txn:
+            info = self._env.info()
+            result = {
+                'map_size': info['map_size'],
+                'last_pgno': info['last_pgno'],
+                'last_txnid': info['last_txnid'],
+                'readers': info['num_readers'],
+                'max_readers': info['max_readers'],
+                'tables': {table.name: table.stats(txn=txn) for table in tables},
+                'metadata': _stats(txn.stat(self._metadata)),
+                'binlog': None
+            }
+            stats = _stats(txn.stat(self._db))
+            in_use = _stat_pages(stats)
+            psize = stats['psize']
+            if self._binlog and self._log_env is self._env:
+                result['binlog'] = _stats(txn.stat(self._binlog))
+        if self._binlog and self._log_env is not self._env:
+            with self._begin(self._log_env) as txn:
+                result['binlog'] = _stats(txn.stat(self._binlog))
+        else:
+            in_use += _stat_pages(result['binlog'])
+        in_use += _stat_pages(result['metadata'])
+        for table in result['tables'].values():
+            in_use += _stat_pages(table)
+            for index in table['indexes'].values():
+                in_use += _stat_pages(index)
+        pages = info['last_pgno'] + 1
+        free = max(pages - in_use - 2, 0)     # 2 meta pages
+        result.update({
+            'psize': psize,
+            'pages': pages,
+            'used': pages * psize,
+            'usage': pages * psize / info['map_size'],
+            'free_pages': free,
+            'free': free * psize
+        })
+        return result
+
+    def backup(self, destination, compact=True, progress=None):
+        """
+        Take a hot backup of this database, the copy is a consistent snapshot taken with a read
+        transaction so writers carry on as normal. With 'compact' free pages are omitted from
+        the copy and the B-trees are rewritten, so the copy is often much smaller than the
+        original. If the binlog has it's own environment it isn't included.
+
+        :param destination: The folder (or file if we're not using 'subdir') to write the copy to
+        :type destination: str
+        :param compact: Whether to compact the copy
+        :type compact: bool
+        :param progress: A function to call with our progress (as returned) as the copy is written
+        :type progress: function
+        :return: bytes (written), elapsed (seconds) and rate (bytes per second)
+        :rtype: dict
+        """
+        if self._env_conf['subdir']:
+            makedirs(destination, exist_ok=True)
+            destination = path.join(destination, 'data.mdb')
+        stats = {'bytes': 0, 'elapsed': 0.0, 'rate': 0.0}
+        errors = []
+        start = time()
+
+        def writer(fd):
+            with open(fd, 'rb') as src, open(destination, 'wb') as dst:
+                while True:
+                    chunk = src.read(1024*1024)
+                    if not chunk:
+                        break
+                    if errors:
+                        continue    # keep draining the pipe so the copy can finish
+                    try:
+                        dst.write(chunk)
+                    except OSError as error:
+                        errors.append(error)
+                        continue
+                    stats['bytes'] += len(chunk)
+                    stats['elapsed'] = time() - start
+                    stats['rate'] = stats['bytes'] / stats['elapsed'] if stats['elapsed'] else 0.0
+                    if progress:
+                        progress(dict(stats))
+
+        rfd, wfd = pipe()
+        thread = Thread(target=writer, args=(rfd,))
+        thread.start()
+        try:
+            self.env.copyfd(wfd, compact=compact)
+        finally:
+            close(wfd)
+            thread.join()
+        if errors:
+            raise errors[0]
+        stats['elapsed'] = time() - start
+        stats['rate'] = stats['bytes'] / stats['elapsed'] if stats['elapsed'] else 0.0
+        return stats
+
+    def compact(self, progress=None):
+        """
+        Compact this database in place, a compacted copy is written alongside the database which
+        then replaces it and the database is re-opened. Writers are locked out while the copy is
+        taken, but this is only safe for single-process deployments as other processes will
+        carry on using the old file, and nothing else in this process should be writing to the
+        database as it's re-opened.
+
+        :param progress: A function to call with our progress as the copy is written, see backup
+        :type progress: function
+        :return: before and after (bytes in use) along with the stats from backup
+        :rtype: dict
+        :raises: xCompactFail if there is a transaction in progress
+        """
+        if self.transaction: raise xCompactFail('compact inside a transaction')
+        source = self.env.path()
+        if self._env_conf['subdir']:
+            filename = path.join(source, 'data.mdb')
+            temp = source.rstrip('/') + '-compact'
+            copy = path.join(temp, 'data.mdb')
+        else:
+            filename = source
+            temp = copy = source + '-compact'
+        before = _map_used(self._env)
+        with self._begin(write=True):
+            stats = self.backup(temp, True, progress)
+            replace(copy, filename)
+            map_size = self._env.info()['map_size']
+        if temp != copy:
+            rmdir(temp)
+        self._env.close()
+        self._reopen(map_size, log=False)
+        return dict(stats, before=before, after=_map_used(self._env))
+
+    def _reopen(self, map_size=None, log=True):
+        """
+        Open our environment again and refresh every handle we hold, tables and indexes included
+
+        :param map_size: The map size to use, the default is the size we were opened with
+        :type map_size: int
+        :param log: Whether to reopen a separate binlog environment too
+        :type log: bool
+        """
+        conf = dict(self._env_conf, map_size=map_size) if map_size else self._env_conf
+        shared = self._log_env is self._env
+        self._env = Environment(self._name, **conf)
+        if shared:
+            self._log_env = self._env
+        elif log:
+            self._log_env = Environment(self._binlog_conf['path'], **conf)
+        self._open_handles(self._binlog is not None)
+        for table in self._tables.values():
+            table._indexes = {}
+        if self._readonly:
+            for table in self._tables.values():
+                table._open_()
+        elif self._tables:
+            with self._begin(write=True) as txn:
+                for table in self._tables.values():
+                    table._open_write(txn=txn)
+
+    def _after_fork(self):
+        """
+        We're in a child process, LMDB handles can't be used across a fork so we need new ones.
+        These are opened when the child first uses this database (see _adopt), a child that never
+        does takes no locks. The parent's handles are kept (but never used) as closing them
+        would clear the parent's reader slots.
+        """
+        _inherited.extend([self._env, self._log_env])
+        self._transaction = None
+        self._forked = True
+
+    def _adopt(self):
+        """
+        Open new handles in a child process the first time it uses this database, see _after_fork
+        """
+        self._forked = False
+        self._reopen()
+        self.reader_check()
+
+    def reader_check(self):
+        """
+        Release reader slots held by processes that have died, stale readers stop LMDB from
+        reusing the pages they can see so the file grows. This happens automatically when a
+        database is opened (or re-opened after a fork).
+
+        :return: The number of stale readers released
+        :rtype: int
+        """
+        count = self._env.reader_check()
+        if self._log_env is not self._env:
+            count += self._log_env.reader_check()
+        return count
+
     def sync(self, force=False):
         self.env.sync(force)
 
@@ -357,7 +1298,7 @@ class Database(object):
             txn = self.transaction.txn
             abort = False
         else:
-            txn = self.env.begin()
+            txn = self._begin()
             abort = True
 
         try:
@@ -429,6 +1370,144 @@ class Database(object):
         return self._tables[name]
 
 
+class Watcher(object):
+    """
+    A change feed for a database, iterating a watcher generates changes as they're committed
+    to the binlog. Each change is a binlog entry with the id of it's transaction added as 'txn'.
+    Instead of polling, the watcher creates a FIFO in the database's 'watch' folder which
+    writers signal (from any process) each time they commit. For use with asyncio, use poll()
+    to collect pending changes and wait_async() to wait for more.
+
+    :param db: The database to watch
+    :type db: Database
+    :param since: Start after this transaction id, None for new changes only, '' for everything
+    :type since: str
+    :param tables: Only report changes to these tables
+    :type tables: list
+    :param ops: Only report these operations, i.e. ['add', 'upd', 'del']
+    :type ops: list
+    :param wait: Whether to wait for new changes once we've caught up
+    :type wait: bool
+    :param timeout: How long to wait (seconds) before giving up, None to wait forever
+    :type timeout: float
+    """
+    def __init__(self, db, since=None, tables=None, ops=None, wait=True, timeout=None):
+        self._db = db
+        self._tables = set(tables) if tables else None
+        self._ops = set(ops) if ops else None
+        self._wait = wait
+        self._timeout = timeout
+        makedirs(db._watch_path, exist_ok=True)
+        self._fifo = path.join(db._watch_path, '{}-{}'.format(getpid(), ObjectId()))
+        mkfifo(self._fifo, 0o600)
+        # we hold the write side open too, otherwise the FIFO reports EOF after each wakeup
+        self._fd = os_open(self._fifo, O_RDWR | O_NONBLOCK)
+        self._since = (db.tail() or '') if since is None else since
+
+    def __del__(self):
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, txn_type, txn_value, traceback):
+        self.close()
+
+    def __iter__(self):
+        while True:
+            for change in self.poll():
+                yield change
+            if not self._wait or not self.wait(self._timeout):
+                return
+
+    def close(self):
+        """
+        Stop watching, this removes our FIFO
+        """
+        if getattr(self, '_fd', None) is not None:
+            close(self._fd)
+            self._fd = None
+            try:
+                unlink(self._fifo)
+            except OSError as error:
+                if error.errno != ENOENT: raise
+
+    @property
+    def checkpoint(self):
+        """
+        PROPERTY - The id of the last transaction we've processed, use as 'since' to resume
+
+        :getter: A transaction id
+        :type: str
+        """
+        return self._since
+
+    def fileno(self):
+        """
+        The file descriptor that becomes readable when changes are committed
+
+        :return: A file descriptor
+        :rtype: int
+        """
+        return self._fd
+
+    def poll(self):
+        """
+        Generate any changes committed since we last looked, without waiting
+
+        :return: The next change (generator)
+        :rtype: dict
+        """
+        self._drain()
+        last = None
+        for tid, entry in self._db.entries(self._since):
+            if tid != last:
+                if last:
+                    self._since = last
+                last = tid
+            if self._tables and entry.get('tab') not in self._tables:
+                continue
+            if self._ops and entry['cmd'] not in self._ops:
+                continue
+            entry['txn'] = tid
+            yield entry
+        if last:
+            self._since = last
+
+    def wait(self, timeout=None):
+        """
+        Wait for a writer to commit a transaction
+
+        :param timeout: How long to wait (seconds), None to wait forever
+        :type timeout: float
+        :return: True if there was a commit, False if we timed out
+        :rtype: bool
+        """
+        return bool(select([self._fd], [], [], timeout)[0])
+
+    async def wait_async(self):
+        """
+        Wait for a writer to commit a transaction (asyncio)
+        """
+        loop = get_event_loop()
+        future = loop.create_future()
+        loop.add_reader(self._fd, lambda: future.done() or future.set_result(True))
+        try:
+            await future
+        finally:
+            loop.remove_reader(self._fd)
+
+    def _drain(self):
+        """
+        Clear any pending wakeups, we do this before reading so a new commit is never missed
+        """
+        try:
+            while read(self._fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+
 class Table(object):
     """
     Representation of a database table
@@ -444,17 +1523,65 @@ class Table(object):
         self._ctx = ctx
         self._name = name
         self._indexes = {}
+        self._deferred = False
         self._open_()
 
+    def _open_(self):
+        """
+        Open this table and it's indexes, in read-only mode the table must already exist
+
+        :raises: xTableMissing if we're read-only and the table doesn't exist
+        """
+        if not self._ctx._readonly:
+            return self._open_write()
+        try:
+            self._db = self._ctx.env.open_db(self._name.encode(), create=False)
+        except NotFoundError:
+            raise xTableMissing(self._name)
+        with self._ctx._begin() as txn:
+            definitions = self._ctx._load_definitions(txn)
+        self._open_indexes(definitions, None)
+
     @write_transaction
-    def _open_(self, txn):
+    def _open_write(self, txn):
         self._db = self._ctx.env.open_db(self._name.encode(), txn=txn)
-        for index in self.indexes:
-            key = _index_name(self, index).encode()
-            doc = loads(bytes(txn.get(key, db=self._ctx._metadata)))
-            self._indexes[index] = Index(self._ctx, index, doc['func'], doc['conf'], txn)
+        self._open_indexes(self._ctx._load_definitions(txn), txn)
+
+    def _open_indexes(self, definitions, txn):
+        """
+        Open our indexes from their (cached) definitions
+
+        :param definitions: Index definitions by metadata key
+        :type definitions: dict
+        :param txn: A write transaction, or None if we're read-only
+        :type txn: Transaction
+        """
+        prefix = _index_name(self, '')
+        for key, doc in definitions.items():
+            if key.startswith(prefix):
+                index = key[len(prefix):]
+                conf = dict(doc['conf'], create=False) if txn is None else dict(doc['conf'])
+                self._indexes[index] = _index_class(conf)(self._ctx, index, doc['func'], conf, txn)
+
+    def watch(self, since=None, ops=None, wait=True, timeout=None):
+        """
+        Watch this table for committed changes, see Database.watch
+
+        :param since: Start after this transaction id, None for new changes only, '' for everything
+        :type since: str
+        :param ops: Only report these operations, i.e. ['add', 'upd', 'del']
+        :type ops: list
+        :param wait: Whether to wait for new changes once we've caught up
+        :type wait: bool
+        :param timeout: How long to wait (seconds) before giving up, None to wait forever
+        :type timeout: float
+        :return: A watcher that generates changes when iterated
+        :rtype: Watcher
+        """
+        return self._ctx.watch(since, [self._name], ops, wait, timeout)
 
     @write_transaction
+    @metered
     def append(self, record, txn=None):
         """
         Append a new record to this table
@@ -465,7 +1592,8 @@ class Table(object):
         :type txn: Transaction
         :raises: xWriteFail on write error
         """
-        if not '_id' in record:
+        generated = '_id' not in record
+        if generated:
             key = str(ObjectId())
         else:
             key = record['_id']
@@ -473,15 +1601,26 @@ class Table(object):
                 key = str(key)
             else:
                 key = str(key.decode())
-        if not txn.put(key.encode(), dumps(record).encode(), db=self._db, append=True): raise xWriteFail(key)
+        value = dumps(record).encode()
+        #
+        #   Keys generated by another process (or a forked child) can sort before our last key
+        #   within the same second, in which case we fall back to a normal (but slower) insert.
+        #   This includes our own key when a write is retried after the map has grown.
+        #
+        if not txn.put(key.encode(), value, db=self._db, append=True):
+            if not (generated or ObjectId.is_valid(key)) or \
+                    not txn.put(key.encode(), value, db=self._db, overwrite=False):
+                raise xWriteFail(key)
         record['_id'] = key.encode()
-        for name in self._indexes:
-            if not self._indexes[name].put(txn, key, record): raise xWriteFail(name)
+        if not self._deferred:
+            for name in self._indexes:
+                if not self._indexes[name].put(txn, key, record): raise xWriteFail(name)
 
         if self._ctx.transaction:
             self._ctx.transaction.append(self._name, record)
 
     @write_transaction
+    @metered
     def delete(self, keys, txn):
         """
         Delete a record from this table
@@ -500,27 +1639,235 @@ class Table(object):
         for key in keys:
             doc = loads(bytes(txn.get(key, db=self._db)))
             if not txn.delete(key, db=self._db): raise xWriteFail
+            if self._deferred:
+                continue
             for name in self._indexes:
                 if not self._indexes[name].delete(txn, key, doc): raise xWriteFail
 
         if self._ctx.transaction:
             self._ctx.transaction.delete(self._name, keys)
 
-    @write_transaction
-    def _drop(self, txn):
-        """
-        Drop this tablex and all it's indecies
-
-        :param delete: Whether we delete the table after removing all items
-        :type delete: bool
-        :param txn: An optional transaction
-        :type txn: Transaction
+    def delete_range(self, index, lower=None, upper=None, inclusive=True, chunk_size=1000):
         """
-        for name in self.indexes:
-            self._unindex(name, txn)
-        if self._ctx.transaction:
-            self._ctx.transaction.drop(self._name)
-        return txn.drop(self._db, True)
+        Delete all records with a key >= lower and <= upper, see range. Records are deleted as
+        we walk the table (or index) in chunks of 'chunk_size' records, each with it's own write
+        transaction, unless we're called inside a transaction in which case everything is
+        deleted in that transaction. Ranges of keys (no index) are logged as a single range
+        deletion per chunk.
+
+        :param index: The name of the index to use, None to delete by key
+        :type index: str
+        :param lower: A template record containing the lower end of the range
+        :type lower: dict
+        :param upper: A template record containing the upper end of the range
+        :type upper: dict
+        :param inclusive: Whether to include items at each boundary
+        :type inclusive: bool
+        :param chunk_size: The number of records to read per write transaction
+        :type chunk_size: int
+        :return: The number of records deleted
+        :rtype: int
+        :raises: xIndexMissing if the index doesn't exist, xIndexUnsupported for a text or trigram index
+        """
+        encode = self._ordered(index)._func if index else lambda record: record['_id']
+        lower = encode(lower) if lower else None
+        upper = encode(upper) if upper else None
+        return self._delete_chunks(index, lower, upper, inclusive, None, chunk_size)
+
+    def expire(self, now=None, chunk_size=1000, rate=None):
+        """
+        Delete the records that have expired according to this table's TTL indexes, walking each
+        index from the oldest entry in chunks of 'chunk_size' records, each in it's own write
+        transaction. Deletions are logged as for delete_where, so expire on the primary only.
+
+        :param now: The current time, the default is time()
+        :type now: float
+        :param chunk_size: The number of records to delete per write transaction
+        :type chunk_size: int
+        :param rate: The maximum number of records to delete per second, None for no limit
+        :type rate: float
+        :return: expired (records), chunks, reclaimed (bytes, table and indexes) and elapsed (seconds)
+        :rtype: dict
+        :raises: xWriteFail if called inside a transaction
+        """
+        if self._ctx.transaction: raise xWriteFail('expire inside a transaction')
+        now = time() if now is None else now
+        stats = {'expired': 0, 'chunks': 0, 'reclaimed': 0, 'elapsed': 0.0}
+        start = time()
+        before = self.stats()
+        for index in [index for index in self._indexes.values() if index.ttl]:
+            field, = index.key_fields
+            upper = index._func({field: now - index.ttl})
+            position, done = None, False
+            while not done:
+                began = time()
+                with self._ctx.begin() as transaction:
+                    count, position, done = self._delete_chunk(
+                        transaction, index._name, position, None, upper, True, None, chunk_size)
+                stats['expired'] += count
+                stats['chunks'] += 1
+                if rate and count and not done:
+                    sleep(max(0.0, count / rate - (time() - began)))
+        if stats['expired']:
+            after = self.stats()
+            stats['reclaimed'] = before['bytes'] + before['index_bytes'] - after['bytes'] - after['index_bytes']
+        stats['elapsed'] = time() - start
+        return stats
+
+    def delete_where(self, expression, index=None, chunk_size=1000):
+        """
+        Delete all records for which 'expression' returns True, see delete_range
+
+        :param expression: Called with each record, returns True if it should be deleted
+        :type expression: function
+        :param index: The name of an index to walk the table in the order of
+        :type index: str
+        :param chunk_size: The number of records to read per write transaction
+        :type chunk_size: int
+        :return: The number of records deleted
+        :rtype: int
+        :raises: xIndexMissing if the index doesn't exist, xIndexUnsupported for a text or trigram index
+        """
+        if index: self._ordered(index)
+        return self._delete_chunks(index, None, None, True, expression, chunk_size)
+
+    def _ordered(self, name):
+        """
+        Recover an index we can walk in key order, text and trigram indexes hold any number of
+        entries per record (and aren't in the order of any field) so they're only for searching
+
+        :param name: The name of the index
+        :type name: str
+        :return: The index
+        :rtype: Index
+        :raises: xIndexMissing if the index doesn't exist, xIndexUnsupported for a text or trigram index
+        """
+        if name not in self._indexes: raise xIndexMissing(name)
+        index = self._indexes[name]
+        if not index._seekable: raise xIndexUnsupported(name)
+        return index
+
+    def _delete_chunks(self, index, lower, upper, inclusive, expression, chunk_size):
+        """
+        Delete records in chunks, each in it's own transaction, see delete_range
+
+        :return: The number of records deleted
+        :rtype: int
+        """
+        if self._ctx.transaction:
+            return self._delete_chunk(self._ctx.transaction, index, None, lower, upper, inclusive, expression, maxsize)[0]
+        position, total, done = None, 0, False
+        while not done:
+            with self._ctx.begin() as transaction:
+                count, position, done = self._delete_chunk(
+                    transaction, index, position, lower, upper, inclusive, expression, chunk_size)
+            total += count
+        return total
+
+    def _delete_chunk(self, transaction, index, position, lower, upper, inclusive, expression, limit):
+        """
+        Delete records from the position we reached last time, deleting as we go with the cursor
+        we're walking with. Entries in the other indexes are collected and removed afterwards in
+        key order, as are a record's other entries in a multikey index we're walking, which we
+        skip if we reach them before then.
+
+        :param transaction: The current transaction
+        :type transaction: DBTransaction
+        :param index: The name of the index to walk, None for natural order
+        :type index: str
+        :param position: Where we left off (key, value), None to start at the beginning
+        :type position: tuple
+        :param lower: The key to start at, or None
+        :type lower: bytes
+        :param upper: The key to end at, or None
+        :type upper: bytes
+        :param inclusive: Whether to include keys equal to lower and upper
+        :type inclusive: bool
+        :param expression: An optional filter expression
+        :type expression: function
+        :param limit: The maximum number of records to read
+        :type limit: int
+        :return: The number of records deleted, our new position and whether we've finished
+        :rtype: tuple
+        """
+        txn = transaction.txn
+        index = self._indexes[index] if index else None
+        others = [] if self._deferred else [other for other in self._indexes.values() if other is not index]
+        entries = {other: [] for other in others}
+        if index and index.multikey:
+            entries[index] = []
+        keys, gone, scanned, done = [], set(), 0, False
+        with Cursor(index._db if index else self._db, txn) as cursor:
+            if position:
+                key, value = position
+                if index and index.duplicates and cursor.set_range_dup(key, value):
+                    found = cursor.value() != value or cursor.next()
+                else:
+                    found = cursor.set_range(key)
+                    while found and cursor.key() == key:
+                        found = cursor.next()
+            else:
+                found = cursor.set_range(lower) if lower else cursor.first()
+                while found and not inclusive and cursor.key() == lower:
+                    found = cursor.next()
+            while True:
+                if not found:
+                    done = True
+                    break
+                key = cursor.key()
+                if upper is not None and (key > upper or (not inclusive and key == upper)):
+                    done = True
+                    break
+                if scanned >= limit:
+                    break
+                scanned += 1
+                position = bytes(key), bytes(cursor.value())
+                if index:
+                    key = position[1]
+                    if key in gone:
+                        found = cursor.next()
+                        continue
+                    doc = txn.get(key, db=self._db)
+                    if not doc: raise xNotFound(key)
+                else:
+                    key, doc = position
+                record = loads(bytes(doc))
+                if callable(expression) and not expression(record):
+                    found = cursor.next()
+                    continue
+                if index and not txn.delete(key, db=self._db): raise xWriteFail(key)
+                for other in others:
+                    entries[other] += ((ikey, key) for ikey in other.keys(record))
+                if index in entries:
+                    entries[index] += ((ikey, key) for ikey in index.keys(record) if ikey != position[0])
+                    gone.add(key)
+                keys.append(key)
+                if not cursor.delete(): raise xWriteFail(key)
+                found = bool(cursor.key())
+        for other, pairs in entries.items():
+            other.remove(txn, sorted(pairs))
+        if keys:
+            if index or expression:
+                transaction.delete(self._name, keys)
+            else:
+                transaction.delete_range(self._name, keys[0], keys[-1])
+        return len(keys), position, done
+
+    @write_transaction
+    def _drop(self, txn):
+        """
+        Drop this tablex and all it's indecies
+
+        :param delete: Whether we delete the table after removing all items
+        :type delete: bool
+        :param txn: An optional transaction
+        :type txn: Transaction
+        """
+        for name in list(self._indexes):
+            self._unindex(name, txn)
+        if self._ctx.transaction:
+            self._ctx.transaction.drop(self._name)
+        return txn.drop(self._db, True)
 
     @write_transaction
     def drop_index(self, name, txn):
@@ -541,8 +1888,8 @@ class Table(object):
         """
         Clear all records from the current table
         """
-        for name in self.indexes:
-            self._indexes[name].empty(txn)
+        for index in self._indexes.values():
+            index.empty(txn)
         if self._ctx.transaction:
             self._ctx.transaction.empty(self._name)
         txn.drop(self._db, False)
@@ -559,10 +1906,21 @@ class Table(object):
         return name in self._indexes
 
     @read_transaction
-    def find(self, index=None, expression=None, limit=maxsize, txn=None, abort=False):
+    @metered
+    def find(self, index=None, expression=None, limit=maxsize, txn=None, abort=False, trace=None, snapshot=True):
         """
         Find all records either sequential or based on an index
 
+        By default the whole scan sees a single snapshot of the database, which is held (along
+        with every page it refers to) until the generator finishes, so a slow consumer makes the
+        file grow. With snapshot=False the records are read in batches of conf['scan']['records']
+        records or conf['scan']['seconds'], each in a new read transaction which is closed before
+        the batch is returned. Each batch is consistent, the scan as a whole is not; records come
+        back in key order and each record is returned once provided it's key (or index key) isn't
+        changed during the scan, changes ahead of the scan are seen and changes behind it aren't.
+        A record whose key changes may be returned twice or not at all. snapshot=False has no
+        effect inside a transaction.
+
         :param index: The name of the index to use [OR use natural order] 
         :type index: str
         :param expression: An optional filter expression
@@ -571,18 +1929,23 @@ class Table(object):
         :type limit: int
         :param txn: An optional transaction
         :type txn: Transaction
+        :param trace: If supplied, updated with the records 'scanned', 'fetched' and 'decode' time
+        :type trace: dict
+        :param snapshot: Set to False to read in batches rather than holding a single snapshot
+        :type snapshot: bool
         :return: The next record (generator)
         :rtype: dict
         """
-
+        _trace(trace)
+        if not snapshot and abort:
+            yield from self._batched(txn, index, None, None, True, expression, limit, trace)
+            return
         try:
             cursor = None
             if not index:
                 cursor = Cursor(self._db, txn)
             else:
-                if index not in self._indexes:
-                    raise xIndexMissing(index)
-                index = self._indexes[index]
+                index = self._ordered(index)
                 cursor = index.cursor(txn)
             count = 0
             first = True
@@ -596,7 +1959,7 @@ class Table(object):
                     record = txn.get(record, db=self._db)
                 else:
                     key = cursor.key()
-                record = loads(bytes(record))
+                record = loads(bytes(record)) if trace is None else _traced(record, trace, index)
                 if callable(expression) and not expression(record):
                     continue
                 record['_id'] = key
@@ -609,8 +1972,284 @@ class Table(object):
             if abort:
                 txn.abort()
 
+    def _batched(self, txn, index, lower, upper, inclusive, expression, limit, trace):
+        """
+        Read a table or index in batches, each in it's own read transaction, for find and range
+        with snapshot=False. Between batches we resume from the last key (and for an index with
+        duplicates, the last record key) we read.
+
+        :param txn: The (read) transaction for the first batch, we're responsible for it
+        :type txn: Transaction
+        :param index: The name of the index to use, or None for natural order
+        :type index: str
+        :param lower: The key to start at, or None
+        :type lower: bytes
+        :param upper: The key to end at, or None
+        :type upper: bytes
+        :param inclusive: Whether to include keys equal to lower and upper
+        :type inclusive: bool
+        :param expression: An optional filter expression
+        :type expression: function
+        :param limit: The maximum number of records to return
+        :type limit: int
+        :param trace: If supplied, updated with the records 'scanned', 'fetched' and 'decode' time
+        :type trace: dict
+        :return: The next record (generator)
+        :rtype: dict
+        """
+        try:
+            if index:
+                index = self._ordered(index)
+            db = index._db if index else self._db
+            duplicates = index.duplicates if index else False
+            records, seconds = self._ctx._scan_conf['records'], self._ctx._scan_conf['seconds']
+            position, count, done = None, 0, False
+            while not done:
+                batch = []
+                with Cursor(db, txn) as cursor:
+                    if position:
+                        key, value = position
+                        if duplicates and cursor.set_range_dup(key, value):
+                            found = cursor.value() != value or cursor.next()
+                        else:
+                            found = cursor.set_range(key)
+                            while found and cursor.key() == key:
+                                found = cursor.next()
+                    else:
+                        found = cursor.set_range(lower) if lower else cursor.first()
+                        while found and not inclusive and cursor.key() == lower:
+                            found = cursor.next()
+                    began, scanned = time(), 0
+                    while True:
+                        if not found or count >= limit:
+                            done = True
+                            break
+                        key = cursor.key()
+                        if upper is not None and (key > upper or (not inclusive and key == upper)):
+                            done = True
+                            break
+                        if scanned and (scanned >= records or time() - began >= seconds):
+                            break
+                        position = bytes(key), bytes(cursor.value())
+                        if index:
+                            key = position[1]
+                            record = txn.get(key, db=self._db)
+                            if not record: raise xNotFound(key)
+                        else:
+                            record = position[1]
+                        record = loads(bytes(record)) if trace is None else _traced(record, trace, bool(index))
+                        scanned += 1
+                        if not callable(expression) or expression(record):
+                            record['_id'] = key
+                            batch.append(record)
+                            count += 1
+                        found = cursor.next()
+                txn.abort()
+                txn = None
+                for record in batch:
+                    yield record
+                if not done:
+                    txn = self._ctx._begin()
+        finally:
+            if txn:
+                txn.abort()
+
+    @read_transaction
+    def query(self, query, limit=maxsize, txn=None, abort=False, trace=None):
+        """
+        Find the records matching a filter, see _matches for the operators. The cheapest
+        index we can use is chosen (see explain), an index whose key fields all have values in
+        the filter is used to seek and a partial index is used if the filter implies it's own,
+        failing that we scan the table.
+
+        :param query: The filter, i.e. {'active': True, 'age': {'$gte': 18}}
+        :type query: dict
+        :param limit: The maximum number of records to return
+        :type limit: int
+        :param txn: An optional transaction
+        :type txn: Transaction
+        :param trace: If supplied, updated with the records 'scanned', 'fetched' and 'decode' time
+        :type trace: dict
+        :return: The matching records (generator)
+        :rtype: dict
+        """
+        try:
+            access, index, _ = self._plan(query, txn=txn)
+            if access == 'index seek':
+                records = self.seek(index, _values(query), txn=txn, trace=trace)
+            else:
+                records = self.find(index, txn=txn, trace=trace)
+            count = 0
+            for record in records:
+                if count >= limit:
+                    break
+                if _matches(record, query):
+                    yield record
+                    count += 1
+        finally:
+            if abort:
+                txn.abort()
+
+    @read_transaction
+    def search(self, index, query, mode='and', limit=maxsize, scores=False, txn=None, abort=False):
+        """
+        Search a text index, records are returned best match first, see TextIndex.search
+
+        :param index: The name of the text index
+        :type index: str
+        :param query: The words to search for, i.e. 'red fox*' or '"red fox"'
+        :type query: str
+        :param mode: 'and' to match every word, 'or' to match any
+        :type mode: str
+        :param limit: The maximum number of records to return
+        :type limit: int
+        :param scores: Return (score, record) tuples rather than records
+        :type scores: bool
+        :param txn: An optional transaction
+        :type txn: Transaction
+        :return: The matching records (generator)
+        :rtype: dict|tuple
+        :raises: xIndexMissing if the index doesn't exist, ValueError if it can't be searched
+        """
+        try:
+            if index not in self._indexes: raise xIndexMissing(index)
+            index = self._indexes[index]
+            if not hasattr(index, 'search'): raise ValueError('not a search index: {}'.format(index._name))
+            for key, score in index.search(txn, query, mode, limit, self._db):
+                record = loads(bytes(txn.get(key, db=self._db)))
+                record['_id'] = key
+                yield (score, record) if scores else record
+        finally:
+            if abort:
+                txn.abort()
+
     @read_transaction
-    def range(self, index, lower=None, upper=None, inclusive=True, txn=None, abort=False):
+    def like(self, index, pattern, limit=maxsize, txn=None, abort=False):
+        """
+        Find the records whose field matches a (case insensitive) LIKE pattern using a trigram
+        index, '%' matches any number of characters and '_' any single character, so for example
+        like('by_host', '%web%') finds every host containing 'web'. Records are returned in
+        natural order.
+
+        :param index: The name of the trigram index
+        :type index: str
+        :param pattern: The pattern to match
+        :type pattern: str
+        :param limit: The maximum number of records to return
+        :type limit: int
+        :param txn: An optional transaction
+        :type txn: Transaction
+        :return: The matching records (generator)
+        :rtype: dict
+        :raises: xIndexMissing if the index doesn't exist, ValueError if it's not a trigram index
+        """
+        try:
+            if index not in self._indexes: raise xIndexMissing(index)
+            index = self._indexes[index]
+            if not hasattr(index, 'like'): raise ValueError('not a trigram index: {}'.format(index._name))
+            for count, (key, record) in enumerate(index.like(txn, pattern, self._db)):
+                if count >= limit:
+                    break
+                record['_id'] = key
+                yield record
+        finally:
+            if abort:
+                txn.abort()
+
+    @read_transaction
+    def _plan(self, query, txn, abort=False):
+        """
+        Choose how to run a query, the access path with the lowest estimate of the records
+        we'll need to read wins
+
+        :param query: The filter
+        :type query: dict
+        :param txn: An optional transaction
+        :type txn: Transaction
+        :return: access (full scan, index scan or index seek), index and estimated (records)
+        :rtype: tuple
+        """
+        try:
+            values = _values(query)
+            best = 'full scan', None, txn.stat(self._db)['entries']
+            for name, index in sorted(self._indexes.items()):
+                if not index._seekable or not index.implied_by(query):
+                    continue
+                if index.key_fields and index.key_fields <= set(values):
+                    try:
+                        plan = 'index seek', name, index.matches(values, txn=txn)
+                    except (KeyError, ValueError, TypeError):
+                        continue    # the values can't be used to make a key
+                elif index.where:
+                    plan = 'index scan', name, index.count(txn=txn)
+                else:
+                    continue
+                if plan[2] < best[2]:
+                    best = plan
+            return best
+        finally:
+            if abort:
+                txn.abort()
+
+    def explain(self, op, *args, **kwargs):
+        """
+        Run a read operation and report how it was done, i.e. explain('find', expression=fn)
+        will tell you it was a full scan along with how many records were read to find the ones
+        returned. The 'estimated' figure is the number of records we'd expect to read based on
+        the size of the table or index, for ranges and expressions this is an upper bound.
+
+        :param op: The operation, one of find, range, seek, seek_one, get or query
+        :type op: str
+        :param args: The arguments for the operation
+        :param kwargs: The keyword arguments for the operation
+        :return: op, table, access (full scan, key range, key lookup, index scan, index range or
+            index seek), index, estimated, scanned, returned, fetched (records read by key),
+            decode (seconds spent decoding records) and elapsed (seconds)
+        :rtype: dict
+        """
+        if op not in ['find', 'range', 'seek', 'seek_one', 'get', 'query']: raise ValueError(op)
+        index = None if op in ['get', 'query'] else kwargs.get('index', args[0] if args else None)
+        if index and index not in self._indexes: raise xIndexMissing(index)
+        if op == 'query':
+            access, index, estimated = self._plan(kwargs.get('query', args[0] if args else None))
+        elif op == 'find':
+            total = self._indexes[index].count() if index else self.records
+            estimated = total if 'expression' in kwargs else min(total, kwargs.get('limit', maxsize))
+            access = 'index scan' if index else 'full scan'
+        elif op == 'range':
+            estimated = self._indexes[index].count() if index else self.records
+            access = 'index range' if index else 'key range'
+        elif op == 'seek':
+            record = kwargs.get('record', args[1] if len(args) > 1 else None)
+            estimated = self._indexes[index].matches(record)
+            access = 'index seek'
+        else:
+            estimated = 1
+            access = 'index seek' if index else 'key lookup'
+        trace = kwargs['trace'] = {}
+        start = time()
+        result = getattr(self, op)(*args, **kwargs)
+        if isinstance(result, GeneratorType):
+            returned = sum(1 for _ in result)
+        else:
+            returned = int(result is not None)
+        return {
+            'op': op,
+            'table': self._name,
+            'access': access,
+            'index': index,
+            'estimated': estimated,
+            'scanned': trace['scanned'],
+            'returned': returned,
+            'fetched': trace['fetched'],
+            'decode': trace['decode'],
+            'elapsed': time() - start
+        }
+
+    @read_transaction
+    @metered
+    def range(self, index, lower=None, upper=None, inclusive=True, txn=None, abort=False, trace=None,
+              snapshot=True):
         """
         Find all records with a key >= lower and <= upper. If you set inclusive to false the range
         becomes key > lower and key < upper. Upper and/or Lower can be set to None, if lower is none
@@ -627,9 +2266,20 @@ class Table(object):
         :type inclusive: bool
         :param txn: An optional transaction
         :type txn: Transaction
+        :param trace: If supplied, updated with the records 'scanned', 'fetched' and 'decode' time
+        :type trace: dict
+        :param snapshot: Set to False to read in batches rather than holding a single snapshot, see find
+        :type snapshot: bool
         :return: The records with keys within the specified range (generator)
         :type: dict
         """
+        _trace(trace)
+        if not snapshot and abort:
+            encode = self._ordered(index)._func if index else lambda record: record['_id']
+            lower = encode(lower) if lower else None
+            upper = encode(upper) if upper else None
+            yield from self._batched(txn, index, lower, upper, inclusive, None, maxsize, trace)
+            return
         try:
             if not index:
                 with Cursor(self._db, txn) as cursor:
@@ -645,7 +2295,8 @@ class Table(object):
                     while True:
                         key = cursor.key()
                         if not key: break
-                        record = loads(bytes(cursor.value()))
+                        record = cursor.value()
+                        record = loads(bytes(record)) if trace is None else _traced(record, trace)
                         record['_id'] = key
                         if not inclusive:
                             if not forward(): break
@@ -654,8 +2305,7 @@ class Table(object):
                             yield record
                             if not forward(): break
             else:
-                if index not in self._indexes: raise xIndexMissing
-                index = self._indexes[index]
+                index = self._ordered(index)
                 with index.cursor(txn) as cursor:
                     def forward():
                         if upper:
@@ -674,7 +2324,7 @@ class Table(object):
                         if not key: break
                         record = txn.get(cursor.value(), db=self._db)
                         if not record: raise xNotFound(cursor.value())
-                        record = loads(bytes(record))
+                        record = loads(bytes(record)) if trace is None else _traced(record, trace, True)
                         record['_id'] = cursor.value()
                         if not inclusive:
                             if not forward(): break
@@ -687,19 +2337,23 @@ class Table(object):
                 txn.abort()
 
     @read_transaction
-    def get(self, key, txn=None, abort=False):
+    @metered
+    def get(self, key, txn=None, abort=False, trace=None):
         """
         Get a single record based on it's key
 
         :param key: The _id of the record to get
         :type key: str
+        :param trace: If supplied, updated with the records 'scanned', 'fetched' and 'decode' time
+        :type trace: dict
         :return: The requested record
         :rtype: dict
         """
+        _trace(trace)
         try:
             record = txn.get(key, db=self._db)
             if not record: return None
-            record = loads(bytes(record))
+            record = loads(bytes(record)) if trace is None else _traced(record, trace, True)
             record['_id'] = key
             return record
 
@@ -708,35 +2362,85 @@ class Table(object):
                 txn.abort()
 
     @write_transaction
-    def index(self, name, func=None, duplicates=False, txn=None):
+    def index(self, name, func=None, duplicates=False, ttl=None, where=None, multikey=False, text=False,
+              positions=False, trigram=False, txn=None):
         """
         Return a reference for a names index, or create if not available
 
+        A TTL index, i.e. index('by_when', '{when}', ttl=3600), is keyed on a single field holding
+        a time (seconds since the epoch), records expire 'ttl' seconds after that time and are
+        deleted by expire() or a pymamba.reaper.Reaper. TTL indexes always allow duplicates.
+
+        A partial index only holds the records that match a filter (see Table.query), i.e.
+        index('active_by_name', '{name}', where={'active': True}), records move in and out of
+        the index as they're saved. query() uses a partial index when the query implies it's filter.
+
+        A multikey index holds a key for each element of list fields, i.e. index('by_tag', '{tags}',
+        multikey=True) finds records by any of their tags, so seek('by_tag', {'tags': 'red'}).
+        Compound keys get a key per combination of elements. Multikey indexes always allow
+        duplicates, a record appears once for each of it's keys when the index is scanned.
+
+        A text index, i.e. index('by_text', '{name} {notes}', text=True), is an inverted index of
+        the words in the fields named, see TextIndex and search(). A trigram index, i.e.
+        index('by_host', '{host}', trigram=True), holds every three character sequence of a
+        field and is used for substring matching, see TrigramIndex and like().
+
         :param name: The name of the index to create
         :type name: str
         :param func: A specification of the index, !<function>|<field name>
         :type func: str
         :param duplicates: Whether this index will allow duplicate keys
         :type duplicates: bool
+        :param ttl: Make this a TTL index, records expire this many seconds after the indexed time
+        :type ttl: float
+        :param where: Make this a partial index, only records matching this filter are indexed
+        :type where: dict
+        :param multikey: Make this a multikey index, with a key per element of list fields
+        :type multikey: bool
+        :param text: Make this a text index
+        :type text: bool
+        :param positions: For a text index, keep the positions of words for ranking and phrases
+        :type positions: bool
+        :param trigram: Make this a trigram index
+        :type trigram: bool
         :param txn: An optional transaction
         :type txn: Transaction
         :return: A reference to the index, created index, or None if index creation fails
         :rtype: Index
+        :raises: ValueError if a TTL index doesn't refer to exactly one field
         """
         if name not in self._indexes:
             conf = {
                 'key': _index_name(self, name),
-                'dupsort': duplicates,
+                'dupsort': duplicates or bool(ttl) or multikey or text or trigram,
                 'create': True,
             }
-            self._indexes[name] = Index(self._ctx, name, func, conf, txn)
-            key = _index_name(self, name).encode()
-            val = dumps({'conf': conf, 'func': func}).encode()
-            if not txn.put(key, val, db=self._ctx._metadata): raise xWriteFail
-            self._reindex(name, txn)
+            if ttl:
+                conf['ttl'] = ttl
+            if where:
+                conf['where'] = where
+            if multikey:
+                conf['multikey'] = True
+            if text:
+                conf['text'] = True
+                if positions:
+                    conf['positions'] = True
+            if trigram:
+                conf['trigram'] = True
+            self._indexes[name] = _index_class(conf)(self._ctx, name, func, conf, txn)
+            try:
+                key = _index_name(self, name).encode()
+                val = dumps({'conf': conf, 'func': func}).encode()
+                if not txn.put(key, val, db=self._ctx._metadata): raise xWriteFail
+                self._ctx._bump_version(txn)
+                if not self._deferred:
+                    self._reindex(name, txn)
+            except Exception:
+                del self._indexes[name]     # the transaction will be aborted
+                raise
 
             if self._ctx.transaction:
-                self._ctx.transaction.index(self._name, name, func, duplicates)
+                self._ctx.transaction.index(self._name, name, func, duplicates, self._indexes[name].options)
 
         return self._indexes[name]
 
@@ -765,15 +2469,29 @@ class Table(object):
     @write_transaction
     def reindex(self, txn):
         """
-        Reindex all indexes for a given table
+        Reindex all indexes for a given table, all indexes are rebuilt in a single pass
         
-        :param name: Name of the table to reindex
-        :type name: str
         :param txn: An optional transaction
         :type txn: Trnsaction
+        :return: Number of records indexed
+        :rtype: int
         """
-        for name in self._indexes:
-            self._reindex(name, txn)
+        indexes = list(self._indexes.values())
+        for index in indexes:
+            index.empty(txn)
+        count = 0
+        if not indexes:
+            return count
+        with Cursor(self._db, txn) as cursor:
+            found = cursor.first()
+            while found:
+                key = cursor.key().decode()
+                record = loads(bytes(cursor.value()))
+                for index in indexes:
+                    index.put(txn, key, record)
+                count += 1
+                found = cursor.next()
+        return count
 
     def _reindex(self, name, txn):
         """
@@ -805,6 +2523,7 @@ class Table(object):
         return count
 
     @write_transaction
+    @metered
     def save(self, record, txn):
         """
         Save an changes to a pre-existing record
@@ -822,17 +2541,202 @@ class Table(object):
         if not doc: raise xWriteFail('old record is missing')
         old = loads(bytes(doc))
         if not txn.put(key, dumps(rec).encode(), db=self._db): raise xWriteFail('main record')
-        for name in self._indexes:
-            self._indexes[name].save(txn, key, old, rec)
-        #
-        #   Delta, old .vs. record
-        #
-        detla = diff(old, record, verbose=False)
-        if self._ctx.transaction:
-            self._ctx.transaction.update(self._name, key, detla)
+        if not self._deferred:
+            indexes = self._indexes.values()
+            changed = _changed(old, rec, indexes)
+            for index in indexes:
+                if index.fields & changed:
+                    index.save(txn, key, old, rec)
+        transaction = self._ctx.transaction
+        if transaction and transaction.logging:
+            transaction.save(self._name, key, old, rec)
+
+    @write_transaction
+    @metered
+    def update(self, key, ops, index=None, txn=None):
+        """
+        Update records in place with update operators, i.e. {'$inc': {'count': 1}}, this reads
+        and writes each record once and only updates the indexes that depend on the fields
+        being changed. The operators (rather than a delta) are written to the binlog.
+
+            $set    {field: value}  set fields to values
+            $inc    {field: number} add a number to fields, a missing field counts as 0
+            $unset  {field: any}    remove fields
+            $push   {field: value}  append a value to list fields, a missing field becomes a list
+
+        :param key: The key of the record to update, a record, or a template record if 'index' is given
+        :type key: bytes|str|dict
+        :param ops: The update operators
+        :type ops: dict
+        :param index: Update every record matching 'key' in this index
+        :type index: str
+        :param txn: An open transaction
+        :type txn: Transaction
+        :return: The number of records updated
+        :rtype: int
+        :raises: ValueError for an unknown operator, xIndexMissing if the index doesn't exist
+        """
+        unknown = set(ops) - {'$set', '$inc', '$unset', '$push'}
+        if unknown: raise ValueError('unknown operator: {}'.format(', '.join(sorted(unknown))))
+        if index:
+            if index not in self._indexes: raise xIndexMissing(index)
+            keys = [doc['_id'] for doc in self.seek(index, key, txn=txn)]
+        elif isinstance(key, dict):
+            keys = [key['_id']]
+        else:
+            keys = [key.encode() if isinstance(key, str) else key]
+        fields = set()
+        for values in ops.values():
+            fields.update(values)
+        indexes = [] if self._deferred else [i for i in self._indexes.values() if i.fields & fields]
+        count = 0
+        for key in keys:
+            doc = txn.get(key, db=self._db)
+            if not doc:
+                continue
+            old = loads(bytes(doc))
+            rec = dict(old)
+            rec.update(ops.get('$set', {}))
+            for field, value in ops.get('$inc', {}).items():
+                rec[field] = rec.get(field, 0) + value
+            for field in ops.get('$unset', {}):
+                rec.pop(field, None)
+            for field, value in ops.get('$push', {}).items():
+                rec[field] = rec.get(field, []) + [value]
+            if not txn.put(key, dumps(rec).encode(), db=self._db): raise xWriteFail('main record')
+            for i in indexes:
+                i.save(txn, key, old, rec)
+            if self._ctx.transaction:
+                self._ctx.transaction.operators(self._name, key, ops)
+            count += 1
+        return count
+
+    @write_transaction
+    @metered
+    def upsert(self, record, on, txn=None):
+        """
+        Insert a record, or if a record with the same key in the unique index 'on' exists,
+        replace it (keeping it's _id). A new record keeps the _id it's given, as for append,
+        otherwise one is generated.
+
+        :param record: The record to insert or update
+        :type record: dict
+        :param on: The name of a unique index used to find an existing record
+        :type on: str
+        :param txn: An open transaction
+        :type txn: Transaction
+        :return: The _id of the record
+        :rtype: bytes
+        :raises: xIndexMissing if the index doesn't exist, ValueError if it allows duplicates,
+            xWriteFail if a new record's _id is in use or can't be appended
+        """
+        self.upsert_many([record], on, txn=txn)
+        return record['_id']
+
+    @write_transaction
+    def upsert_many(self, records, on, txn=None):
+        """
+        Upsert a number of records in a single transaction, see upsert. Records are processed in
+        the order of their keys in the index 'on' so lookups and inserts touch neighbouring pages,
+        a later record with the same key as an earlier one updates it.
+
+        :param records: The records to insert or update
+        :type records: iterable
+        :param on: The name of a unique index used to find existing records
+        :type on: str
+        :param txn: An open transaction
+        :type txn: Transaction
+        :return: The number of records 'inserted' and 'updated'
+        :rtype: dict
+        :raises: xIndexMissing if the index doesn't exist, ValueError if it allows duplicates,
+            xWriteFail if a new record's _id is in use or can't be appended
+        """
+        if on not in self._indexes: raise xIndexMissing(on)
+        index = self._indexes[on]
+        if index.duplicates: raise ValueError('upsert needs a unique index: {}'.format(on))
+        stats = {'inserted': 0, 'updated': 0}
+        for ikey, _, record in sorted((index._func(record), n, record) for n, record in enumerate(records)):
+            key = txn.get(ikey, db=index._db)
+            if key:
+                record['_id'] = key
+                self.save(record, txn=txn)
+                stats['updated'] += 1
+            else:
+                self.append(record, txn=txn)
+                stats['inserted'] += 1
+        return stats
+
+    def transform(self, fn, chunk_size=1000, where=None, name='transform', pause=0):
+        """
+        Rewrite the records in this table in place, i.e. for a schema migration. Records are
+        processed in key order in chunks, each chunk has it's own (short) write transaction
+        and the key of the last record processed is kept in __metadata__ so an interrupted
+        transform will carry on where it left off when called again with the same name. Only
+        the indexes that depend on fields that have changed are updated.
+
+        :param fn: Called with each record, returns the new record or None to leave it alone
+        :type fn: function
+        :param chunk_size: The number of records to process per write transaction
+        :type chunk_size: int
+        :param where: Only transform records for which this returns True
+        :type where: function
+        :param name: The name under which our progress is kept
+        :type name: str
+        :param pause: How long to sleep (seconds) between chunks to let other writers in
+        :type pause: float
+        :return: scanned, changed, chunks and elapsed (seconds)
+        :rtype: dict
+        :raises: xWriteFail if called inside a transaction
+        """
+        if self._ctx.transaction: raise xWriteFail('transform inside a transaction')
+        marker = '~transform~{}~{}'.format(self._name, name).encode()
+        stats = {'scanned': 0, 'changed': 0, 'chunks': 0, 'elapsed': 0.0}
+        start = time()
+        while True:
+            with self._ctx.begin() as transaction:
+                txn = transaction.txn
+                last = txn.get(marker, db=self._ctx._metadata)
+                chunk = []
+                with Cursor(self._db, txn) as cursor:
+                    found = cursor.set_range(last) if last else cursor.first()
+                    if found and cursor.key() == last:
+                        found = cursor.next()
+                    while found and len(chunk) < chunk_size:
+                        chunk.append((cursor.key(), loads(bytes(cursor.value()))))
+                        found = cursor.next()
+                if not chunk:
+                    txn.delete(marker, db=self._ctx._metadata)
+                    break
+                for key, old in chunk:
+                    stats['scanned'] += 1
+                    record = dict(old, _id=key)
+                    if where and not where(record):
+                        continue
+                    record = fn(record)
+                    if record is None:
+                        continue
+                    rec = dict(record)
+                    rec.pop('_id', None)
+                    if rec == old:
+                        continue
+                    if not txn.put(key, dumps(rec).encode(), db=self._db): raise xWriteFail('main record')
+                    changed = _changed(old, rec, self._indexes.values())
+                    for index in self._indexes.values():
+                        if index.fields & changed:
+                            index.save(txn, key, old, rec)
+                    if transaction.logging:
+                        transaction.save(self._name, key, old, rec)
+                    stats['changed'] += 1
+                if not txn.put(marker, chunk[-1][0], db=self._ctx._metadata): raise xWriteFail('progress')
+            stats['chunks'] += 1
+            if pause:
+                sleep(pause)
+        stats['elapsed'] = time() - start
+        return stats
 
     @read_transaction
-    def seek(self, index, record, txn, abort=False):
+    @metered
+    def seek(self, index, record, txn, abort=False, trace=None):
         """
         Find all records matching the key in the specified index.
 
@@ -842,11 +2746,14 @@ class Table(object):
         :type record: dict
         :param txn: An optional transaction
         :type txn: Transaction
+        :param trace: If supplied, updated with the records 'scanned', 'fetched' and 'decode' time
+        :type trace: dict
         :return: The records with matching keys (generator)
         :type: dict
         """
+        _trace(trace)
         try:
-            index = self._indexes[index]
+            index = self._ordered(index)
             with index.cursor(txn) as cursor:
                 index.set_key(cursor, record)
                 while True:
@@ -854,7 +2761,7 @@ class Table(object):
                         break
                     key = cursor.value()
                     record = txn.get(key, db=self._db)
-                    record = loads(bytes(record))
+                    record = loads(bytes(record)) if trace is None else _traced(record, trace, True)
                     record['_id'] = key
                     yield record
                     if not cursor.next_dup():
@@ -864,7 +2771,8 @@ class Table(object):
                 txn.abort()
 
     @read_transaction
-    def seek_one(self, index, record, txn, abort=False):
+    @metered
+    def seek_one(self, index, record, txn, abort=False, trace=None):
         """
         Find the first records matching the key in the specified index.
 
@@ -872,16 +2780,19 @@ class Table(object):
         :type index: str
         :param record: A template record containing the fields to search on
         :type record: dict
+        :param trace: If supplied, updated with the records 'scanned', 'fetched' and 'decode' time
+        :type trace: dict
         :return: The record with matching key
         :type: dict
         """
+        _trace(trace)
         try:
-            index = self._indexes[index]
+            index = self._ordered(index)
             entry = index.get(txn, record)
             if not entry: return None
             record = txn.get(entry, db=self._db)
             if not record: return None
-            record = loads(bytes(record))
+            record = loads(bytes(record)) if trace is None else _traced(record, trace, True)
             record['_id'] = entry
             return record
         finally:
@@ -905,34 +2816,42 @@ class Table(object):
         self._indexes[name].drop(txn)
         del self._indexes[name]
         if not txn.delete(_index_name(self, name).encode(), db=self._ctx._metadata): raise xWriteFail
+        self._ctx._bump_version(txn)
 
         if self._ctx.transaction:
             self._ctx.transaction.unindex(self._name, name)
 
     @property
-    @read_transaction
-    def indexes(self, txn, abort=False):
+    def indexes(self):
         """
         Return a list of indexes for this table
 
         :getter: The indexes for this table
         :type: list
         """
+        return sorted(self._indexes)
+
+    @read_transaction
+    def stats(self, txn, abort=False):
+        """
+        Storage statistics for this table and it's indexes, 'average_record' and 'average_key'
+        are the bytes (pages) used per entry so they include LMDB's overheads.
+
+        :param txn: An optional transaction
+        :type txn: Transaction
+        :return: LMDB stat() figures (depth, branch_pages, leaf_pages, overflow_pages, psize,
+            entries) plus bytes, average_record, index_bytes and indexes (a dict of index stats)
+        :rtype: dict
+        """
         try:
-            results = []
-            index_name = _index_name(self, '')
-            pos = len(index_name)
-            db = self._ctx.env.open_db(txn=txn)
-            with Cursor(db, txn) as cursor:
-                if cursor.set_range(index_name.encode()):
-                    while True:
-                        name = cursor.key().decode()
-                        if not name.startswith(index_name) or not cursor.next():
-                            break
-                        results.append(name[pos:])
-            return results
+            result = _stats(txn.stat(self._db))
+            result['average_record'] = result.pop('average_key')
+            result['indexes'] = {name: index.stats(txn=txn) for name, index in self._indexes.items()}
+            result['index_bytes'] = sum(index['bytes'] for index in result['indexes'].values())
+            return result
         finally:
-            if abort: txn.abort()
+            if abort:
+                txn.abort()
 
     @property
     @read_transaction
@@ -973,35 +2892,213 @@ class Index(object):
 
     """
     _debug = False
+    _seekable = True
 
     def __init__(self, ctx, name, func, conf, txn):
         self._ctx = ctx
         self._name = name
         self._conf = conf
         self._conf['key'] = self._conf['key'].encode()
-        self._func = _anonymous('(r): return "{}".format(**r).encode()'.format(func))
-        self._db = self._ctx.env.open_db(**self._conf, txn=txn)
+        self._spec = func
+        self._key_fields = frozenset(_spec_fields(func or ''))
+        self._ttl = self._conf.get('ttl')
+        if self._ttl and len(self._key_fields) != 1: raise ValueError('a TTL index needs a single field: {}'.format(func))
+        self._where = self._conf.get('where')
+        self._multikey = self._conf.get('multikey', False)
+        self._fields = self._key_fields | frozenset(self._where or ())
+        self._func = self._compile
+        self._db = self._ctx.env.open_db(**{k: v for k, v in self._conf.items() if k in _index_conf}, txn=txn)
+
+    def _compile(self, record):
+        """
+        Compile our key function the first time it's needed, then replace ourself with it
 
-    @read_transaction
-    def count(self, txn, abort=False):
+        :param record: The record to generate a key for
+        :type record: dict
+        :return: The key
+        :rtype: bytes
         """
-        Count the number of items currently present in this index
-        
-        :param txn: Is an open Transaction 
-        :param txn: Is an open Transaction 
-        :type txn: Transaction
-        :return: The number if items in the index
-        :rtype: int
+        if self._ttl:
+            field, = self._key_fields
+            self._func = lambda r: '{:020.6f}'.format(r[field]).encode()
+        else:
+            self._func = _anonymous('(r): return "{}".format(**r).encode()'.format(self._spec))
+        return self._func(record)
+
+    @property
+    def func(self):
         """
-        try:
-            return txn.stat(self._db).get('entries', 0)
-        finally:
-            if abort:
-                txn.abort()
+        PROPERTY - The specification (format string) used to generate keys for this index
 
-    def cursor(self, txn):
+        :getter: The index specification
+        :type: str
         """
-        Return a cursor into the current index
+        return self._spec
+
+    @property
+    def fields(self):
+        """
+        PROPERTY - The (top level) fields of a record this index depends on
+
+        :getter: The field names
+        :type: frozenset
+        """
+        return self._fields
+
+    @property
+    def key_fields(self):
+        """
+        PROPERTY - The (top level) fields of a record used to make this index's keys
+
+        :getter: The field names
+        :type: frozenset
+        """
+        return self._key_fields
+
+    @property
+    def where(self):
+        """
+        PROPERTY - For a partial index, the filter a record must match to be indexed
+
+        :getter: The filter or None
+        :type: dict
+        """
+        return self._where
+
+    @property
+    def options(self):
+        """
+        PROPERTY - The options this index was created with beyond it's function and duplicates
+
+        :getter: i.e. {'ttl': 3600}
+        :type: dict
+        """
+        return {k: v for k, v in self._conf.items() if k not in _index_conf}
+
+    def keys(self, record):
+        """
+        Generate the keys this index holds for a record, a partial index holds nothing for a
+        record that doesn't match it's filter and a multikey index holds a key for each element
+        of a list field (or each combination of elements if there's more than one)
+
+        :param record: The record
+        :type record: dict
+        :return: The keys
+        :rtype: tuple|set
+        """
+        if self._where and not _matches(record, self._where):
+            return ()
+        if self._multikey:
+            lists = [field for field in self._key_fields if isinstance(record.get(field), list)]
+            if lists:
+                values = {field: record[field] for field in self._key_fields if field in record}
+                keys = set()
+                for elements in product(*(record[field] for field in lists)):
+                    values.update(zip(lists, elements))
+                    keys.add(self._func(values))
+                return keys
+        return self._func(record),
+
+    def implied_by(self, query):
+        """
+        Test whether every record matching a query is held by this index, i.e. the query
+        {'active': True, 'age': 40} implies the filter {'active': True}
+
+        :param query: A filter, see Table.query
+        :type query: dict
+        :return: True if the index holds every record the query matches
+        :rtype: bool
+        """
+        return all(field in query and query[field] == condition for field, condition in (self._where or {}).items())
+
+    @property
+    def multikey(self):
+        """
+        PROPERTY - Whether this index holds a key for each element of list fields
+
+        :getter: True for a multikey index
+        :type: bool
+        """
+        return self._multikey
+
+    @property
+    def ttl(self):
+        """
+        PROPERTY - For a TTL index, the number of seconds after the indexed time records expire
+
+        :getter: The time to live or None
+        :type: float
+        """
+        return self._ttl
+
+    @property
+    def duplicates(self):
+        """
+        PROPERTY - Whether this index allows duplicate keys
+
+        :getter: True if duplicates are allowed
+        :type: bool
+        """
+        return self._conf['dupsort']
+
+    @read_transaction
+    def count(self, txn, abort=False):
+        """
+        Count the number of items currently present in this index
+        
+        :param txn: Is an open Transaction 
+        :param txn: Is an open Transaction 
+        :type txn: Transaction
+        :return: The number if items in the index
+        :rtype: int
+        """
+        try:
+            return txn.stat(self._db).get('entries', 0)
+        finally:
+            if abort:
+                txn.abort()
+
+    @read_transaction
+    def stats(self, txn, abort=False):
+        """
+        Storage statistics for this index, see Table.stats. An index that keeps data in more
+        than one database includes every database it owns in the page and byte counts.
+
+        :param txn: An optional transaction
+        :type txn: Transaction
+        :return: LMDB stat() figures plus bytes and average_key (bytes per entry)
+        :rtype: dict
+        """
+        try:
+            return _stats(txn.stat(self._db))
+        finally:
+            if abort:
+                txn.abort()
+
+    @read_transaction
+    def matches(self, record, txn, abort=False):
+        """
+        Count the number of entries in this index with the same key as 'record'
+
+        :param record: A template record containing the fields to search on
+        :type record: dict
+        :param txn: An optional transaction
+        :type txn: Transaction
+        :return: The number of matching entries
+        :rtype: int
+        """
+        try:
+            with self.cursor(txn) as cursor:
+                if not cursor.set_key(self._func(record)):
+                    return 0
+                return cursor.count() if self.duplicates else 1
+        finally:
+            if abort:
+                txn.abort()
+
+    def cursor(self, txn):
+        """
+        Return a cursor into the current index
 
         :param txn: Is an open Transaction 
         :type txn: Transaction
@@ -1070,7 +3167,10 @@ class Index(object):
         :return: True if the record was deleted
         :rtype: boolean
         """
-        return txn.delete(self._func(record), key, db=self._db)
+        deleted = True
+        for ikey in self.keys(record):
+            deleted = txn.delete(ikey, key, db=self._db) and deleted
+        return deleted
 
     def drop(self, txn):
         """
@@ -1089,6 +3189,18 @@ class Index(object):
         """
         return txn.drop(self._db, delete=False)
 
+    def remove(self, txn, entries):
+        """
+        Remove a batch of entries from the index, used for bulk deletes
+
+        :param txn: An open (write) transaction
+        :type txn: Transaction
+        :param entries: (index key, record key) pairs, ideally sorted
+        :type entries: list
+        """
+        for ikey, key in entries:
+            if not txn.delete(ikey, key, db=self._db): raise xWriteFail(self._name)
+
     def get(self, txn, record):
         """
         Read a single record from the index
@@ -1116,8 +3228,10 @@ class Index(object):
         :rtype: boolean
         """
         try:
-            ikey = self._func(record)
-            return txn.put(ikey, key.encode(), db=self._db)
+            key = key.encode()
+            for ikey in self.keys(record):
+                if not txn.put(ikey, key, db=self._db): return False
+            return True
         except KeyError:
             return False
 
@@ -1133,12 +3247,17 @@ class Index(object):
         :type old: dict
         :param rec: The record in it's amended state
         :type rec: dict
+        :raises: xWriteFail if the amended record is missing a field we need, as for append
         """
-        old_key = self._func(old)
-        new_key = self._func(rec)
-        if old_key != new_key:
-            if not txn.delete(old_key, key, db=self._db): raise xReindexNoKey1
-            if not txn.put(new_key, key, db=self._db): raise xReindexNoKey2
+        try:
+            old_keys = set(self.keys(old))
+            new_keys = set(self.keys(rec))
+        except KeyError:
+            raise xWriteFail(self._name)
+        for ikey in old_keys - new_keys:
+            if not txn.delete(ikey, key, db=self._db): raise xReindexNoKey1
+        for ikey in new_keys - old_keys:
+            if not txn.put(ikey, key, db=self._db): raise xReindexNoKey2
 
     #@property
     #def name(self):
@@ -1151,6 +3270,420 @@ class Index(object):
     #    return self._name
 
 
+class TextIndex(Index):
+    """
+    A full text (inverted) index, each word in the fields named by the index function is a key
+    in the index and the records containing it are it's duplicates. Words are lower cased runs
+    of letters and digits. With 'positions' the positions of each word in each record are kept
+    in a second database, these are used to rank records by how often words appear and to
+    match phrases.
+
+    :param context: A reference to the controlling Database object
+    :type context: Database
+    :param name: The name of the index we're working with
+    :type name: str
+    :param func: A format string naming the fields to index, i.e. '{name} {notes}'
+    :type func: str
+    :param conf: Configuration options for this index
+    :type conf: dict
+    """
+    _seekable = False
+
+    def __init__(self, ctx, name, func, conf, txn):
+        super().__init__(ctx, name, func, conf, txn)
+        self._order = list(dict.fromkeys(_spec_fields(func or '')))
+        self._positions = None
+        if self._conf.get('positions'):
+            key = self._conf['key'] + b'~pos'
+            self._positions = self._ctx.env.open_db(key, create=self._conf['create'], txn=txn)
+
+    def words(self, record):
+        """
+        Split the indexed fields of a record into words, fields may be strings or lists of strings
+
+        :param record: The record
+        :type record: dict
+        :return: The words in order
+        :rtype: list
+        """
+        words = []
+        for field in self._order:
+            value = record.get(field)
+            for text in value if isinstance(value, list) else [value]:
+                if isinstance(text, str):
+                    words += [word.encode() for word in _words(text.lower()) if len(word) <= _max_word]
+        return words
+
+    def keys(self, record):
+        if self._where and not _matches(record, self._where):
+            return ()
+        return set(self.words(record))
+
+    def _places(self, record):
+        """
+        Find the positions of each word in a record
+
+        :param record: The record
+        :type record: dict
+        :return: Positions by word
+        :rtype: dict
+        """
+        places = {}
+        if not self._where or _matches(record, self._where):
+            for place, word in enumerate(self.words(record)):
+                places.setdefault(word, []).append(place)
+        return places
+
+    def put(self, txn, key, record):
+        if not super().put(txn, key, record):
+            return False
+        if self._positions:
+            key = key.encode()
+            for word, places in self._places(record).items():
+                if not txn.put(word + b'\x00' + key, dumps(places).encode(), db=self._positions): return False
+        return True
+
+    def delete(self, txn, key, record):
+        deleted = super().delete(txn, key, record)
+        if self._positions:
+            for word in self.keys(record):
+                txn.delete(word + b'\x00' + key, db=self._positions)
+        return deleted
+
+    def save(self, txn, key, old, rec):
+        super().save(txn, key, old, rec)
+        if self._positions:
+            places = self._places(rec)
+            for word in self.keys(old):
+                if word not in places:
+                    txn.delete(word + b'\x00' + key, db=self._positions)
+            for word, where in places.items():
+                if not txn.put(word + b'\x00' + key, dumps(where).encode(), db=self._positions): raise xReindexNoKey2
+
+    def remove(self, txn, entries):
+        super().remove(txn, entries)
+        if self._positions:
+            for word, key in entries:
+                txn.delete(word + b'\x00' + key, db=self._positions)
+
+    def drop(self, txn):
+        super().drop(txn)
+        if self._positions:
+            txn.drop(self._positions, delete=True)
+
+    @read_transaction
+    def stats(self, txn, abort=False):
+        """
+        Storage statistics for this index, with 'positions' the pages and bytes used to hold the
+        positions are included and their own figures are returned as 'positions'
+
+        :param txn: An optional transaction
+        :type txn: Transaction
+        :return: LMDB stat() figures plus bytes and average_key (bytes per entry)
+        :rtype: dict
+        """
+        try:
+            result = super().stats(txn=txn)
+            if self._positions:
+                positions = result['positions'] = _stats(txn.stat(self._positions))
+                for field in ('branch_pages', 'leaf_pages', 'overflow_pages', 'bytes'):
+                    result[field] += positions[field]
+                result['average_key'] = result['bytes'] / result['entries'] if result['entries'] else 0
+            return result
+        finally:
+            if abort:
+                txn.abort()
+
+    def empty(self, txn):
+        if self._positions:
+            txn.drop(self._positions, delete=False)
+        return super().empty(txn)
+
+    def search(self, txn, query, mode='and', limit=maxsize, table=None):
+        """
+        Find the records matching a query, a query is a list of words, words ending in '*'
+        match any word they're a prefix of and words in double quotes must appear together
+        as a phrase (this needs 'positions'). Records are scored by the sum over the words they
+        match of tf * idf, where idf is log(1 + records / records containing the word) and tf
+        is the number of times the word appears (with 'positions', otherwise 1).
+
+        :param txn: An open transaction
+        :type txn: Transaction
+        :param query: The query, i.e. 'red fox*' or '"red fox" jumps'
+        :type query: str
+        :param mode: 'and' to match every word (or phrase), 'or' to match any
+        :type mode: str
+        :param limit: The maximum number of results
+        :type limit: int
+        :param table: The table's database, used to count the records for idf
+        :return: (record key, score) tuples, best first
+        :rtype: list
+        :raises: ValueError for an unknown mode, or a phrase without positions
+        """
+        if mode not in ('and', 'or'): raise ValueError('unknown mode: {}'.format(mode))
+        total = txn.stat(table)['entries'] if table else self.count(txn=txn)
+        terms = []
+        for phrase, word in _terms(query.lower()):
+            if phrase:
+                if not self._positions: raise ValueError('phrase search needs positions: {}'.format(self._name))
+                terms.append(self._phrase(txn, phrase, total))
+            else:
+                terms.append(self._postings(txn, word, total))
+        if not terms:
+            return []
+        scores = dict(terms[0])
+        for postings in terms[1:]:
+            if mode == 'and':
+                scores = {key: score + postings[key] for key, score in scores.items() if key in postings}
+            else:
+                for key, score in postings.items():
+                    scores[key] = scores.get(key, 0.0) + score
+        return sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:limit]
+
+    def _postings(self, txn, word, total):
+        """
+        Score the records containing a word, or any word starting with a prefix ('word*')
+
+        :param txn: An open transaction
+        :type txn: Transaction
+        :param word: The word
+        :type word: str
+        :param total: The number of records in the table
+        :type total: int
+        :return: Scores by record key
+        :rtype: dict
+        """
+        prefix = word.endswith('*')
+        word = word.rstrip('*').encode()
+        scores = {}
+        with self.cursor(txn) as cursor:
+            found = cursor.set_range(word) if prefix else cursor.set_key(word)
+            while found and cursor.key().startswith(word):
+                token = cursor.key()
+                idf = log(1 + total / cursor.count())
+                for key in cursor.iternext_dup():
+                    scores[key] = scores.get(key, 0.0) + idf * len(self._where_in(txn, token, key))
+                if not prefix:
+                    break
+                found = cursor.next_nodup()
+        return scores
+
+    def _phrase(self, txn, words, total):
+        """
+        Score the records containing a phrase, the sum of the scores of the words for the
+        records in which they appear next to each other
+
+        :param txn: An open transaction
+        :type txn: Transaction
+        :param words: The words of the phrase
+        :type words: list
+        :param total: The number of records in the table
+        :type total: int
+        :return: Scores by record key
+        :rtype: dict
+        """
+        postings = [self._postings(txn, word, total) for word in words]
+        scores = {}
+        for key in set.intersection(*(set(p) for p in postings)) if postings else ():
+            places = [set(self._where_in(txn, word.encode(), key)) for word in words]
+            if any(all(start + n in where for n, where in enumerate(places)) for start in places[0]):
+                scores[key] = sum(p[key] for p in postings)
+        return scores
+
+    def _where_in(self, txn, word, key):
+        """
+        Recover the positions of a word in a record, without 'positions' we just know it's there
+
+        :param txn: An open transaction
+        :type txn: Transaction
+        :param word: The word
+        :type word: bytes
+        :param key: The record key
+        :type key: bytes
+        :return: The positions
+        :rtype: list
+        """
+        if not self._positions:
+            return [0]
+        places = txn.get(word + b'\x00' + key, db=self._positions)
+        return loads(bytes(places)) if places else []
+
+
+class TrigramIndex(Index):
+    """
+    A trigram index, each (lower cased) three character sequence in a single string field is a
+    key in the index and the records containing it are it's duplicates. A substring or LIKE
+    pattern is matched by intersecting the records holding each of it's trigrams, starting with
+    the rarest, then checking the survivors against the field itself.
+
+    :param context: A reference to the controlling Database object
+    :type context: Database
+    :param name: The name of the index we're working with
+    :type name: str
+    :param func: A format string naming the field to index, i.e. '{host}'
+    :type func: str
+    :param conf: Configuration options for this index
+    :type conf: dict
+    """
+    _seekable = False
+
+    def __init__(self, ctx, name, func, conf, txn):
+        super().__init__(ctx, name, func, conf, txn)
+        if len(self._key_fields) != 1: raise ValueError('a trigram index needs a single field: {}'.format(func))
+        self._field = next(iter(self._key_fields))
+
+    def keys(self, record):
+        if self._where and not _matches(record, self._where):
+            return ()
+        return _trigrams(record.get(self._field))
+
+    def like(self, txn, pattern, table):
+        """
+        Find the records matching a LIKE pattern, if the pattern has no literal run of three or
+        more characters the index can't help and we check every record instead
+
+        :param txn: An open transaction
+        :type txn: Transaction
+        :param pattern: The pattern, '%' matches any characters, '_' any single character
+        :type pattern: str
+        :param table: The table's database
+        :return: (record key, record) tuples in key order (generator)
+        :rtype: tuple
+        """
+        match = regex(''.join(
+            '.*' if part == '%' else '.' if part == '_' else escape(part) for part in _like_parts(pattern)
+        ), IGNORECASE | DOTALL).fullmatch
+        trigrams = set()
+        for part in _like_parts(pattern):
+            if part not in ('%', '_'):
+                trigrams |= _trigrams(part)
+        if trigrams:
+            keys = self.candidates(txn, trigrams)
+        else:
+            with Cursor(table, txn) as cursor:
+                keys = list(cursor.iternext(values=False))
+        for key in keys:
+            record = loads(bytes(txn.get(key, db=table)))
+            value = record.get(self._field)
+            if isinstance(value, str) and match(value) and (not self._where or _matches(record, self._where)):
+                yield key, record
+
+    def candidates(self, txn, trigrams):
+        """
+        Find the keys of the records holding every one of a set of trigrams, we read the records
+        holding the rarest trigram then test each against the others
+
+        :param txn: An open transaction
+        :type txn: Transaction
+        :param trigrams: The trigrams
+        :type trigrams: set
+        :return: The record keys, sorted
+        :rtype: list
+        """
+        with self.cursor(txn) as cursor:
+            counts = []
+            for trigram in trigrams:
+                if not cursor.set_key(trigram):
+                    return []
+                counts.append((cursor.count(), trigram))
+            counts.sort()
+            cursor.set_key(counts[0][1])
+            keys = list(cursor.iternext_dup())
+            for count, trigram in counts[1:]:
+                keys = [key for key in keys if cursor.set_key_dup(trigram, key)]
+                if not keys:
+                    break
+        return keys
+
+
+def _index_class(conf):
+    """
+    Choose the class for an index based on it's configuration
+
+    :param conf: The index configuration
+    :type conf: dict
+    :return: The class
+    :rtype: type
+    """
+    if conf.get('text'):
+        return TextIndex
+    return TrigramIndex if conf.get('trigram') else Index
+
+
+def _trigrams(value):
+    """
+    Split a string into it's (lower cased) trigrams, anything else has none
+
+    :param value: The string
+    :type value: str
+    :return: The trigrams
+    :rtype: set
+    """
+    if not isinstance(value, str):
+        return set()
+    value = value.lower()
+    return {value[i:i + 3].encode() for i in range(len(value) - 2)}
+
+
+def _terms(query):
+    """
+    Split a text query into words and phrases (in double quotes)
+
+    :param query: The query
+    :type query: str
+    :return: (phrase words, None) or (None, word) tuples (generator)
+    :rtype: tuple
+    """
+    for phrase, word in _query_terms.findall(query):
+        if phrase:
+            words = _words(phrase)
+            if len(words) > 1:
+                yield words, None
+            elif words:
+                yield None, words[0]
+        else:
+            yield None, word
+
+
+_words = regex(r'\w+').findall
+_like_parts = regex(r'%|_|[^%_]+').findall
+_query_terms = regex(r'"([^"]*)"|(\w+\*?)')
+_max_word = 255
+_databases = WeakSet()
+_inherited = []
+
+
+def _readers(env):
+    """
+    Count the read transactions this process has open in an environment
+
+    :param env: The environment
+    :type env: Environment
+    :return: The number of transactions
+    :rtype: int
+    """
+    pid = str(getpid())
+    count = 0
+    for line in env.readers().splitlines()[1:]:
+        fields = line.split()
+        if len(fields) == 3 and fields[0] == pid and fields[2] != '-':
+            count += 1
+    return count
+
+
+def _after_fork():
+    """
+    Mark every database that was open when we forked as needing new handles, called in the child
+    """
+    for database in list(_databases):
+        if getattr(database, '_env', None):
+            database._after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
 def _debug(self, msg):
     """
     Display a debug message with current line number and function name
@@ -1180,6 +3713,453 @@ def _anonymous(text):
     return scope['func']
 
 
+def _trace(trace):
+    """
+    Reset the counters in a trace (if we have one)
+
+    :param trace: The trace, or None
+    :type trace: dict
+    """
+    if trace is not None:
+        trace.update(scanned=0, fetched=0, decode=0.0)
+
+
+def _traced(value, trace, fetched=False):
+    """
+    Decode a record, accounting for it in 'trace'
+
+    :param value: The encoded record
+    :type value: bytes
+    :param trace: The trace to update
+    :type trace: dict
+    :param fetched: Whether the record was fetched from the table by key (i.e. via an index)
+    :type fetched: bool
+    :return: The record
+    :rtype: dict
+    """
+    began = time()
+    record = loads(bytes(value))
+    trace['decode'] += time() - began
+    trace['scanned'] += 1
+    if fetched:
+        trace['fetched'] += 1
+    return record
+
+
+def _context(names, args, kwargs):
+    """
+    Describe the call to a table operation for a metrics sink that wants the detail
+
+    :param names: The names of the operation's arguments
+    :type names: tuple
+    :param args: The positional arguments
+    :type args: tuple
+    :param kwargs: The keyword arguments
+    :type kwargs: dict
+    :return: caller (file:line (function)) and params (the arguments by name)
+    :rtype: dict
+    """
+    frame = _getframe(3)    # _context <- metered <- read/write_transaction <- caller
+    params = dict(zip(names[1:], args[1:]))
+    params.update((k, v) for k, v in kwargs.items() if k not in ['txn', 'abort', 'trace'])
+    caller = '{}:{} ({})'.format(frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name)
+    return {'caller': caller, 'params': params}
+
+
+def _metered(metrics, op, table, index, start, records, trace, context):
+    """
+    Pass on the records from a generator, reporting the operation to 'metrics' when we're done
+
+    :param metrics: The metrics sink
+    :type metrics: Metrics
+    :param op: The name of the operation
+    :type op: str
+    :param table: The name of the table
+    :type table: str
+    :param index: The name of the index or None
+    :type index: str
+    :param start: When the operation started
+    :type start: float
+    :param records: The records generated by the operation
+    :type records: generator
+    :param trace: Updated with the number of records 'scanned' by the operation (or None)
+    :type trace: dict
+    :param context: The caller and parameters of the operation (or None)
+    :type context: dict
+    :return: The next record (generator)
+    :rtype: dict
+    """
+    returned = 0
+    try:
+        for record in records:
+            returned += 1
+            yield record
+    finally:
+        records.close()
+        scanned = trace.get('scanned', returned) if trace is not None else returned
+        metrics.operation(op, table, index, time() - start, scanned, returned, context)
+
+
+def _field_name(field):
+    """
+    Recover the top level field from a format string replacement field, i.e. 'a' from 'a.b[0]'
+
+    :param field: The field as it appears in the format string
+    :type field: str
+    :return: The field name
+    :rtype: str
+    """
+    return field.split('.')[0].split('[')[0]
+
+
+def _spec_fields(spec):
+    """
+    Recover the top level fields used by a format string, including those used in format specs
+    i.e. 'age' and 'width' from '{age:{width}}'
+
+    :param spec: The format string
+    :type spec: str
+    :return: The field names (generator)
+    :rtype: str
+    """
+    for _, field, format_spec, _ in Formatter().parse(spec):
+        if field:
+            yield _field_name(field)
+        if format_spec:
+            yield from _spec_fields(format_spec)
+
+
+def _changed(old, rec, indexes):
+    """
+    Find the fields that indexes depend on which differ between two versions of a record
+
+    :param old: The record as it was
+    :type old: dict
+    :param rec: The record as it is now
+    :type rec: dict
+    :param indexes: The indexes we're interested in
+    :type indexes: iterable
+    :return: The names of the fields that have changed
+    :rtype: set
+    """
+    fields = set()
+    for index in indexes:
+        fields |= index.fields
+    return {field for field in fields if old.get(field, _missing) != rec.get(field, _missing)}
+
+
+_missing = object()
+_index_conf = frozenset(['key', 'dupsort', 'create'])
+
+
+def _matches(record, query):
+    """
+    Test a record against a filter, a filter maps fields to values or to conditions made up
+    of the operators $eq, $ne, $gt, $gte, $lt, $lte, $in, $nin and $exists, i.e.
+    {'active': True, 'age': {'$gte': 18}}. A value matches a list field if it's in the list.
+
+    :param record: The record to test
+    :type record: dict
+    :param query: The filter
+    :type query: dict
+    :return: True if the record matches
+    :rtype: bool
+    """
+    for field, condition in query.items():
+        value = record.get(field, _missing)
+        if _operators(condition):
+            for op, operand in condition.items():
+                if not _compare(op, value, operand):
+                    return False
+        elif not _compare('$eq', value, condition):
+            return False
+    return True
+
+
+def _values(query):
+    """
+    Recover the fields a filter requires to have a specific value
+
+    :param query: The filter
+    :type query: dict
+    :return: The fields and their values
+    :rtype: dict
+    """
+    values = {}
+    for field, condition in query.items():
+        if not _operators(condition):
+            values[field] = condition
+        elif '$eq' in condition:
+            values[field] = condition['$eq']
+    return values
+
+
+def _operators(condition):
+    """
+    Test whether a filter condition is a set of operators rather than a value
+
+    :param condition: The condition
+    :return: True if the condition is a dict of operators
+    :rtype: bool
+    """
+    return isinstance(condition, dict) and bool(condition) and all(key.startswith('$') for key in condition)
+
+
+def _compare(op, value, operand):
+    """
+    Apply a filter operator to a value
+
+    :param op: The operator, i.e. '$gt'
+    :type op: str
+    :param value: The value from the record, _missing if the field isn't there
+    :param operand: The value from the filter
+    :return: True if the value satisfies the operator
+    :rtype: bool
+    :raises: ValueError for an unknown operator
+    """
+    if op == '$exists':
+        return (value is not _missing) == bool(operand)
+    if op == '$eq':
+        return value == operand or (isinstance(value, list) and operand in value)
+    if op == '$ne':
+        return not _compare('$eq', value, operand)
+    if op == '$in':
+        return any(_compare('$eq', value, item) for item in operand)
+    if op == '$nin':
+        return not _compare('$in', value, operand)
+    if op not in _ranges: raise ValueError('unknown operator: {}'.format(op))
+    if value is _missing:
+        return False
+    try:
+        return _ranges[op](value, operand)
+    except TypeError:
+        return False
+
+
+_ranges = {
+    '$gt': lambda a, b: a > b,
+    '$gte': lambda a, b: a >= b,
+    '$lt': lambda a, b: a < b,
+    '$lte': lambda a, b: a <= b
+}
+
+
+def _fields_delta(old, rec):
+    """
+    A field level difference between two versions of a record, as update operators
+
+    :param old: The record as it was
+    :type old: dict
+    :param rec: The record as it is now
+    :type rec: dict
+    :return: $set for fields added or changed, $unset for fields removed
+    :rtype: dict
+    """
+    ops = {}
+    changed = {field: value for field, value in rec.items() if old.get(field, _missing) != value}
+    if changed:
+        ops['$set'] = changed
+    removed = {field: 1 for field in old if field not in rec}
+    if removed:
+        ops['$unset'] = removed
+    return ops
+
+
+def _binlog_encode(entry):
+    """
+    Encode a binlog entry, we use ujson (as we do for records) so anything a table will accept
+    can also be logged. Keys (bytes) are passed as strings and restored by _binlog_decode.
+    Entries are text rather than a binary encoding as BSON (the binary encoding we have to
+    hand) only accepts string keys in documents, so records a table accepts (i.e. with integer
+    keys) couldn't be logged.
+
+    :param entry: The binlog entry
+    :type entry: dict
+    :return: The encoded entry
+    :rtype: bytes
+    """
+    cmd = entry['cmd']
+    if cmd == 'add':
+        doc = entry['doc']
+        key = doc['_id']
+        doc['_id'] = key.decode()
+        try:
+            return dumps(entry).encode()
+        finally:
+            doc['_id'] = key
+    if cmd == 'del':
+        entry['keys'] = [key.decode() if isinstance(key, bytes) else key for key in entry['keys']]
+    elif cmd in ('upd', 'opr', 'img'):
+        entry['key'] = entry['key'].decode()
+    elif cmd == 'dlr':
+        entry['lo'], entry['hi'] = entry['lo'].decode(), entry['hi'].decode()
+    return dumps(entry).encode()
+
+
+def _binlog_decode(value):
+    """
+    Decode a binlog entry written by _binlog_encode
+
+    :param value: The encoded entry
+    :type value: bytes
+    :return: The binlog entry
+    :rtype: dict
+    """
+    entry = loads(bytes(value).decode())
+    cmd = entry['cmd']
+    if cmd == 'add':
+        entry['doc']['_id'] = entry['doc']['_id'].encode()
+    elif cmd == 'del':
+        entry['keys'] = [key.encode() for key in entry['keys']]
+    elif cmd in ('upd', 'opr', 'img'):
+        entry['key'] = entry['key'].encode()
+    elif cmd == 'dlr':
+        entry['lo'], entry['hi'] = entry['lo'].encode(), entry['hi'].encode()
+    return entry
+
+
+def _binlog_chain(since, entries):
+    """
+    Check binlog entries are continuous, each transaction logged to a separate environment
+    records the id of the transaction before it ('prv') so we can tell if one has gone missing
+
+    :param since: The transaction we're starting after (if known)
+    :type since: str
+    :param entries: The (transaction id, entry) tuples to check
+    :type entries: generator
+    :return: The next transaction id and entry (generator)
+    :rtype: tuple
+    :raises: xBinlogGap if a transaction is missing
+    """
+    last = since or None
+    for tid, entry in entries:
+        if tid != last:
+            if last and 'prv' in entry and entry['prv'] != last:
+                raise xBinlogGap('transaction(s) missing between {} and {}'.format(last, tid))
+            last = tid
+        yield tid, entry
+
+
+def _binlog_id(txn, db):
+    """
+    Generate a new transaction id for the binlog, ids must always sort after the last one written
+
+    :param txn: An open (write) transaction
+    :type txn: Transaction
+    :param db: The binlog database
+    :return: A new transaction id
+    :rtype: str
+    """
+    oid = str(ObjectId())
+    with Cursor(db, txn) as cursor:
+        if cursor.last():
+            last = cursor.key()[:24].decode()
+            if oid <= last:
+                oid = '{:024x}'.format(int(last, 16) + 1)
+    return oid
+
+
+def _replay_bound(until):
+    """
+    Convert the 'until' of a replay into an (exclusive) transaction id bound, times are only
+    accurate to the second as that's the resolution of the timestamp in a transaction id
+
+    :param until: A transaction id, datetime or time() value
+    :type until: str|ObjectId|datetime|float
+    :return: The bound, or None for no bound
+    :rtype: str
+    """
+    if until is None:
+        return None
+    if isinstance(until, (int, float)):
+        until = datetime.fromtimestamp(int(until), timezone.utc)
+    if isinstance(until, datetime):
+        return str(ObjectId.from_datetime(until.replace(microsecond=0) + timedelta(seconds=1)))
+    return str(until) + '~'
+
+
+def _purge(txn, db, bound, limit):
+    """
+    Remove entries from the start of the binlog, we only stop at the end of a transaction
+
+    :param txn: An open (write) transaction
+    :type txn: Transaction
+    :param db: The binlog database
+    :param bound: Remove entries with keys lower than this
+    :type bound: bytes
+    :param limit: Stop at the first transaction boundary after this many entries
+    :type limit: int
+    :return: The number of entries removed
+    :rtype: int
+    """
+    count = 0
+    last = None
+    with Cursor(db, txn) as cursor:
+        cursor.first()
+        while True:
+            key = cursor.key()
+            if not key or key >= bound:
+                break
+            tid = key[:24]
+            if count >= limit and tid != last:
+                break
+            cursor.delete()
+            count += 1
+            last = tid
+    return count
+
+
+def _stat_bytes(stat):
+    """
+    Calculate the space used by a database from it's statistics
+
+    :param stat: The result of a call to stat()
+    :type stat: dict
+    :return: The number of bytes in use
+    :rtype: int
+    """
+    return _stat_pages(stat) * stat['psize']
+
+
+def _stats(stat):
+    """
+    Add bytes used and bytes per entry to the results of a call to stat()
+
+    :param stat: The result of a call to stat()
+    :type stat: dict
+    :return: The statistics
+    :rtype: dict
+    """
+    stat = dict(stat)
+    stat['bytes'] = _stat_bytes(stat)
+    stat['average_key'] = stat['bytes'] / stat['entries'] if stat['entries'] else 0
+    return stat
+
+
+def _stat_pages(stat):
+    """
+    The number of pages used according to a call to stat()
+
+    :param stat: The result of a call to stat(), or None
+    :type stat: dict
+    :return: The number of pages
+    :rtype: int
+    """
+    return stat['branch_pages'] + stat['leaf_pages'] + stat['overflow_pages'] if stat else 0
+
+
+def _map_used(env):
+    """
+    Work out how much of an environment's map is in use
+
+    :param env: An open environment
+    :type env: Environment
+    :return: The number of bytes used
+    :rtype: int
+    """
+    return (env.info()['last_pgno'] + 1) * env.stat()['psize']
+
+
 def _index_name(self, name):
     """
     Generate the name of the object in which to store index records
@@ -1230,6 +4210,11 @@ class xIndexMissing(Exception):
     pass
 
 
+class xIndexUnsupported(Exception):
+    """Exception - the index doesn't support this operation"""
+    pass
+
+
 class xNotFound(Exception):
     """Exception - expected record was not found"""
     pass
@@ -1257,3 +4242,19 @@ class xDropFail(Exception):
 
 class xNoKey(Exception):
     """No key was specified for operation"""
+
+
+class xReplicaFail(Exception):
+    """Exception - replication failed"""
+
+
+class xBinlogGap(Exception):
+    """Exception - transaction(s) missing from the binlog"""
+
+
+class xMapFull(Exception):
+    """Exception - the map is full and can't be grown"""
+
+
+class xCompactFail(Exception):
+    """Exception - unable to compact the database"""
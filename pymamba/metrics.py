@@ -0,0 +1,278 @@
+"""
+Metrics for PyMamba, a Database reports the latency of table operations and transactions to
+a metrics sink. By default there is no sink and nothing is measured, otherwise pass one of the
+sinks below (or your own subclass of Metrics) as Database(..., metrics=sink).
+
+A SlowQueryLog keeps the operations that took longer than a threshold along with where they
+were called from and their parameters, use Fanout to report to more than one sink.
+
+Operations are reported by name (append, save, delete, get, seek, seek_one, find, range) along
+with the table and index (if any) they used. For generators (seek, find, range) the time is
+measured from the call until the generator is exhausted or closed, so it includes the time
+the caller spends consuming the results.
+"""
+from bisect import bisect_left
+from collections import deque
+from threading import Lock
+from time import time
+
+BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+           0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metrics(object):
+    """
+    The metrics interface, this implementation does nothing. Sinks that set 'detail' are also
+    given the context (caller and parameters) of each operation, this is relatively expensive.
+    """
+    detail = False
+
+    def operation(self, op, table, index, seconds, scanned=None, returned=None, context=None):
+        """
+        Record a table operation
+
+        :param op: The operation, i.e. 'append'
+        :type op: str
+        :param table: The name of the table
+        :type table: str
+        :param index: The name of the index used, or None
+        :type index: str
+        :param seconds: How long the operation took
+        :type seconds: float
+        :param scanned: For reads, the number of records read
+        :type scanned: int
+        :param returned: For reads, the number of records returned
+        :type returned: int
+        :param context: caller (file:line (function)) and params, only if we want the 'detail'
+        :type context: dict
+        """
+        pass
+
+    def transaction(self, seconds, commit):
+        """
+        Record a transaction (begin() .. end of the 'with')
+
+        :param seconds: How long the transaction took, including the commit
+        :type seconds: float
+        :param commit: How long the commit took
+        :type commit: float
+        """
+        pass
+
+
+class Histogram(object):
+    """
+    A cumulative histogram of observations, compatible with Prometheus histograms
+
+    :param buckets: The upper bounds of the buckets
+    :type buckets: tuple
+    """
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """
+        Add an observation
+
+        :param value: The value observed
+        :type value: float
+        """
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """
+        Generate the cumulative count for each bucket, the last bucket is +Inf
+
+        :return: The upper bound (as a string) and count (generator)
+        :rtype: tuple
+        """
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            yield str(bound), total
+
+
+class Prometheus(Metrics):
+    """
+    Collect counts and latency histograms, render() returns them in the Prometheus text format
+
+    :param prefix: The prefix for the names of our metrics
+    :type prefix: str
+    :param buckets: The upper bounds of the histogram buckets (seconds)
+    :type buckets: tuple
+    """
+    def __init__(self, prefix='pymamba', buckets=BUCKETS):
+        self._prefix = prefix
+        self._buckets = buckets
+        self._lock = Lock()
+        self._operations = {}
+        self._scanned = {}
+        self._returned = {}
+        self._transactions = Histogram(buckets)
+        self._commits = Histogram(buckets)
+
+    def operation(self, op, table, index, seconds, scanned=None, returned=None, context=None):
+        key = (op, table, index or '')
+        with self._lock:
+            histogram = self._operations.get(key)
+            if not histogram:
+                histogram = self._operations[key] = Histogram(self._buckets)
+            histogram.observe(seconds)
+            if scanned is not None:
+                self._scanned[key] = self._scanned.get(key, 0) + scanned
+                self._returned[key] = self._returned.get(key, 0) + returned
+
+    def transaction(self, seconds, commit):
+        with self._lock:
+            self._transactions.observe(seconds)
+            self._commits.observe(commit)
+
+    def render(self):
+        """
+        Render our metrics in the Prometheus text exposition format
+
+        :return: The metrics
+        :rtype: str
+        """
+        lines = []
+        name = self._prefix + '_operation_seconds'
+        with self._lock:
+            lines += ['# HELP {} Latency of table operations'.format(name), '# TYPE {} histogram'.format(name)]
+            for key in sorted(self._operations):
+                labels = 'op="{}",table="{}",index="{}"'.format(*key)
+                lines += self._histogram(name, labels, self._operations[key])
+            for metric, values, text in [
+                ('_records_scanned_total', self._scanned, 'Records read by table operations'),
+                ('_records_returned_total', self._returned, 'Records returned by table operations')
+            ]:
+                metric = self._prefix + metric
+                lines += ['# HELP {} {}'.format(metric, text), '# TYPE {} counter'.format(metric)]
+                for key in sorted(values):
+                    lines.append('{}{{op="{}",table="{}",index="{}"}} {}'.format(metric, *key, values[key]))
+            for metric, histogram, text in [
+                ('_transaction_seconds', self._transactions, 'Duration of transactions'),
+                ('_commit_seconds', self._commits, 'Time taken to commit transactions')
+            ]:
+                metric = self._prefix + metric
+                lines += ['# HELP {} {}'.format(metric, text), '# TYPE {} histogram'.format(metric)]
+                lines += self._histogram(metric, '', histogram)
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _histogram(name, labels, histogram):
+        """
+        Render a single histogram
+
+        :param name: The name of the metric
+        :type name: str
+        :param labels: The labels to apply to each line
+        :type labels: str
+        :param histogram: The histogram to render
+        :type histogram: Histogram
+        :return: The lines of text
+        :rtype: list
+        """
+        sep = ',' if labels else ''
+        lines = ['{}_bucket{{{}{}le="{}"}} {}'.format(name, labels, sep, bound, count)
+                 for bound, count in histogram.cumulative()]
+        labels = '{{{}}}'.format(labels) if labels else ''
+        lines.append('{}_sum{} {}'.format(name, labels, histogram.sum))
+        lines.append('{}_count{} {}'.format(name, labels, histogram.count))
+        return lines
+
+
+class RingBuffer(Metrics):
+    """
+    Keep the most recent events in memory, each event is a dict with the time it was recorded,
+    the 'type' ('operation' or 'transaction') and the arguments it was reported with.
+
+    :param size: The number of events to keep
+    :type size: int
+    """
+    def __init__(self, size=10000):
+        self._events = deque(maxlen=size)
+
+    def operation(self, op, table, index, seconds, scanned=None, returned=None, context=None):
+        self._events.append({
+            'type': 'operation', 'when': time(), 'op': op, 'table': table, 'index': index,
+            'seconds': seconds, 'scanned': scanned, 'returned': returned
+        })
+
+    def transaction(self, seconds, commit):
+        self._events.append({'type': 'transaction', 'when': time(), 'seconds': seconds, 'commit': commit})
+
+    def events(self):
+        """
+        Recover the events we're holding, oldest first
+
+        :return: The events
+        :rtype: list
+        """
+        return list(self._events)
+
+
+class SlowQueryLog(Metrics):
+    """
+    Keep (and optionally pass on) operations that take longer than 'threshold', each entry is
+    a dict with the time it was recorded, the operation, table, index, seconds, scanned and
+    returned along with the caller (file:line (function)) and the parameters it was called with.
+
+    :param threshold: Log operations that take longer than this (seconds)
+    :type threshold: float
+    :param size: The number of entries to keep
+    :type size: int
+    :param callback: Called with each new entry
+    :type callback: function
+    """
+    detail = True
+
+    def __init__(self, threshold=0.1, size=1000, callback=None):
+        self._threshold = threshold
+        self._callback = callback
+        self._entries = deque(maxlen=size)
+
+    def operation(self, op, table, index, seconds, scanned=None, returned=None, context=None):
+        if seconds < self._threshold:
+            return
+        entry = {
+            'when': time(), 'op': op, 'table': table, 'index': index, 'seconds': seconds,
+            'scanned': scanned, 'returned': returned
+        }
+        entry.update(context or {})
+        self._entries.append(entry)
+        if self._callback:
+            self._callback(entry)
+
+    def entries(self):
+        """
+        Recover the entries we're holding, oldest first
+
+        :return: The entries
+        :rtype: list
+        """
+        return list(self._entries)
+
+
+class Fanout(Metrics):
+    """
+    Pass everything on to a number of sinks, i.e. Fanout(Prometheus(), SlowQueryLog())
+
+    :param sinks: The sinks to pass on to
+    :type sinks: Metrics
+    """
+    def __init__(self, *sinks):
+        self._sinks = sinks
+        self.detail = any(sink.detail for sink in sinks)
+
+    def operation(self, op, table, index, seconds, scanned=None, returned=None, context=None):
+        for sink in self._sinks:
+            sink.operation(op, table, index, seconds, scanned, returned, context if sink.detail else None)
+
+    def transaction(self, seconds, commit):
+        for sink in self._sinks:
+            sink.transaction(seconds, commit)
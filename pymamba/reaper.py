@@ -0,0 +1,117 @@
+"""
+Expiry for PyMamba, a Reaper deletes the records that have expired according to the TTL indexes
+of a database's tables, either on demand (poll) or periodically from a background thread.
+
+    reaper = Reaper(db, rate=1000).start(interval=60)
+    ...
+    reaper.stop()
+
+Expired records are deleted in small chunks, each in it's own write transaction, so other
+writers are only held up briefly. Run the reaper against the primary, replicas see the
+deletions via the binlog.
+"""
+from threading import Event, Thread
+from time import time
+
+
+class Reaper(object):
+    """
+    Delete expired records from the tables of a database, see Table.expire
+
+    :param database: The database to reap
+    :type database: Database
+    :param tables: The names of the tables to reap, the default is every table
+    :type tables: list
+    :param chunk_size: The number of records to delete per write transaction
+    :type chunk_size: int
+    :param rate: The maximum number of records to delete per second (per table), None for no limit
+    :type rate: float
+    :param callback: Called with the results of each poll that expires something
+    :type callback: function
+    """
+    def __init__(self, database, tables=None, chunk_size=1000, rate=None, callback=None):
+        self._db = database
+        self._tables = tables
+        self._chunk_size = chunk_size
+        self._rate = rate
+        self._callback = callback
+        self._stop = None
+        self._thread = None
+        self._expired = 0
+        self._reclaimed = 0
+        self._polled = None
+
+    def poll(self):
+        """
+        Expire records from every table that has a TTL index
+
+        :return: expired (records), reclaimed (bytes), elapsed (seconds) and tables (by name, see Table.expire)
+        :rtype: dict
+        """
+        start = time()
+        result = {'expired': 0, 'reclaimed': 0, 'tables': {}}
+        for name in self._tables or self._db.tables:
+            table = self._db.table(name)
+            if not any(index.ttl for index in table._indexes.values()):
+                continue
+            stats = result['tables'][name] = table.expire(chunk_size=self._chunk_size, rate=self._rate)
+            result['expired'] += stats['expired']
+            result['reclaimed'] += stats['reclaimed']
+        result['elapsed'] = time() - start
+        self._expired += result['expired']
+        self._reclaimed += result['reclaimed']
+        self._polled = time()
+        if result['expired'] and self._callback:
+            self._callback(result)
+        return result
+
+    def run(self, interval=60.0, stop=None):
+        """
+        Keep expiring records until 'stop' is set, polling every 'interval' seconds
+
+        :param interval: How long to wait (seconds) between polls
+        :type interval: float
+        :param stop: An Event used to stop the reaper
+        :type stop: Event
+        """
+        stop = stop or Event()
+        while not stop.is_set():
+            self.poll()
+            stop.wait(interval)
+
+    def start(self, interval=60.0):
+        """
+        Run the reaper in a background (daemon) thread
+
+        :param interval: How long to wait (seconds) between polls
+        :type interval: float
+        :return: The reaper
+        :rtype: Reaper
+        """
+        self._stop = Event()
+        self._thread = Thread(target=self.run, args=(interval, self._stop), daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop the background thread, waiting for the current poll to finish
+        """
+        if self._thread:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def status(self):
+        """
+        Report on the work this reaper has done
+
+        :return: expired (records), reclaimed (bytes), polled (time) and running
+        :rtype: dict
+        """
+        return {
+            'expired': self._expired,
+            'reclaimed': self._reclaimed,
+            'polled': self._polled,
+            'running': self._thread is not None
+        }
@@ -0,0 +1,225 @@
+"""
+Read replicas for PyMamba, a Replica tails the binlog of a primary database and applies
+each transaction to a second (local) database. The primary can either be a Database opened
+by the caller (on the same file, or a copy of it) or reached over a Unix socket via a
+BinlogServer.
+"""
+from socket import socket, AF_UNIX, SOCK_STREAM
+from socketserver import ThreadingUnixStreamServer, StreamRequestHandler
+from struct import pack, unpack
+from sys import maxsize
+from threading import Event
+from time import time
+from bson.objectid import ObjectId
+from ujson import loads, dumps
+from . import _binlog_decode, _binlog_chain, xReplicaFail
+
+
+class Replica(object):
+    """
+    A follower that applies the binlog of a primary database to a local database
+
+    :param database: The (local) database we're replicating into
+    :type database: Database
+    :param source: The primary, a Database (opened on the primary or a copy) or a SocketSource
+    :type source: Database|SocketSource
+    :param name: The name under which our checkpoint is stored
+    :type name: str
+    :param batch: The maximum number of transactions to apply in one write transaction
+    :type batch: int
+    """
+    def __init__(self, database, source, name='primary', batch=100):
+        self._db = database
+        self._source = source
+        self._key = '~replica:{}'.format(name).encode()
+        self._batch = batch
+        self._applied = 0
+        self._entries = 0
+        self._polled = None
+
+    @property
+    def checkpoint(self):
+        """
+        PROPERTY - The id of the last primary transaction we applied
+
+        :getter: A transaction id or None
+        :type: str
+        """
+        with self._db._begin() as txn:
+            value = txn.get(self._key, db=self._db._metadata)
+        return value.decode() if value else None
+
+    def poll(self):
+        """
+        Apply the next batch of transactions from the primary
+
+        :return: The number of transactions applied
+        :rtype: int
+        """
+        applied = 0
+        checkpoint = self.checkpoint
+        entries = self._source.entries(checkpoint)
+        try:
+            with self._db.begin() as transaction:
+                for tid, entry in entries:
+                    if tid != checkpoint:
+                        if applied >= self._batch:
+                            break
+                        checkpoint = tid
+                        applied += 1
+                    self._db.apply([entry])
+                    self._entries += 1
+                if applied:
+                    if not transaction.txn.put(self._key, checkpoint.encode(), db=self._db._metadata):
+                        raise xReplicaFail('unable to write checkpoint')
+        finally:
+            entries.close()
+        self._applied += applied
+        self._polled = time()
+        return applied
+
+    def run(self, interval=1.0, stop=None):
+        """
+        Keep applying transactions until 'stop' is set, pausing when we've caught up
+
+        :param interval: How long to wait (seconds) when there's nothing to do
+        :type interval: float
+        :param stop: An Event used to stop the replica
+        :type stop: Event
+        """
+        stop = stop or Event()
+        while not stop.is_set():
+            if not self.poll():
+                stop.wait(interval)
+
+    def status(self):
+        """
+        Report on the state of this replica, 'lag' is the time difference (seconds) between
+        the last transaction on the primary and the last transaction we've applied.
+
+        :return: checkpoint, tail, lag, applied (transactions), entries and polled (time)
+        :rtype: dict
+        """
+        checkpoint = self.checkpoint
+        tail = self._source.tail()
+        lag = 0.0
+        if tail and tail != checkpoint:
+            lag = ObjectId(tail).generation_time.timestamp()
+            if checkpoint:
+                lag -= ObjectId(checkpoint).generation_time.timestamp()
+            else:
+                lag = time() - lag
+        return {
+            'checkpoint': checkpoint,
+            'tail': tail,
+            'lag': lag,
+            'applied': self._applied,
+            'entries': self._entries,
+            'polled': self._polled
+        }
+
+
+class SocketSource(object):
+    """
+    Read the binlog of a primary via a BinlogServer listening on a Unix socket
+
+    :param path: The path of the socket
+    :type path: str
+    :param limit: The maximum number of transactions to request at once
+    :type limit: int
+    """
+    def __init__(self, path, limit=1000):
+        self._path = path
+        self._limit = limit
+
+    def entries(self, since=None):
+        """
+        Generate the entries held on the primary, see Database.entries
+
+        :param since: Only return transactions logged after this transaction id
+        :type since: str
+        :return: The next transaction id and entry (generator)
+        :rtype: tuple
+        :raises: xBinlogGap if a transaction is missing from the log
+        """
+        frames = self._request({'op': 'txn', 'since': since, 'limit': self._limit})
+        return _binlog_chain(since, ((frame[:24].decode(), _binlog_decode(frame[24:])) for frame in frames))
+
+    def tail(self):
+        """
+        Recover the id of the last transaction on the primary
+
+        :return: A transaction id or None
+        :rtype: str
+        """
+        for frame in self._request({'op': 'tail'}):
+            return loads(frame.decode())['id']
+
+    def _request(self, request):
+        """
+        Send a request to the server and generate the frames that come back
+
+        :param request: The request to send
+        :type request: dict
+        :return: The next frame (generator)
+        :rtype: bytes
+        """
+        with socket(AF_UNIX, SOCK_STREAM) as sock:
+            sock.connect(self._path)
+            sock.sendall(dumps(request).encode() + b'\n')
+            with sock.makefile('rb') as stream:
+                while True:
+                    head = stream.read(4)
+                    if len(head) != 4: raise xReplicaFail('connection closed by server')
+                    size = unpack('>I', head)[0]
+                    if not size:
+                        break
+                    yield stream.read(size)
+
+
+class BinlogServer(ThreadingUnixStreamServer):
+    """
+    Serve the binlog of a database to SocketSource clients, use serve_forever() to run it
+
+    :param database: The database whose binlog we're serving
+    :type database: Database
+    :param path: The path of the socket to listen on
+    :type path: str
+    """
+    daemon_threads = True
+
+    def __init__(self, database, path):
+        self.database = database
+        super().__init__(path, _BinlogHandler)
+
+
+class _BinlogHandler(StreamRequestHandler):
+    """
+    Handle a single request, each frame is a 4 byte length followed by a payload, for
+    transactions the payload is the transaction id followed by an encoded entry
+    """
+    def handle(self):
+        request = loads(self.rfile.readline().decode())
+        try:
+            if request.get('op') == 'tail':
+                self._send(dumps({'id': self.server.database.tail()}).encode())
+            else:
+                limit = request.get('limit') or maxsize
+                entries = self.server.database._scan(request.get('since'))
+                last, count = None, 0
+                try:
+                    for tid, value in entries:
+                        if tid != last:
+                            if count >= limit:
+                                break
+                            last = tid
+                            count += 1
+                        self._send(tid.encode() + value)
+                finally:
+                    entries.close()
+            self.wfile.write(pack('>I', 0))
+        except (BrokenPipeError, ConnectionResetError):
+            pass    # the client has all it wanted
+
+    def _send(self, frame):
+        self.wfile.write(pack('>I', len(frame)) + frame)
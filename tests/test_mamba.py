@@ -1,8 +1,18 @@
 #!/usr/bin/python3
 
 import unittest
-from pymamba import Database, Table, _debug, xIndexMissing, xWriteFail, xTableMissing, size_mb, size_gb
+from pymamba import Database, DBTransaction, Index, Table, _debug, xIndexMissing, xWriteFail, xTableMissing, xBinlogGap, size_mb, size_gb, \
+    _purge, _stat_bytes, _stat_pages, xMapFull, xIndexUnsupported
+from lmdb import MapFullError, ReadonlyError
 from subprocess import call
+from os import makedirs
+import os
+from threading import Thread, Timer
+from asyncio import new_event_loop
+from collections import OrderedDict
+from unittest.mock import patch
+from ujson_delta import diff
+from math import log
 
 
 class UnitTests(unittest.TestCase):
@@ -49,6 +59,9 @@ class UnitTests(unittest.TestCase):
                     del row['_id']
                 table.append(dict(row))
 
+    def txn_ids(self, db):
+        return list(OrderedDict((tid, True) for tid, entry in db.entries()))
+
     def test_00_debug(self):
         _debug(self, "We are here!")
 
@@ -659,3 +672,911 @@ class UnitTests(unittest.TestCase):
             index = table.ensure('by_name', '{name}', True, False)
             index = table.ensure('by_name', '{name}', True, True)
 
+
+    def test_31_binlog_stream(self):
+        db = Database(self._db_name, conf={'binlog': {'buffer': 100}})
+        table = db.table(self._tb_name)
+        with db.begin():
+            for row in self._data:
+                table.append(dict(row))
+        with db.begin():
+            doc = next(table.find())
+            doc['age'] += 1
+            table.save(doc)
+            table.delete(doc)
+        entries = list(db.entries())
+        txns = self.txn_ids(db)
+        self.assertEqual(len(txns), 2)
+        self.assertEqual([e['cmd'] for t, e in entries if t == txns[0]], ['add'] * len(self._data))
+        self.assertEqual(entries[0][1]['doc']['name'], self._data[0]['name'])
+        self.assertEqual(entries[-1][1]['keys'], [doc['_id']])
+        self.assertEqual([e['cmd'] for t, e in db.entries(txns[0])], ['upd', 'del'])
+        self.assertEqual(list(db.entries(txns[1])), [])
+        with db.env.begin() as txn:
+            self.assertEqual(txn.stat(db._binlog)['entries'], len(self._data) + 2)
+
+    def test_31_binlog_encoding(self):
+        db = Database(self._db_name)
+        table = db.table(self._tb_name)
+        record = {'map': {1: 'a'}, 'big': 2**63 - 1, 'list': [None, 1.5, 'x']}
+        with db.begin():
+            table.append(dict(record))
+        entry = next(db.entries())[1]
+        self.assertEqual(entry['doc']['map'], {'1': 'a'})
+        self.assertEqual(entry['doc']['list'], record['list'])
+        self.assertEqual(entry['doc']['big'], record['big'])
+        self.assertEqual(entry['doc']['_id'], next(table.find())['_id'])
+
+    def test_32_binlog_purge(self):
+        db = Database(self._db_name, conf={'binlog': {'chunk': 2, 'entries': 8}})
+        table = db.table(self._tb_name)
+        for row in self._data:
+            with db.begin():
+                table.append(dict(row))
+                table.append(dict(row))
+        txns = self.txn_ids(db)
+        self.assertEqual(db.purge(age=3600), 0)
+        self.assertEqual(db.purge(until=txns[1]), 4)
+        self.assertEqual(self.txn_ids(db), txns[2:])
+        self.assertEqual(db.purge(), 2)
+        self.assertEqual(self.txn_ids(db), txns[3:])
+        self.assertEqual(db.purge(entries=0, until=txns[4]), 4)
+        with db.begin():
+            self.assertEqual(db.purge(size=0), 4)
+        self.assertEqual(list(db.entries()), [])
+
+    def test_33_binlog_environment(self):
+        call(['rm', '-rf', self._db_name + '-log'])
+        db = Database(self._db_name, conf={'binlog': {'path': self._db_name + '-log'}})
+        table = db.table(self._tb_name)
+        self.generate_data2(db, self._tb_name)
+        self.assertEqual(db.tables_all, ['__metadata__', self._tb_name])
+        txns = self.txn_ids(db)
+        self.assertEqual(len(txns), 1)
+        self.assertEqual(len(list(db.entries())), len(self._data))
+        with self.assertRaises(Exception):
+            with db.begin():
+                table.append({'name': 'aborted'})
+                raise Exception('catch this')
+        self.assertEqual(self.txn_ids(db), txns)
+        self.assertEqual(db.purge(until=txns[0]), len(self._data))
+
+        class BrokenCommit(object):
+            def __init__(self, txn):
+                self._txn = txn
+
+            def __getattr__(self, name):
+                return getattr(self._txn, name)
+
+            def commit(self):
+                self._txn.abort()
+                raise IOError('log commit failed')
+
+        with db.begin():
+            table.append({'name': 'first'})
+        first = db.tail()
+        with self.assertRaises(IOError):
+            with db.begin() as transaction:
+                table.append({'name': 'lost'})
+                transaction._log_txn = BrokenCommit(transaction._log_txn)
+        self.assertEqual(db.tail(), first)
+        self.assertEqual(len(list(table.find(expression=lambda doc: doc['name'] == 'lost'))), 1)
+        with db.begin():
+            table.append({'name': 'next'})
+        with self.assertRaises(xBinlogGap):
+            list(db.entries())
+        with self.assertRaises(xBinlogGap):
+            list(db.entries(first))
+        self.assertEqual(len(list(db.entries(db.tail()))), 0)
+        db.close()
+
+    def test_33_purge_whole_transactions(self):
+        db = Database(self._db_name, conf={'binlog': {'chunk': 1}})
+        self.generate_data2(db, self._tb_name)
+        self.generate_data2(db, self._tb_name)
+        self.generate_data2(db, self._tb_name)
+        txns = self.txn_ids(db)
+        with db._log_env.begin(write=True) as txn:
+            self.assertEqual(_purge(txn, db._binlog, (txns[1] + '~').encode(), 1), len(self._data))
+        self.assertEqual(self.txn_ids(db), txns[1:])
+        with db.env.begin() as txn:
+            stat = txn.stat(db._binlog)
+        self.assertEqual(db.purge(size=_stat_bytes(stat) - 1), len(self._data))
+        self.assertEqual(self.txn_ids(db), txns[2:])
+
+    def test_34_watch(self):
+        db = Database(self._db_name)
+        table = db.table(self._tb_name)
+        self.generate_data2(db, self._tb_name)
+        with db.watch('') as watcher:
+            changes = list(watcher.poll())
+            self.assertEqual(len(changes), len(self._data))
+            checkpoint = watcher.checkpoint
+        with table.watch(ops=['upd'], timeout=0.1) as watcher:
+            self.assertEqual(list(watcher), [])
+            self.assertEqual(watcher.checkpoint, checkpoint)
+            with db.begin():
+                doc = next(table.find())
+                db.table('other').append({'name': 'other'})
+                doc['age'] += 1
+                table.save(doc)
+            changes = list(watcher)
+            self.assertEqual([c['cmd'] for c in changes], ['upd'])
+            self.assertEqual(changes[0]['key'], doc['_id'])
+            self.assertEqual(changes[0]['txn'], db.tail())
+
+        def commit():
+            with db.begin():
+                table.append({'name': 'late'})
+
+        with db.watch(tables=[self._tb_name], wait=False) as watcher:
+            Timer(0.1, commit).start()
+            self.assertTrue(watcher.wait(5))
+            self.assertEqual([c['doc']['name'] for c in watcher], ['late'])
+            self.assertFalse(watcher.wait(0.1))
+            loop = new_event_loop()
+            Timer(0.1, commit).start()
+            loop.run_until_complete(watcher.wait_async())
+            loop.close()
+            self.assertEqual(len(list(watcher.poll())), 1)
+
+    def test_35_replay(self):
+        restore_name = self._db_name + '-restore'
+        call(['rm', '-rf', restore_name])
+        db = Database(self._db_name)
+        table = db.table(self._tb_name)
+        with db.begin():
+            table.index('by_name', '{name}')
+        self.generate_data2(db, self._tb_name)
+        makedirs(restore_name)
+        db.env.copy(restore_name)
+        with db.begin():
+            table.append({'name': 'Restored', 'age': 1})
+        with db.begin():
+            doc = next(table.find())
+            doc['age'] = 99
+            table.save(doc)
+        with db.begin():
+            table.delete(doc['_id'])
+        txns = self.txn_ids(db)
+        restored = Database(restore_name)
+        self.assertEqual(restored.tail(), txns[1])
+        reports = []
+        stats = restored.replay(db, until=txns[3], batch=1, progress=reports.append)
+        self.assertEqual(stats['transactions'], 2)
+        self.assertEqual([r['checkpoint'] for r in reports], txns[2:4])
+        copy = restored.table(self._tb_name)
+        self.assertEqual(copy.get(doc['_id'])['age'], 99)
+        self.assertEqual(copy.seek_one('by_name', {'name': 'Restored'})['age'], 1)
+        self.assertEqual(copy.index('by_name').count(), len(self._data) + 1)
+        self.assertEqual(restored.tail(), txns[1])
+        stats = restored.replay(db)
+        self.assertEqual((stats['transactions'], stats['checkpoint']), (1, txns[4]))
+        self.assertEqual(list(copy.find()), list(table.find()))
+        self.assertEqual(list(copy.find('by_name')), list(table.find('by_name')))
+        self.assertEqual(restored.replay(db)['transactions'], 0)
+        restored.close()
+        db.close()
+
+    def test_36_map_growth(self):
+        warnings = []
+        conf = {'map': {'warn': lambda db, name, used, size: warnings.append((used, size))}}
+        db = Database(self._db_name, conf=conf, size=size_mb(1))
+        table = db.table(self._tb_name)
+        table.index('by_name', '{name}')
+        for i in range(1000):
+            table.append({'name': 'record-{:05}'.format(i), 'text': 'x' * 1000})
+        self.assertGreater(db.env.info()['map_size'], size_mb(1))
+        self.assertEqual(table.index('by_name').count(), 1000)
+        self.assertTrue(warnings)
+        self.assertTrue(all(used >= size * 0.8 for used, size in warnings))
+        size = db.env.info()['map_size']
+        with self.assertRaises(MapFullError):
+            with db.begin():
+                for i in range(1000):
+                    table.append({'name': 'more-{:05}'.format(i), 'text': 'x' * 1000})
+        self.assertGreater(db.env.info()['map_size'], size)
+        self.assertEqual(table.records, 1000)
+        db.close()
+        call(['rm', '-rf', self._db_name])
+        db = Database(self._db_name, conf={'map': {'limit': size_mb(1)}}, size=size_mb(1))
+        table = db.table(self._tb_name)
+        with self.assertRaises(xMapFull):
+            for i in range(1000):
+                table.append({'name': 'record-{:05}'.format(i), 'text': 'x' * 1000})
+        db.close()
+
+    def test_37_backup_compact(self):
+        backup_name = self._db_name + '-backup'
+        call(['rm', '-rf', backup_name])
+        db = Database(self._db_name)
+        table = db.table(self._tb_name)
+        table.index('by_name', '{name}')
+        for i in range(2000):
+            table.append({'name': 'record-{:05}'.format(i), 'text': 'x' * 500})
+        table.delete([doc['_id'] for doc in table.find(limit=1900)])
+        reports = []
+        stats = db.backup(backup_name, progress=reports.append)
+        self.assertTrue(reports)
+        self.assertEqual(reports[-1]['bytes'], stats['bytes'])
+        copy = Database(backup_name)
+        self.assertEqual(list(copy.table(self._tb_name).find('by_name')), list(table.find('by_name')))
+        copy.close()
+        stats = db.compact()
+        self.assertLess(stats['after'], stats['before'])
+        self.assertEqual(table.records, 100)
+        self.assertEqual(table.index('by_name').count(), 100)
+        table.append({'name': 'after'})
+        self.assertEqual(table.seek_one('by_name', {'name': 'after'})['name'], 'after')
+        db.close()
+
+    def test_38_transform(self):
+        db = Database(self._db_name)
+        table = db.table(self._tb_name)
+        table.index('by_age', '{age:04}', duplicates=True)
+        table.index('by_name', '{name}')
+        self.generate_data(db, self._tb_name)
+        self.assertEqual(table.index('by_age').fields, frozenset(['age']))
+        calls = []
+
+        def older(doc):
+            calls.append(doc['name'])
+            if len(calls) == 3:
+                raise ValueError('interrupted')
+            doc['age'] += 1
+            return doc
+
+        with self.assertRaises(ValueError):
+            table.transform(older, chunk_size=2, where=lambda doc: doc['cat'] == 'B')
+        stats = table.transform(older, chunk_size=2, where=lambda doc: doc['cat'] == 'B')
+        self.assertEqual((stats['scanned'], stats['changed']), (3, 3))
+        self.assertEqual([doc['age'] for doc in table.find() if doc['cat'] == 'B'], [41, 41, 41, 22])
+        self.assertEqual([doc['age'] for doc in table.find('by_age')], [21, 22, 41, 41, 41, 45, 3000])
+        self.assertEqual(table.seek_one('by_name', {'name': 'Jim Smith'})['age'], 41)
+        self.assertEqual(table.transform(lambda doc: None)['changed'], 0)
+        with self.assertRaises(xWriteFail):
+            with db.begin():
+                table.transform(older)
+        db.close()
+
+    def test_39_stats(self):
+        db = Database(self._db_name)
+        table = db.table(self._tb_name)
+        table.index('by_name', '{name}')
+        table.index('by_age', '{age:03}', duplicates=True)
+        self.generate_data(db, self._tb_name)
+        stats = table.stats()
+        self.assertEqual(stats['entries'], len(self._data))
+        self.assertEqual(stats['bytes'], stats['leaf_pages'] * stats['psize'])
+        self.assertEqual(stats['average_record'], stats['bytes'] / len(self._data))
+        self.assertEqual(sorted(stats['indexes']), ['by_age', 'by_name'])
+        self.assertEqual(stats['indexes']['by_name']['entries'], len(self._data))
+        self.assertEqual(stats['index_bytes'], 2 * stats['psize'])
+        for i in range(500):
+            table.append({'name': 'record-{:05}'.format(i), 'age': i, 'cat': 'C', 'text': 'x' * 200})
+        table.delete([doc['_id'] for doc in table.find(limit=490)])
+        stats = db.stats()
+        self.assertEqual(list(stats['tables']), [self._tb_name])
+        self.assertEqual(stats['tables'][self._tb_name]['entries'], len(self._data) + 10)
+        self.assertEqual(stats['pages'], stats['last_pgno'] + 1)
+        self.assertEqual(stats['usage'], stats['used'] / stats['map_size'])
+        self.assertGreater(stats['free_pages'], 0)
+        self.assertEqual(stats['binlog']['entries'], 0)
+        self.assertGreaterEqual(stats['readers'], 0)
+        db.close()
+
+    def test_40_explain(self):
+        db = Database(self._db_name)
+        table = db.table(self._tb_name)
+        table.index('by_age', '{age:03}', duplicates=True)
+        table.index('by_name', '{name}')
+        self.generate_data(db, self._tb_name)
+        plan = table.explain('find', expression=lambda doc: doc['age'] == 40)
+        self.assertEqual((plan['access'], plan['index']), ('full scan', None))
+        self.assertEqual((plan['estimated'], plan['scanned'], plan['returned']), (7, 7, 3))
+        self.assertEqual(plan['fetched'], 0)
+        self.assertGreater(plan['decode'], 0)
+        plan = table.explain('find', 'by_name', limit=2)
+        self.assertEqual((plan['access'], plan['estimated'], plan['scanned'], plan['fetched']), ('index scan', 2, 2, 2))
+        plan = table.explain('seek', 'by_age', {'age': 40})
+        self.assertEqual((plan['access'], plan['estimated'], plan['returned']), ('index seek', 3, 3))
+        plan = table.explain('range', 'by_age', {'age': 21}, {'age': 40})
+        found = len(list(table.range('by_age', {'age': 21}, {'age': 40})))
+        self.assertEqual((plan['access'], plan['estimated'], plan['returned']), ('index range', 7, found))
+        plan = table.explain('seek_one', 'by_name', {'name': 'Squizzey'})
+        self.assertEqual((plan['estimated'], plan['returned'], plan['fetched']), (1, 1, 1))
+        key = next(table.find())['_id']
+        self.assertEqual(table.explain('get', key)['access'], 'key lookup')
+        self.assertEqual(table.explain('range', None)['access'], 'key range')
+        with self.assertRaises(xIndexMissing):
+            table.explain('seek', 'by_nothing', {})
+        db.close()
+
+    def test_41_cached_definitions(self):
+        db = Database(self._db_name)
+        table = db.table(self._tb_name)
+        table.index('by_name', '{name}')
+        self.generate_data(db, self._tb_name)
+        db.close()
+        db = Database(self._db_name)
+        definitions = db._definitions
+        self.assertEqual(list(definitions), ['_demo1_by_name'])
+        table = db.table(self._tb_name)
+        db.table('other')
+        self.assertIs(db._definitions, definitions)
+        index = table._indexes['by_name']
+        self.assertEqual(index._func, index._compile)
+        self.assertEqual(table.seek_one('by_name', {'name': 'Squizzey'})['age'], 3000)
+        self.assertNotEqual(index._func, index._compile)
+        db.table('other').index('by_age', '{age}')
+        del db._tables['other']
+        self.assertEqual(db.table('other').indexes, ['by_age'])
+        self.assertEqual(sorted(db._definitions), ['_demo1_by_name', '_other_by_age'])
+        self.assertEqual(table.indexes, ['by_name'])
+        db.close()
+
+    def test_42_readonly(self):
+        db = Database(self._db_name)
+        table = db.table(self._tb_name)
+        table.index('by_name', '{name}')
+        self.generate_data(db, self._tb_name)
+        reader = Database(self._db_name, readonly=True)
+        table = reader.table(self._tb_name)
+        self.assertEqual(table.records, len(self._data))
+        self.assertEqual(table.seek_one('by_name', {'name': 'Squizzey'})['age'], 3000)
+        with self.assertRaises(ReadonlyError):
+            table.append({'name': 'Nobody'})
+        with self.assertRaises(xTableMissing):
+            reader.table('missing')
+        db.table(self._tb_name).append({'name': 'Late', 'age': 1})
+        self.assertEqual(table.records, len(self._data) + 1)
+        self.assertEqual(reader.reader_check(), 0)
+        reader.close()
+        db.close()
+
+    def test_43_fork(self):
+        if not hasattr(os, 'register_at_fork'):
+            return
+        call(['rm', '-rf', self._db_name + '-closed'])
+        closed = Database(self._db_name + '-closed')
+        closed.close()
+        db = Database(self._db_name)
+        table = db.table(self._tb_name)
+        table.index('by_name', '{name}')
+        self.generate_data(db, self._tb_name)
+        pid = os.fork()
+        if not pid:
+            status = 1
+            try:
+                if not db._forked or closed._forked or closed._env:
+                    status = 2
+                else:
+                    table.append({'name': 'Child', 'age': 1})
+                    status = 0 if table.seek_one('by_name', {'name': 'Child'}) and not db._forked else 3
+            finally:
+                os._exit(status)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.WEXITSTATUS(status), 0)
+        self.assertFalse(db._forked)
+        self.assertEqual(table.records, len(self._data) + 1)
+        self.assertEqual(table.seek_one('by_name', {'name': 'Child'})['age'], 1)
+        pid = os.fork()
+        if not pid:
+            os._exit(0 if db._forked and table.records == len(self._data) + 1 else 1)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.WEXITSTATUS(status), 0)
+        db.close()
+        call(['rm', '-rf', self._db_name + '-closed'])
+
+    def test_44_batched_scans(self):
+        db = Database(self._db_name, conf={'scan': {'records': 2}})
+        table = db.table(self._tb_name)
+        table.index('by_name', '{name}')
+        table.index('by_age', '{age:03}', duplicates=True)
+        self.generate_data(db, self._tb_name)
+        for index in [None, 'by_name', 'by_age']:
+            self.assertEqual(list(table.find(index, snapshot=False)), list(table.find(index)))
+        adults = lambda doc: doc['age'] >= 40
+        self.assertEqual(list(table.find('by_age', adults, limit=3, snapshot=False)),
+                         list(table.find('by_age', adults, limit=3)))
+        for inclusive in [True, False]:
+            lower, upper = {'age': 21}, {'age': 45}
+            self.assertEqual(list(table.range('by_age', lower, upper, inclusive, snapshot=False)),
+                             list(table.range('by_age', lower, upper, inclusive)))
+        keys = [doc['_id'] for doc in table.find()]
+        lower, upper = {'_id': keys[1]}, {'_id': keys[4]}
+        self.assertEqual(list(table.range(None, lower, upper, False, snapshot=False)),
+                         list(table.range(None, lower, upper, False)))
+        names = []
+        for doc in table.find(snapshot=False):
+            if not names:
+                table.delete(keys[-1])
+                table.append({'name': 'Late', 'age': 1})
+            names.append(doc['name'])
+        self.assertEqual(names[-1], 'Late')
+        self.assertNotIn(self._data[-1]['name'], names)
+        with db.begin():
+            self.assertEqual(len(list(table.find(snapshot=False))), len(self._data))
+        db.close()
+
+    def test_45_update(self):
+        db = Database(self._db_name)
+        table = db.table(self._tb_name)
+        table.index('by_name', '{name}')
+        table.index('by_age', '{age:03}', duplicates=True)
+        self.generate_data(db, self._tb_name)
+        key = table.seek_one('by_name', {'name': 'Squizzey'})['_id']
+        self.assertEqual(table.update(key, {'$inc': {'age': 1, 'visits': 2}, '$set': {'cat': 'C'}}), 1)
+        self.assertEqual(table.update(key.decode(), {'$unset': {'admin': 1}, '$push': {'tags': 'x'}}), 1)
+        doc = table.get(key)
+        self.assertEqual((doc['age'], doc['visits'], doc['cat'], doc['tags']), (3001, 2, 'C', ['x']))
+        self.assertNotIn('admin', doc)
+        self.assertEqual(table.seek_one('by_age', {'age': 3001})['_id'], key)
+        self.assertIsNone(table.seek_one('by_age', {'age': 3000}))
+        self.assertEqual(table.update({'age': 40}, {'$inc': {'age': 1}}, index='by_age'), 3)
+        self.assertEqual(len(list(table.seek('by_age', {'age': 41}))), 3)
+        self.assertEqual(table.update(b'missing', {'$inc': {'age': 1}}), 0)
+        with self.assertRaises(ValueError):
+            table.update(key, {'$rename': {'age': 'years'}})
+        with self.assertRaises(xWriteFail):
+            table.update(key, {'$unset': {'name': 1}, '$set': {'cat': 'D'}})
+        self.assertEqual((table.get(key)['name'], table.get(key)['cat']), ('Squizzey', 'C'))
+        self.assertEqual(table.seek_one('by_name', {'name': 'Squizzey'})['_id'], key)
+        with db.begin():
+            table.update(doc, {'$inc': {'age': 1}})
+        tid, entry = list(db.entries())[-1]
+        self.assertEqual(entry, {'cmd': 'opr', 'tab': self._tb_name, 'key': key, 'ops': {'$inc': {'age': 1}}})
+        call(['rm', '-rf', self._db_name + '-copy'])
+        copy = Database(self._db_name + '-copy')
+        with copy.begin():
+            copy.table(self._tb_name).append(dict(table.get(key), age=3001))
+            copy.apply([entry])
+        self.assertEqual(copy.table(self._tb_name).get(key)['age'], 3002)
+        copy.close()
+        db.close()
+
+    def test_46_save_skips_indexes(self):
+        db = Database(self._db_name)
+        table = db.table(self._tb_name)
+        table.index('by_name', '{name}')
+        table.index('by_age', '{age:0{width}}', duplicates=True)
+        table.index('by_cat', '{cat}|{name[0]}', duplicates=True)
+        self.assertEqual(table._indexes['by_age'].fields, {'age', 'width'})
+        self.assertEqual(table._indexes['by_cat'].fields, {'cat', 'name'})
+        for row in self._data:
+            table.append(dict(row, width=3))
+        saved = []
+        for name, index in table._indexes.items():
+            index.save = lambda txn, key, old, rec, name=name, save=index.save: saved.append(name) or save(txn, key, old, rec)
+        doc = table.seek_one('by_name', {'name': 'Squizzey'})
+        doc['age'] += 1
+        table.save(doc)
+        self.assertEqual(saved, ['by_age'])
+        doc['width'] = 5
+        doc['admin'] = False
+        table.save(doc)
+        self.assertEqual(saved, ['by_age', 'by_age'])
+        self.assertEqual(table.seek_one('by_age', {'age': 3001, 'width': 5})['name'], 'Squizzey')
+        doc['name'] = 'Squiz'
+        table.save(doc)
+        self.assertEqual(sorted(saved[2:]), ['by_cat', 'by_name'])
+        self.assertEqual(table.seek_one('by_name', {'name': 'Squiz'})['age'], 3001)
+        db.close()
+
+    def test_47_update_representations(self):
+        updates = {'*': 'fields', 'images': 'image', 'deltas': 'delta'}
+        db = Database(self._db_name, conf={'binlog': {'updates': updates}})
+        call(['rm', '-rf', self._db_name + '-copy'])
+        copy = Database(self._db_name + '-copy')
+        for name, cmd in [(self._tb_name, 'opr'), ('images', 'img'), ('deltas', 'upd')]:
+            table = db.table(name)
+            with db.begin():
+                table.append({'name': 'Fred', 'age': 45, 'admin': True})
+            doc = next(table.find())
+            with db.begin():
+                del doc['admin']
+                doc['age'] += 2
+                table.save(doc)
+            entries = [entry for _, entry in db.entries() if entry['tab'] == name]
+            self.assertEqual([entry['cmd'] for entry in entries], ['add', cmd])
+            with copy.begin():
+                copy.apply(entries)
+            self.assertEqual(copy.table(name).get(doc['_id']), table.get(doc['_id']))
+            self.assertEqual(table.get(doc['_id']), {'_id': doc['_id'], 'name': 'Fred', 'age': 47})
+        self.assertEqual(entries[-1]['yyy'], diff({'name': 'Fred', 'age': 45, 'admin': True},
+                                                  {'name': 'Fred', 'age': 47}, verbose=False))
+        entry = [entry for _, entry in db.entries() if entry['cmd'] == 'opr'][0]
+        self.assertEqual(entry['ops'], {'$set': {'age': 47}, '$unset': {'admin': 1}})
+        with patch('pymamba.diff') as delta:
+            table.save(doc)
+            with db.begin(log=False):
+                table.save(doc)
+            delta.assert_not_called()
+        copy.close()
+        db.close()
+        with self.assertRaises(ValueError):
+            Database(self._db_name, conf={'binlog': {'updates': 'diff'}})
+
+    def test_48_bulk_delete(self):
+        db = Database(self._db_name)
+        table = db.table(self._tb_name)
+        table.index('by_name', '{name}', duplicates=True)
+        table.index('by_age', '{age:03}', duplicates=True)
+        self.generate_data2(db, self._tb_name)
+        self.generate_data2(db, self._tb_name)
+        keys = [doc['_id'] for doc in table.find()]
+        self.assertEqual(table.delete_range(None, {'_id': keys[1]}, {'_id': keys[5]}, chunk_size=2), 5)
+        self.assertEqual([doc['_id'] for doc in table.find()], keys[:1] + keys[6:])
+        self.assertEqual(table.delete_range(None, {'_id': keys[6]}, {'_id': keys[8]}, False), 1)
+        self.assertEqual(table.delete_range('by_age', {'age': 40}, {'age': 40}, chunk_size=1), 3)
+        self.assertEqual(sorted(doc['age'] for doc in table.find()), [21, 21, 21, 45, 3000])
+        self.assertEqual(table.delete_where(lambda doc: doc.get('admin'), 'by_name', chunk_size=2), 3)
+        with db.begin():
+            self.assertEqual(table.delete_where(lambda doc: doc['age'] == 45), 1)
+        remaining = list(table.find())
+        self.assertEqual([doc['name'] for doc in remaining], ['Squizzey'])
+        self.assertEqual(table.index('by_name').count(), 1)
+        self.assertEqual(table.index('by_age').count(), 1)
+        self.assertEqual(len(list(table.seek('by_age', {'age': 3000}))), 1)
+        entries = [entry for _, entry in db.entries()]
+        self.assertEqual([entry['cmd'] for entry in entries if entry['cmd'] in ('del', 'dlr')],
+                         ['dlr'] * 4 + ['del'] * 6)
+        ranges = [(entry['lo'], entry['hi']) for entry in entries if entry['cmd'] == 'dlr']
+        self.assertEqual(ranges, [(keys[1], keys[2]), (keys[3], keys[4]), (keys[5], keys[5]), (keys[7], keys[7])])
+        call(['rm', '-rf', self._db_name + '-copy'])
+        copy = Database(self._db_name + '-copy')
+        copy.apply(entries)
+        self.assertEqual(list(copy.table(self._tb_name).find()), remaining)
+        copy.close()
+        db.close()
+
+    def test_49_upsert(self):
+        db = Database(self._db_name)
+        table = db.table(self._tb_name)
+        table.index('by_name', '{name}')
+        table.index('by_age', '{age:03}', duplicates=True)
+        self.generate_data(db, self._tb_name)
+        key = table.seek_one('by_name', {'name': 'Squizzey'})['_id']
+        self.assertEqual(table.upsert({'name': 'Squizzey', 'age': 3001}, 'by_name'), key)
+        self.assertEqual(table.get(key), {'_id': key, 'name': 'Squizzey', 'age': 3001})
+        self.assertEqual(table.seek_one('by_age', {'age': 3001})['_id'], key)
+        key = table.upsert({'name': 'Newbie', 'age': 1}, 'by_name')
+        self.assertEqual(table.seek_one('by_name', {'name': 'Newbie'})['_id'], key)
+        stats = table.upsert_many([
+            {'name': 'Zed', 'age': 2}, {'name': 'Fred Bloggs', 'age': 46}, {'name': 'Abe', 'age': 3},
+            {'name': 'Zed', 'age': 4}
+        ], on='by_name')
+        self.assertEqual(stats, {'inserted': 2, 'updated': 2})
+        self.assertEqual(table.records, len(self._data) + 3)
+        self.assertEqual(table.seek_one('by_name', {'name': 'Zed'})['age'], 4)
+        self.assertEqual(table.seek_one('by_name', {'name': 'Fred Bloggs'})['age'], 46)
+        self.assertEqual([doc['name'] for doc in table.seek('by_age', {'age': 4})], ['Zed'])
+        self.assertEqual(table.upsert({'_id': b'f' * 24, 'name': 'Keeper', 'age': 5}, 'by_name'), b'f' * 24)
+        self.assertEqual(table.get(b'f' * 24)['name'], 'Keeper')
+        self.assertEqual(table.upsert({'_id': b'e' * 24, 'name': 'Keeper', 'age': 6}, 'by_name'), b'f' * 24)
+        self.assertIsNone(table.get(b'e' * 24))
+        stats = table.upsert_many([{'_id': b'f' * 23 + b'g', 'name': 'Last', 'age': 7}], 'by_name')
+        self.assertEqual(stats, {'inserted': 1, 'updated': 0})
+        self.assertEqual(table.seek_one('by_name', {'name': 'Last'})['_id'], b'f' * 23 + b'g')
+        with self.assertRaises(xWriteFail):
+            table.upsert({'_id': b'f' * 24, 'name': 'Clash', 'age': 8}, 'by_name')
+        with self.assertRaises(ValueError):
+            table.upsert({'age': 1}, 'by_age')
+        with self.assertRaises(xIndexMissing):
+            table.upsert({'age': 1}, 'by_nothing')
+        db.close()
+
+    def test_50_partial_index(self):
+        db = Database(self._db_name)
+        table = db.table(self._tb_name)
+        self.generate_data(db, self._tb_name)
+        table.index('admin_by_name', '{name}', where={'admin': True})
+        table.index('old_by_cat', '{cat}', duplicates=True, where={'age': {'$gte': 40}})
+        table.index('by_age', '{age:03}', duplicates=True)
+        index = table.index('admin_by_name')
+        self.assertEqual(index.count(), 3)
+        self.assertEqual(index.fields, {'name', 'admin'})
+        self.assertEqual(index.options, {'where': {'admin': True}})
+        self.assertEqual(table.index('old_by_cat').count(), 5)
+        table.append({'name': 'Nobody', 'age': 1, 'cat': 'A'})
+        self.assertEqual(index.count(), 3)
+        doc = table.seek_one('by_age', {'age': 1})
+        doc['admin'] = True
+        table.save(doc)
+        self.assertEqual([d['name'] for d in table.find('admin_by_name')],
+                         ['Gareth Bult', 'Gareth Bult1', 'John Doe', 'Nobody'])
+        del doc['admin']
+        doc['age'] = 50
+        table.save(doc)
+        self.assertEqual(index.count(), 3)
+        self.assertEqual(table.index('old_by_cat').count(), 6)
+        table.delete(doc)
+        self.assertEqual(table.index('old_by_cat').count(), 5)
+        table.reindex()
+        self.assertEqual((index.count(), table.index('old_by_cat').count()), (3, 5))
+
+        plan = table.explain('query', {'admin': True, 'cat': 'B'})
+        self.assertEqual((plan['access'], plan['index'], plan['estimated']), ('index scan', 'admin_by_name', 3))
+        self.assertEqual(plan['returned'], 2)
+        plan = table.explain('query', {'admin': True, 'name': 'John Doe'})
+        self.assertEqual((plan['access'], plan['index'], plan['scanned']), ('index seek', 'admin_by_name', 1))
+        plan = table.explain('query', {'age': {'$gte': 40}, 'cat': 'B'})
+        self.assertEqual((plan['access'], plan['index'], plan['returned']), ('index seek', 'old_by_cat', 3))
+        plan = table.explain('query', {'age': 40})
+        self.assertEqual((plan['access'], plan['index'], plan['returned']), ('index seek', 'by_age', 3))
+        plan = table.explain('query', {'name': {'$in': ['Squizzey', 'Fred Bloggs']}})
+        self.assertEqual((plan['access'], plan['scanned'], plan['returned']), ('full scan', 7, 2))
+        self.assertEqual(len(list(table.query({'admin': {'$exists': False}}, limit=2))), 2)
+        self.assertEqual(len(list(table.query({'age': {'$lt': 40, '$ne': 21}}))), 0)
+        with self.assertRaises(ValueError):
+            list(table.query({'age': {'$near': 1}}))
+        db.close()
+        db = Database(self._db_name)
+        self.assertEqual(db.table(self._tb_name).index('admin_by_name').where, {'admin': True})
+        db.close()
+
+    def test_51_multikey_index(self):
+        db = Database(self._db_name)
+        table = db.table(self._tb_name)
+        table.index('by_tag', '{tags}', multikey=True)
+        table.index('by_cat_tag', '{cat}|{tags}', multikey=True)
+        table.index('by_role_tag', '{roles}|{tags}', multikey=True)
+        for name, cat, tags, roles in [('a', 'X', ['red', 'blue'], ['admin']), ('b', 'Y', ['red'], []),
+                                       ('c', 'X', [], ['user', 'admin']), ('d', 'X', 'green', ['user'])]:
+            table.append({'name': name, 'cat': cat, 'tags': tags, 'roles': roles})
+        index = table.index('by_tag')
+        self.assertTrue(index.multikey and index.duplicates)
+        seek = lambda index, record: sorted(doc['name'] for doc in table.seek(index, record))
+        self.assertEqual(seek('by_tag', {'tags': 'red'}), ['a', 'b'])
+        self.assertEqual(seek('by_tag', {'tags': 'green'}), ['d'])
+        self.assertEqual(seek('by_cat_tag', {'cat': 'X', 'tags': 'red'}), ['a'])
+        self.assertEqual(seek('by_role_tag', {'roles': 'admin', 'tags': 'blue'}), ['a'])
+        self.assertEqual(index.count(), 4)
+        self.assertEqual(table.index('by_role_tag').count(), 3)
+        doc = table.seek_one('by_tag', {'tags': 'blue'})
+        saved = []
+        index.save = lambda txn, key, old, rec, save=index.save: saved.append(1) or save(txn, key, old, rec)
+        doc['tags'] = ['blue', 'yellow']
+        table.save(doc)
+        self.assertEqual(seek('by_tag', {'tags': 'red'}), ['b'])
+        self.assertEqual(seek('by_tag', {'tags': 'yellow'}), ['a'])
+        self.assertEqual(seek('by_role_tag', {'roles': 'admin', 'tags': 'yellow'}), ['a'])
+        table.update(doc, {'$push': {'tags': 'red'}})
+        self.assertEqual(seek('by_tag', {'tags': 'red'}), ['a', 'b'])
+        self.assertEqual(saved, [1, 1])
+        self.assertEqual([doc['name'] for doc in table.query({'tags': 'yellow', 'cat': 'X'})], ['a'])
+        self.assertEqual(table.explain('query', {'tags': 'red'})['access'], 'index seek')
+        table.delete(doc)
+        self.assertEqual(index.count(), 2)
+        self.assertEqual(table.index('by_cat_tag').count(), 2)
+        self.assertEqual(table.index('by_role_tag').count(), 1)
+        db.close()
+
+    def test_52_text_index(self):
+        db = Database(self._db_name)
+        table = db.table(self._tb_name)
+        table.index('by_text', '{name} {notes}', text=True, positions=True)
+        table.index('by_words', '{notes}', text=True)
+        for name, notes in [('Fox', 'the quick brown fox jumps'), ('Dog', 'the lazy dog sleeps, dog tired'),
+                            ('Cat', 'a quick cat'), ('Foxglove', ['a plant', 'not a fox'])]:
+            table.append({'name': name, 'notes': notes})
+        table.append({'name': 'Nothing'})
+        search = lambda query, mode='and', index='by_text': [doc['name'] for doc in table.search(index, query, mode)]
+        self.assertEqual(search('quick'), ['Fox', 'Cat'])
+        self.assertEqual(search('QUICK fox'), ['Fox'])
+        self.assertEqual(search('fox cat', 'or'), ['Cat', 'Fox', 'Foxglove'])
+        self.assertEqual(search('fox*'), ['Foxglove', 'Fox'])
+        self.assertEqual(search('dog'), ['Dog'])
+        self.assertEqual(search('"quick brown"'), ['Fox'])
+        self.assertEqual(search('"brown quick"'), [])
+        self.assertEqual(search('"not a fox" plant'), ['Foxglove'])
+        self.assertEqual(search('missing'), [])
+        self.assertEqual(search('quick', index='by_words'), ['Fox', 'Cat'])
+        score, doc = next(table.search('by_text', 'dog', scores=True))
+        self.assertAlmostEqual(score, 3 * log(1 + 5 / 1))
+        with self.assertRaises(ValueError):
+            list(table.search('by_words', '"quick brown"'))
+        with self.assertRaises(ValueError):
+            list(table.search('by_text', 'fox', mode='xor'))
+        with self.assertRaises(xIndexMissing):
+            list(table.search('by_nothing', 'fox'))
+        doc = next(table.search('by_text', 'brown'))
+        doc['notes'] = 'the slow brown fox'
+        table.save(doc)
+        self.assertEqual(search('quick'), ['Cat'])
+        self.assertEqual(search('"slow brown fox"'), ['Fox'])
+        self.assertEqual(table.explain('query', {'name': 'fox'})['access'], 'full scan')
+        for walk in [lambda: list(table.find('by_text')), lambda: list(table.range('by_text')),
+                     lambda: list(table.find('by_text', snapshot=False)), lambda: list(table.seek('by_text', doc)),
+                     lambda: table.seek_one('by_text', doc), lambda: table.delete_where(lambda r: True, 'by_text'),
+                     lambda: table.delete_range('by_words', doc, doc)]:
+            with self.assertRaises(xIndexUnsupported):
+                walk()
+        self.assertEqual(table.records, 5)
+        table.delete(doc)
+        self.assertEqual(search('fox*', 'or'), ['Foxglove'])
+        with db.env.begin() as txn:
+            self.assertEqual(txn.stat(table.index('by_text')._positions)['entries'], table.index('by_text').count())
+        table.delete_where(lambda doc: doc['name'] == 'Cat')
+        self.assertEqual(search('quick cat', 'or'), [])
+        table.reindex()
+        self.assertEqual(search('dog'), ['Dog'])
+        db.close()
+        db = Database(self._db_name)
+        self.assertEqual([doc['name'] for doc in db.table(self._tb_name).search('by_text', 'sleeps')], ['Dog'])
+        db.close()
+
+    def test_53_trigram_index(self):
+        db = Database(self._db_name)
+        table = db.table(self._tb_name)
+        table.index('by_host', '{host}', trigram=True)
+        table.index('by_live_host', '{host}', trigram=True, where={'live': True})
+        for host, live in [('web01.example.com', True), ('WEB02.example.com', False), ('db01.example.org', True),
+                           ('mail.example.net', True), ('ns', True)]:
+            table.append({'host': host, 'live': live})
+        table.append({'host': 12345, 'live': True})
+        like = lambda pattern, index='by_host': [doc['host'] for doc in table.like(index, pattern)]
+        self.assertEqual(like('%web%'), ['web01.example.com', 'WEB02.example.com'])
+        self.assertEqual(like('%01.%'), ['web01.example.com', 'db01.example.org'])
+        self.assertEqual(like('%Example.org'), ['db01.example.org'])
+        self.assertEqual(like('web%.com'), ['web01.example.com', 'WEB02.example.com'])
+        self.assertEqual(like('web0_.example.com'), ['web01.example.com', 'WEB02.example.com'])
+        self.assertEqual(like('%exa%com'), ['web01.example.com', 'WEB02.example.com'])
+        self.assertEqual(like('%xyz%'), [])
+        self.assertEqual(like('%com.%'), [])
+        self.assertEqual(like('n%'), ['ns'])
+        self.assertEqual(like('%b0%'), ['web01.example.com', 'WEB02.example.com', 'db01.example.org'])
+        self.assertEqual(like('%web%', 'by_live_host'), ['web01.example.com'])
+        self.assertEqual(like('%'), ['web01.example.com', 'WEB02.example.com', 'db01.example.org',
+                                     'mail.example.net', 'ns'])
+        self.assertEqual(len(list(table.like('by_host', '%example%', limit=2))), 2)
+        index = table.index('by_host')
+        with db.env.begin() as txn:
+            self.assertEqual(index.candidates(txn, {b'web', b'b02'}), [next(table.like('by_host', 'web02%'))['_id']])
+            self.assertEqual(index.candidates(txn, {b'web', b'xyz'}), [])
+        with self.assertRaises(ValueError):
+            table.index('by_pair', '{host}{live}', trigram=True)
+        with self.assertRaises(ValueError):
+            list(table.search('by_host', 'web'))
+        with self.assertRaises(xIndexMissing):
+            list(table.like('by_nothing', '%web%'))
+        self.assertEqual(table.explain('query', {'host': 'ns'})['access'], 'full scan')
+        for walk in [lambda: list(table.range('by_host')), lambda: list(table.seek('by_host', {'host': 'ns'})),
+                     lambda: list(table.range('by_host', snapshot=False)), lambda: table.delete_range('by_host')]:
+            with self.assertRaises(xIndexUnsupported):
+                walk()
+        doc = next(table.like('by_host', 'mail%'))
+        doc['host'] = 'smtp.example.net'
+        table.save(doc)
+        self.assertEqual(like('%mail%'), [])
+        self.assertEqual(like('%smtp%'), ['smtp.example.net'])
+        table.delete(doc)
+        self.assertEqual(like('%.net'), [])
+        table.delete_where(lambda doc: doc['host'] == 'db01.example.org')
+        self.assertEqual(like('%.org'), [])
+        self.assertEqual(index.count(), 2 * len('web01.example.com') - 4)
+        db.close()
+
+    def test_54_delete_multikey(self):
+        db = Database(self._db_name)
+        table = db.table(self._tb_name)
+        table.index('by_tag', '{tags}', multikey=True)
+        table.index('by_name', '{name}')
+        for number in range(5):
+            table.append({'name': 'n{}'.format(number), 'tags': ['x', 'y', 'z'] if number % 2 else ['x', 'y']})
+        self.assertEqual(table.delete_where(lambda r: r['name'] != 'n2', index='by_tag', chunk_size=2), 4)
+        self.assertEqual([doc['name'] for doc in table.find()], ['n2'])
+        self.assertEqual(table.index('by_tag').count(), 2)
+        self.assertEqual(table.index('by_name').count(), 1)
+        for number in range(5, 10):
+            table.append({'name': 'n{}'.format(number), 'tags': ['x', 'y']})
+        self.assertEqual(table.delete_range('by_tag', {'tags': 'x'}, {'tags': 'y'}), 6)
+        self.assertEqual(table.records, 0)
+        self.assertEqual(table.index('by_tag').count(), 0)
+        with db.begin():
+            table.append({'name': 'a', 'tags': ['p', 'q']})
+            table.append({'name': 'b', 'tags': ['q', 'r']})
+            self.assertEqual(table.delete_where(lambda r: True, index='by_tag'), 2)
+        self.assertEqual(table.index('by_tag').count(), 0)
+        db.close()
+
+    def test_55_commit_failure(self):
+        db = Database(self._db_name)
+        table = db.table(self._tb_name)
+        with patch.object(DBTransaction, 'flush', side_effect=xWriteFail('binlog')):
+            with self.assertRaises(xWriteFail):
+                with db.begin() as transaction:
+                    table.append({'name': 'Lost'})
+        self.assertIsNone(db.transaction)
+        self.assertEqual(table.records, 0)
+        thread = Thread(target=table.append, args=({'name': 'Found'},))
+        thread.start()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        with db.begin():
+            table.append({'name': 'Kept'})
+        self.assertEqual(sorted(doc['name'] for doc in table.find()), ['Found', 'Kept'])
+        del transaction
+        db.close()
+
+    def test_56_map_resize_with_readers(self):
+        db = Database(self._db_name, conf={'map': {'wait': 0.05}}, size=size_mb(1))
+        table = db.table(self._tb_name)
+        for i in range(10):
+            table.append({'name': 'record-{:05}'.format(i)})
+        size = db.env.info()['map_size']
+        scan = table.find()
+        next(scan)
+        with self.assertRaises(xMapFull):
+            for i in range(1000):
+                table.append({'name': 'big-{:05}'.format(i), 'text': 'x' * 1000})
+        self.assertEqual(db.env.info()['map_size'], size)
+        scan.close()
+        for i in range(1000):
+            table.append({'name': 'more-{:05}'.format(i), 'text': 'x' * 1000})
+        self.assertGreater(db.env.info()['map_size'], size)
+        db.close()
+        if not hasattr(os, 'fork'):
+            return
+        db = Database(self._db_name, size=size_mb(1))
+        size = db.env.info()['map_size']
+        records = db.table(self._tb_name).records
+        pid = os.fork()
+        if not pid:
+            status = 1
+            try:
+                other = Database(self._db_name, size=size_mb(1)).table(self._tb_name)
+                for i in range(2000):
+                    other.append({'name': 'child-{:05}'.format(i), 'text': 'x' * 1000})
+                status = 0
+            finally:
+                os._exit(status)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.WEXITSTATUS(status), 0)
+        self.assertEqual(db.tables, [self._tb_name])
+        self.assertGreater(db.env.info()['map_size'], size)
+        self.assertEqual(db.table(self._tb_name).records, records + 2000)
+        db.close()
+
+    def test_57_append_retry(self):
+        db = Database(self._db_name)
+        table = db.table(self._tb_name)
+        table.index('by_name', '{name}')
+        table.append({'_id': b'f' * 24, 'name': 'last'})
+        put, keys = Index.put, []
+
+        def full(index, txn, key, record):
+            if not keys:
+                keys.append(key)
+                raise MapFullError('full')
+            return put(index, txn, key, record)
+
+        with patch.object(Index, 'put', full), patch.object(Database, '_grow'):
+            record = {'name': 'first'}
+            table.append(record)
+        self.assertEqual(record['_id'], keys[0].encode())
+        self.assertEqual(table.seek_one('by_name', {'name': 'first'})['_id'], record['_id'])
+        self.assertEqual(table.records, 2)
+        with self.assertRaises(xWriteFail):
+            table.append({'_id': b'e' * 23, 'name': 'early'})
+        db.close()
+
+    def test_58_stats_text_index(self):
+        db = Database(self._db_name)
+        table = db.table(self._tb_name)
+        table.index('by_text', '{notes}', text=True, positions=True)
+        for i in range(200):
+            table.append({'notes': ' '.join('word{}'.format(j) for j in range(i % 50))})
+        index = table.index('by_text')
+        stats = db.stats()
+        text = stats['tables'][self._tb_name]['indexes']['by_text']
+        with db.env.begin() as txn:
+            own = _stat_pages(txn.stat(index._db))
+            positions = _stat_pages(txn.stat(index._positions))
+            used = sum(_stat_pages(txn.stat(handle)) for handle in [db._db, db._metadata, db._binlog, table._db])
+        self.assertGreater(positions, 0)
+        self.assertEqual(_stat_pages(text), own + positions)
+        self.assertEqual(_stat_pages(text['positions']), positions)
+        self.assertEqual(stats['free_pages'], stats['pages'] - used - own - positions - 2)
+        self.assertEqual(stats['tables'][self._tb_name]['index_bytes'], text['bytes'])
+        db.close()
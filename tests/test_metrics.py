@@ -0,0 +1,102 @@
+#!/usr/bin/python3
+
+import unittest
+from subprocess import call
+from pymamba import Database
+from pymamba.metrics import Metrics, Prometheus, RingBuffer, Histogram, SlowQueryLog, Fanout
+
+
+class UnitTests(unittest.TestCase):
+
+    _db_name = 'databases/unit-db'
+    _tb_name = 'demo1'
+    _data = [
+        {'name': 'Gareth Bult', 'age': 21, 'admin': True, 'cat': 'A'},
+        {'name': 'Squizzey', 'age': 3000, 'cat': 'A'},
+        {'name': 'Fred Bloggs', 'age': 45, 'cat': 'A'},
+        {'name': 'John Doe', 'age': 40, 'admin': True, 'cat': 'B'},
+        {'name': 'John Smith', 'age': 40, 'cat': 'B'},
+        {'name': 'Jim Smith', 'age': 40, 'cat': 'B'},
+        {'name': 'Gareth Bult1', 'age': 21, 'admin': True, 'cat': 'B'}
+    ]
+
+    def setUp(self):
+        call(['rm', '-rf', self._db_name])
+
+    def generate(self, db):
+        table = db.table(self._tb_name)
+        table.index('by_age', '{age:03}', duplicates=True)
+        with db.begin():
+            for row in self._data:
+                table.append(dict(row))
+        return table
+
+    def test_01_ring_buffer(self):
+        metrics = RingBuffer(size=100)
+        db = Database(self._db_name, metrics=metrics)
+        table = self.generate(db)
+        events = metrics.events()
+        self.assertEqual([e['op'] for e in events if e['type'] == 'operation'], ['append'] * len(self._data))
+        self.assertEqual(events[-1]['type'], 'transaction')
+        self.assertGreaterEqual(events[-1]['seconds'], events[-1]['commit'])
+        doc = table.get(next(table.find())['_id'])
+        list(table.find(expression=lambda doc: doc['cat'] == 'A'))
+        list(table.seek('by_age', {'age': 40}))
+        table.seek_one('by_age', {'age': 40})
+        list(table.range('by_age', {'age': 21}, {'age': 40}))
+        table.save(doc)
+        table.delete(doc['_id'])
+        events = [e for e in metrics.events() if e['type'] == 'operation'][len(self._data):]
+        self.assertEqual([(e['op'], e['index']) for e in events], [
+            ('find', None), ('get', None), ('find', None), ('seek', 'by_age'), ('seek_one', 'by_age'),
+            ('range', 'by_age'), ('save', None), ('delete', None)])
+        self.assertEqual((events[0]['scanned'], events[0]['returned']), (1, 1))
+        self.assertEqual((events[2]['scanned'], events[2]['returned']), (len(self._data), 3))
+        self.assertEqual((events[3]['scanned'], events[3]['returned']), (3, 3))
+        self.assertEqual(len(RingBuffer(size=2).events()), 0)
+        db.close()
+
+    def test_02_prometheus(self):
+        metrics = Prometheus()
+        db = Database(self._db_name, metrics=metrics)
+        table = self.generate(db)
+        list(table.find(expression=lambda doc: doc['cat'] == 'A'))
+        list(table.find('by_age', limit=2))
+        text = metrics.render()
+        self.assertIn('# TYPE pymamba_operation_seconds histogram', text)
+        self.assertIn('pymamba_operation_seconds_count{op="append",table="demo1",index=""} 7', text)
+        self.assertIn('pymamba_operation_seconds_bucket{op="find",table="demo1",index="by_age",le="+Inf"} 1', text)
+        self.assertIn('pymamba_records_scanned_total{op="find",table="demo1",index=""} 7', text)
+        self.assertIn('pymamba_records_returned_total{op="find",table="demo1",index=""} 3', text)
+        self.assertIn('pymamba_transaction_seconds_count 1', text)
+        self.assertIn('pymamba_commit_seconds_bucket{le="+Inf"} 1', text)
+        db.close()
+
+    def test_03_histogram(self):
+        histogram = Histogram((1, 2))
+        for value in [0.5, 1, 1.5, 3]:
+            histogram.observe(value)
+        self.assertEqual(list(histogram.cumulative()), [('1', 2), ('2', 3), ('+Inf', 4)])
+        self.assertEqual((histogram.sum, histogram.count), (6.0, 4))
+        Metrics().operation('get', 'demo1', None, 0.1)
+        Metrics().transaction(0.1, 0.05)
+
+    def test_04_slow_query_log(self):
+        slow = SlowQueryLog(threshold=0, size=10)
+        metrics = Prometheus()
+        db = Database(self._db_name, metrics=Fanout(metrics, slow))
+        table = self.generate(db)
+        list(table.find(expression=lambda doc: doc['cat'] == 'B', limit=2))
+        entry = slow.entries()[-1]
+        self.assertEqual((entry['op'], entry['scanned'], entry['returned']), ('find', 5, 2))
+        self.assertIn('test_metrics.py', entry['caller'])
+        self.assertIn('test_04_slow_query_log', entry['caller'])
+        self.assertEqual(entry['params']['limit'], 2)
+        self.assertTrue(callable(entry['params']['expression']))
+        self.assertEqual(len(slow.entries()), 8)
+        self.assertIn('pymamba_operation_seconds_count{op="find",table="demo1",index=""} 1', metrics.render())
+        seen = []
+        db._metrics = SlowQueryLog(threshold=60, callback=seen.append)
+        table.get(entry['params'].get('index') or next(table.find())['_id'])
+        self.assertEqual(seen, [])
+        db.close()
@@ -0,0 +1,79 @@
+#!/usr/bin/python3
+
+import unittest
+from subprocess import call
+from time import time, sleep
+from pymamba import Database, xWriteFail
+from pymamba.reaper import Reaper
+
+
+class UnitTests(unittest.TestCase):
+
+    _db_name = 'databases/unit-db'
+    _tb_name = 'sessions'
+
+    def setUp(self):
+        call(['rm', '-rf', self._db_name])
+
+    def generate(self, db, now):
+        table = db.table(self._tb_name)
+        table.index('by_when', '{when}', ttl=60)
+        table.index('by_sid', '{sid:04}')
+        with db.begin():
+            for sid in range(100):
+                table.append({'sid': sid, 'when': now - 100 + sid, 'text': 'x' * 200})
+        return table
+
+    def test_01_expire(self):
+        db = Database(self._db_name)
+        now = time()
+        table = self.generate(db, now)
+        index = table.index('by_when')
+        self.assertEqual(index.ttl, 60)
+        self.assertTrue(index.duplicates)
+        self.assertEqual(index.fields, {'when'})
+        stats = table.expire(now=now, chunk_size=15)
+        self.assertEqual(stats['expired'], 41)
+        self.assertEqual(stats['chunks'], 3)
+        self.assertGreaterEqual(stats['reclaimed'], 0)
+        self.assertEqual(table.records, 59)
+        self.assertEqual(index.count(), 59)
+        self.assertEqual(table.index('by_sid').count(), 59)
+        self.assertEqual(next(table.find('by_when'))['sid'], 41)
+        self.assertEqual(table.expire(now=now)['expired'], 0)
+        with db.begin():
+            with self.assertRaises(xWriteFail):
+                table.expire()
+        db.close()
+        db = Database(self._db_name)
+        self.assertEqual(db.table(self._tb_name).index('by_when').ttl, 60)
+        db.close()
+
+    def test_02_ttl_needs_one_field(self):
+        db = Database(self._db_name)
+        with self.assertRaises(ValueError):
+            db.table(self._tb_name).index('by_when', '{when}{sid}', ttl=60)
+        self.assertEqual(db.table(self._tb_name).indexes, [])
+        db.close()
+
+    def test_03_reaper(self):
+        db = Database(self._db_name)
+        self.generate(db, time())
+        db.table('other').append({'when': 0})
+        results = []
+        reaper = Reaper(db, chunk_size=10, callback=results.append).start(interval=0.01)
+        with db.begin():
+            db.table(self._tb_name).append({'sid': 999, 'when': 0})
+            sleep(0.05)
+            self.assertIsNotNone(db.transaction)
+        reaper.stop()
+        self.assertGreaterEqual(reaper.status()['expired'], 41)
+        self.assertFalse(reaper.status()['running'])
+        self.assertEqual(list(results[0]['tables']), [self._tb_name])
+        self.assertEqual(db.table(self._tb_name).seek_one('by_sid', {'sid': 999}), None)
+        self.assertEqual(db.table('other').records, 1)
+        db.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
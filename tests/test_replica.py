@@ -0,0 +1,110 @@
+#!/usr/bin/python3
+
+import unittest
+from os import path
+from subprocess import call
+from threading import Thread
+from pymamba import Database, xReplicaFail
+from pymamba.replica import Replica, SocketSource, BinlogServer
+
+
+class UnitTests(unittest.TestCase):
+
+    _db_name = 'databases/unit-db'
+    _rp_name = 'databases/unit-replica'
+    _sock = 'databases/unit-replica.sock'
+    _tb_name = 'demo1'
+    _data = [
+        {'name': 'Gareth Bult', 'age': 21, 'admin': True, 'cat': 'A'},
+        {'name': 'Squizzey', 'age': 3000, 'cat': 'A'},
+        {'name': 'Fred Bloggs', 'age': 45, 'cat': 'A'},
+        {'name': 'John Doe', 'age': 40, 'admin': True, 'cat': 'B'},
+        {'name': 'John Smith', 'age': 40, 'cat': 'B'},
+        {'name': 'Jim Smith', 'age': 40, 'cat': 'B'},
+        {'name': 'Gareth Bult1', 'age': 21, 'admin': True, 'cat': 'B'}
+    ]
+
+    def setUp(self):
+        call(['rm', '-rf', self._db_name, self._rp_name, self._sock])
+
+    def generate(self, db):
+        table = db.table(self._tb_name)
+        with db.begin():
+            table.index('by_name', '{name}')
+            for row in self._data:
+                table.append(dict(row))
+        with db.begin():
+            doc = table.seek_one('by_name', {'name': 'Squizzey'})
+            doc['age'] += 1
+            table.save(doc)
+            table.delete(table.seek_one('by_name', {'name': 'John Doe'}))
+        return table
+
+    def compare(self, primary, replica):
+        self.assertEqual(list(primary.table(self._tb_name).find()), list(replica.table(self._tb_name).find()))
+        self.assertEqual(replica.table(self._tb_name).indexes, ['by_name'])
+        self.assertEqual(replica.table(self._tb_name).seek_one('by_name', {'name': 'Squizzey'})['age'], 3001)
+
+    def test_01_file_replica(self):
+        primary = Database(self._db_name)
+        self.generate(primary)
+        replica_db = Database(self._rp_name)
+        replica = Replica(replica_db, primary, batch=1)
+        status = replica.status()
+        self.assertIsNone(status['checkpoint'])
+        self.assertGreaterEqual(status['lag'], 0)
+        self.assertEqual(replica.poll(), 1)
+        self.assertEqual(replica.poll(), 1)
+        self.assertEqual(replica.poll(), 0)
+        self.compare(primary, replica_db)
+        status = replica.status()
+        self.assertEqual(status['checkpoint'], status['tail'])
+        self.assertEqual(status['lag'], 0)
+        self.assertEqual(status['applied'], 2)
+
+        replica_db.close()
+        replica_db = Database(self._rp_name)
+        replica = Replica(replica_db, primary)
+        self.assertEqual(replica.checkpoint, status['checkpoint'])
+        with primary.begin():
+            primary.table(self._tb_name).empty()
+        self.assertEqual(replica.poll(), 1)
+        self.assertEqual(replica_db.table(self._tb_name).records, 0)
+
+    def test_02_socket_replica(self):
+        primary = Database(self._db_name)
+        self.generate(primary)
+        server = BinlogServer(primary, self._sock)
+        thread = Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            replica_db = Database(self._rp_name)
+            replica = Replica(replica_db, SocketSource(self._sock, limit=1))
+            self.assertEqual(replica.poll(), 1)
+            self.assertEqual(replica.poll(), 1)
+            self.assertEqual(replica.poll(), 0)
+            self.compare(primary, replica_db)
+            self.assertEqual(replica.status()['lag'], 0)
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+    def test_03_divergence(self):
+        primary = Database(self._db_name)
+        replica_db = Database(self._rp_name)
+        replica_db.table(self._tb_name).index('by_name', '{age}', duplicates=True)
+        self.generate(primary)
+        replica = Replica(replica_db, primary)
+        self.assertEqual(replica.poll(), 2)
+        self.compare(primary, replica_db)
+        self.assertEqual(replica_db.table(self._tb_name).index('by_name').func, '{name}')
+        self.assertFalse(replica_db.table(self._tb_name).index('by_name').duplicates)
+
+        replica_db.table(self._tb_name).drop_index('by_name')
+        with primary.begin():
+            primary.table(self._tb_name).drop_index('by_name')
+        checkpoint = replica.checkpoint
+        with self.assertRaises(xReplicaFail):
+            replica.poll()
+        self.assertEqual(replica.checkpoint, checkpoint)